@@ -0,0 +1,61 @@
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from core.auth.document_access import check_file_access_in_metadata, is_caching_allowed
+from core.auth.permissions import check_wabo_for_mail_login
+from main.utils import ExpiringLRUCache, ImmediateHttpResponse
+
+# Making a decision takes a few dict lookups, so the decisions are kept in memory instead of in the shared cache
+access_decision_cache = ExpiringLRUCache(maxsize=settings.ACCESS_DECISION_CACHE_MAX_ENTRIES)
+
+
+class AccessDecision(NamedTuple):
+    status: int | None  # The status code of the response if access is denied, None if access is allowed
+    message: str | None
+    is_cacheable: bool
+
+    @property
+    def is_allowed(self):
+        return self.status is None
+
+    def raise_if_denied(self):
+        if not self.is_allowed:
+            raise ImmediateHttpResponse(response=HttpResponse(self.message, status=self.status))
+
+
+def get_access_decision_cache_key(metadata_version, url_info, scope, is_mail_login):
+    return (
+        metadata_version,
+        scope,
+        is_mail_login,
+        url_info["source"],
+        url_info["stadsdeel"],
+        url_info["dossier"],
+        url_info["document_barcode"],
+    )
+
+
+def decide_access(metadata, url_info, scope, is_mail_login):
+    try:
+        check_wabo_for_mail_login(is_mail_login, url_info)
+        check_file_access_in_metadata(metadata, url_info, scope)
+    except ImmediateHttpResponse as e:
+        return AccessDecision(e.response.status_code, e.response.content.decode("utf-8"), False)
+    return AccessDecision(None, None, is_caching_allowed(metadata, url_info))
+
+
+def get_access_decision(metadata, metadata_version, url_info, scope, is_mail_login):
+    """
+    Decide whether a user may view a document and whether the response may be cached. The same decision holds for
+    all files in a document, so it is cached per (scope, login type, dossier, document). The decision is tied to
+    the version of the metadata it was derived from, so that it's never used with other metadata.
+    """
+    cache_key = get_access_decision_cache_key(metadata_version, url_info, scope, is_mail_login)
+    decision = access_decision_cache.get(cache_key)
+    if decision is None:
+        decision = decide_access(metadata, url_info, scope, is_mail_login)
+        access_decision_cache.set(cache_key, decision, time.time() + settings.METADATA_CACHE_TIMEOUT)
+    return decision
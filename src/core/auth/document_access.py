@@ -13,11 +13,7 @@ from main.utils import ImmediateHttpResponse
 
 
 def _valid_scope_given(scope: str) -> None:
-    if scope not in (
-        settings.BOUWDOSSIER_PUBLIC_SCOPE,
-        settings.BOUWDOSSIER_EXTENDED_SCOPE,
-        settings.BOUWDOSSIER_READ_SCOPE,
-    ):
+    if scope not in settings.BOUWDOSSIER_SCOPES:
         raise ImmediateHttpResponse(response=HttpResponse(RESPONSE_CONTENT_INVALID_SCOPE, status=401))
 
 
@@ -1,3 +1,4 @@
+import hashlib
 from datetime import datetime, timedelta, timezone
 
 import jwt
@@ -9,7 +10,10 @@ from core.auth.constants import (
     RESPONSE_CONTENT_INVALID_SCOPE,
     RESPONSE_CONTENT_NO_TOKEN,
 )
-from main.utils import ImmediateHttpResponse
+from main.utils import ExpiringLRUCache, ImmediateHttpResponse
+
+# Decoded mail login tokens by the digest of the token. Viewers send the same token along with every file request.
+decoded_token_cache = ExpiringLRUCache(maxsize=settings.JWT_CACHE_MAX_ENTRIES)
 
 
 def check_auth_availability(request):
@@ -29,32 +33,46 @@ def read_out_mail_jwt_token(request):
             if settings.DATAPUNT_AUTHZ["ALWAYS_OK"]:
                 return jwt_token, is_mail_login
             raise ImmediateHttpResponse(response=HttpResponse(RESPONSE_CONTENT_NO_TOKEN, status=401))
-        try:
-            jwt_token = jwt.decode(
-                request.GET.get("auth"),
-                settings.JWT_SECRET_KEY,
-                algorithms=[settings.JWT_ALGORITHM],
-            )
-            # Check scopes
-            for scope in jwt_token.get("scopes"):
-                if scope not in (
-                    settings.BOUWDOSSIER_PUBLIC_SCOPE,
-                    settings.BOUWDOSSIER_READ_SCOPE,
-                    settings.BOUWDOSSIER_EXTENDED_SCOPE,
-                ):
-                    raise ImmediateHttpResponse(response=HttpResponse(RESPONSE_CONTENT_INVALID_SCOPE, status=401))
-        except ExpiredSignatureError as e:
-            raise ImmediateHttpResponse(response=HttpResponse("Expired JWT token signature", status=401)) from e
-        except InvalidSignatureError as e:
-            raise ImmediateHttpResponse(response=HttpResponse("Invalid JWT token signature", status=401)) from e
-        except DecodeError as e:
-            raise ImmediateHttpResponse(response=HttpResponse("Invalid JWT token", status=401)) from e
-
+        jwt_token = decode_mail_jwt_token(request.GET.get("auth"))
         is_mail_login = True
 
     return jwt_token, is_mail_login
 
 
+def decode_mail_jwt_token(token):
+    """
+    Decode and verify a mail login token. Valid tokens are cached until they expire, so the signature only has to
+    be checked once per token.
+    """
+    token_digest = hashlib.sha256(token.encode()).digest()
+    jwt_token = decoded_token_cache.get(token_digest)
+    if jwt_token is not None:
+        return dict(jwt_token)
+
+    try:
+        jwt_token = jwt.decode(
+            token,
+            settings.JWT_SECRET_KEY,
+            algorithms=[settings.JWT_ALGORITHM],
+        )
+    except ExpiredSignatureError as e:
+        raise ImmediateHttpResponse(response=HttpResponse("Expired JWT token signature", status=401)) from e
+    except InvalidSignatureError as e:
+        raise ImmediateHttpResponse(response=HttpResponse("Invalid JWT token signature", status=401)) from e
+    except DecodeError as e:
+        raise ImmediateHttpResponse(response=HttpResponse("Invalid JWT token", status=401)) from e
+
+    # Check scopes, a token without any scope is never valid
+    scopes = jwt_token.get("scopes")
+    if not scopes or not settings.BOUWDOSSIER_SCOPES.issuperset(scopes):
+        raise ImmediateHttpResponse(response=HttpResponse(RESPONSE_CONTENT_INVALID_SCOPE, status=401))
+
+    # Tokens without expiry are not cached, so that they are always checked
+    if "exp" in jwt_token:
+        decoded_token_cache.set(token_digest, jwt_token, jwt_token["exp"])
+    return dict(jwt_token)
+
+
 def create_mail_login_token(email_address, key, expiry_hours=24):
     """
     Prepare a JSON web token to be used by the dataportaal. A link which includes this token is sent to the
@@ -4,4 +4,5 @@ from . import views
 
 urlpatterns = [
     path("", views.health),
+    path("upstreams", views.upstreams),
 ]
@@ -1,7 +1,9 @@
 import logging
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+
+from iiif import upstream
 
 log = logging.getLogger(__name__)
 
@@ -17,3 +19,18 @@ def health(request):
         )
 
     return HttpResponse("Connectivity OK", content_type="text/plain", status=200)
+
+
+def upstreams(request):
+    # The state of the circuit breakers and bulkheads of the upstream servers. An open circuit doesn't make this
+    # app unhealthy, restarting it wouldn't bring the upstream server back.
+    return JsonResponse(
+        {
+            name: {
+                **breaker.status(),
+                "active": upstream.get_bulkhead(name).active,
+                "waiting": upstream.get_bulkhead(name).waiting,
+            }
+            for name, breaker in upstream.circuit_breakers.items()
+        }
+    )
@@ -0,0 +1,19 @@
+import asyncio
+from weakref import WeakKeyDictionary
+
+import httpx
+
+# One client (and so one connection pool) per event loop, because a client can't be shared between event loops.
+# Under an ASGI server there is a single event loop, but async views served through WSGI get an event loop per request.
+_clients = WeakKeyDictionary()
+
+
+def get_async_client(verify=True):
+    """
+    Get the shared async HTTP client of the running event loop. The source servers use certificates which can't
+    be verified, so those are requested with a client with verify=False.
+    """
+    loop_clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    if verify not in loop_clients:
+        loop_clients[verify] = httpx.AsyncClient(verify=verify)
+    return loop_clients[verify]
@@ -0,0 +1,53 @@
+import logging
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from main.utils import ImmediateHttpResponse
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CONTENT_DEADLINE_EXCEEDED = "The request took too long while {stage}, please try again later"
+
+
+class Deadline:
+    """
+    The time left to handle a request. uWSGI kills a worker which takes longer than its harakiri timeout, so every
+    stage of a request (getting the metadata, retrieving the file, processing the image) only gets the time which
+    is left. When the time runs out the request fails with a 504, instead of being killed halfway.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def exceeded(self, stage):
+        log.warning(f"Deadline of {self.budget}s exceeded while {stage}")
+        return ImmediateHttpResponse(
+            response=HttpResponse(RESPONSE_CONTENT_DEADLINE_EXCEEDED.format(stage=stage), status=504)
+        )
+
+    def check(self, stage):
+        if self.expired:
+            raise self.exceeded(stage)
+
+    def timeout(self, connect, read, stage):
+        """
+        The (connect, read) timeout for a request, limited to the time which is left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise self.exceeded(stage)
+        return min(connect, remaining), min(read, remaining)
+
+
+def create_request_deadline():
+    return Deadline(settings.REQUEST_DEADLINE)
@@ -0,0 +1,103 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from iiif import image_server
+from iiif.image_handling import get_image_dimensions, is_image_content_type
+from iiif.image_server import create_non_image_file_thumbnail
+from main.utils import ImmediateHttpResponse
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CONTENT_DIMENSIONS_UNKNOWN = "The dimensions of the file could not be determined"
+
+
+def get_dimensions_cache_key(url_info):
+    return (
+        f"iiif-dimensions:{url_info['source']}:{url_info['stadsdeel']}_{url_info['dossier']}"
+        f"~{url_info['document_barcode']}_{url_info['filenr']}@{url_info.get('page') or 0}"
+    )
+
+
+def get_cached_dimensions(url_info):
+    return cache.get(get_dimensions_cache_key(url_info))
+
+
+async def get_cached_dimensions_async(url_info):
+    # The async variant of get_cached_dimensions
+    return await cache.aget(get_dimensions_cache_key(url_info))
+
+
+def store_dimensions(url_info, dimensions):
+    cache.set(get_dimensions_cache_key(url_info), dimensions, settings.DIMENSIONS_CACHE_TIMEOUT)
+
+
+def get_file_dimensions(url_info, file_content, file_type):
+    """
+    Get the dimensions of a retrieved file and store them in the cache. Files which are not an image
+    get the dimensions of the thumbnail which is served in their place.
+    """
+    page = url_info.get("page")
+    if not is_image_content_type(file_type):
+        file_content = create_non_image_file_thumbnail(file_format="jpeg")
+        file_type = "image/jpeg"
+        page = None
+
+    dimensions = get_image_dimensions(file_content, file_type, page)
+    store_dimensions(url_info, dimensions)
+    return dimensions
+
+
+def probe_dimensions(url_info, metadata):
+    """
+    Get the dimensions of a file from the cache, or retrieve the file from the source server if they are unknown.
+    Access to the file should be checked before calling this.
+    """
+    dimensions = get_cached_dimensions(url_info)
+    if dimensions:
+        return dimensions
+
+    file_response, file_url = image_server.get_file(url_info, metadata)
+    image_server.handle_file_response_codes(file_response, file_url)
+    return get_file_dimensions(url_info, file_response.content, file_response.headers.get("Content-Type"))
+
+
+def _probe_dimensions_or_error(url_info, metadata):
+    try:
+        return probe_dimensions(url_info, metadata)
+    except ImmediateHttpResponse as e:
+        return e.response
+    except Exception as e:
+        log.exception(f"Exception while probing the dimensions of {url_info}: ({e})")
+        return HttpResponse(RESPONSE_CONTENT_DIMENSIONS_UNKNOWN, status=502)
+
+
+def probe_dimensions_concurrently(files):
+    """
+    Probe the dimensions of many files at once. Cached dimensions are returned directly, the other files are
+    retrieved from the source servers in parallel.
+
+    :param files: Dict of iiif_url -> (url_info, metadata)
+    :return: Dict of iiif_url -> dimensions, or the HttpResponse describing why the dimensions are unknown
+    """
+    results = {}
+    uncached_files = {}
+    for iiif_url, (url_info, metadata) in files.items():
+        dimensions = get_cached_dimensions(url_info)
+        if dimensions:
+            results[iiif_url] = dimensions
+        else:
+            uncached_files[iiif_url] = (url_info, metadata)
+
+    if uncached_files:
+        with ThreadPoolExecutor(max_workers=settings.DIMENSIONS_PROBE_MAX_WORKERS) as executor:
+            futures = {
+                iiif_url: executor.submit(_probe_dimensions_or_error, url_info, metadata)
+                for iiif_url, (url_info, metadata) in uncached_files.items()
+            }
+        results.update({iiif_url: future.result() for iiif_url, future in futures.items()})
+
+    return {iiif_url: results[iiif_url] for iiif_url in files}
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+from django.conf import settings
+from opentelemetry import metrics
+
+from iiif import upstream
+
+log = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+# The requests (and their hedges) run in this pool, so that the first one to respond can be used
+hedge_executor = futures.ThreadPoolExecutor(max_workers=settings.HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class Hedger:
+    """
+    Sends a second, identical request when the first one doesn't get a response in time, and uses whichever
+    response comes first. This cuts off the long tail of response times of a source server.
+
+    The delay is a percentile of the recent times to the response headers, so only the slowest requests are hedged.
+    The number of hedges in flight is limited to a share (at most all) of the requests in flight, so the load on the
+    source server is never more than doubled. A hedge also takes a slot of the bulkhead of the upstream server, and
+    is skipped when none is free, so hedges don't go over the limit of concurrent requests.
+    """
+
+    def __init__(self, name, percentile, default_delay, min_delay, window_size, min_samples, max_ratio):
+        self.name = name
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_ratio = min(max_ratio, 1)
+        self.primaries = 0
+        self.hedges = 0
+        self._latencies = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    @property
+    def _bulkhead(self):
+        return upstream.get_bulkhead(self.name)
+
+    def record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def get_delay(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.default_delay
+        index = min(len(latencies) - 1, math.ceil(self.percentile / 100 * len(latencies)) - 1)
+        return max(self.min_delay, latencies[index])
+
+    def _start_primary(self):
+        with self._lock:
+            self.primaries += 1
+
+    def _finish_primary(self):
+        with self._lock:
+            self.primaries -= 1
+
+    def _try_start_hedge(self):
+        with self._lock:
+            if self.hedges >= max(1, math.floor(self.primaries * self.max_ratio)) or not self._bulkhead.try_acquire():
+                hedges.add(1, {"upstream": self.name, "outcome": "skipped"})
+                return False
+            self.hedges += 1
+            return True
+
+    def _finish_hedge(self):
+        with self._lock:
+            self.hedges -= 1
+        self._bulkhead.release()
+
+    def _submit(self, send, is_hedge):
+        future = hedge_executor.submit(send)
+        # The counts follow the requests which are actually running, also after they have lost
+        future.add_done_callback(lambda f: self._finish_hedge() if is_hedge else self._finish_primary())
+        return future
+
+    def get(self, send):
+        """
+        Call send (which does a request and returns a streaming response) and hedge it if it's slow. The response
+        of the losing request is closed, so its connection doesn't keep downloading the file.
+        """
+        start = time.monotonic()
+        self._start_primary()
+        primary = self._submit(send, is_hedge=False)
+        try:
+            response = primary.result(timeout=self.get_delay())
+        except futures.TimeoutError:
+            pass
+        else:
+            self.record_latency(time.monotonic() - start)
+            return response
+
+        if not self._try_start_hedge():
+            response = primary.result()
+            self.record_latency(time.monotonic() - start)
+            return response
+
+        hedge = self._submit(send, is_hedge=True)
+        winner = _first_successful([primary, hedge])
+        loser = hedge if winner is primary else primary
+        loser.cancel()
+        loser.add_done_callback(_close_response)
+
+        hedges.add(1, {"upstream": self.name, "outcome": "won" if winner is hedge else "lost"})
+        response = winner.result()
+        self.record_latency(time.monotonic() - start)
+        return response
+
+    async def get_async(self, send):
+        # The async variant of get, in which send is a coroutine function. The losing request is cancelled.
+        start = time.monotonic()
+        self._start_primary()
+        primary = asyncio.ensure_future(send())
+        primary.add_done_callback(lambda _: self._finish_primary())
+        tasks = [primary]
+        winner = None
+        try:
+            done, _ = await asyncio.wait([primary], timeout=self.get_delay())
+            if done or not self._try_start_hedge():
+                response = await primary
+                self.record_latency(time.monotonic() - start)
+                return response
+
+            hedge = asyncio.ensure_future(send())
+            hedge.add_done_callback(lambda _: self._finish_hedge())
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+        finally:
+            # Cancel whichever request is still running, also when this request itself is cancelled
+            for task in tasks:
+                task.cancel()
+
+        if winner is None:
+            # Both requests failed, so raise the error of the original request
+            return await primary
+
+        hedges.add(1, {"upstream": self.name, "outcome": "won" if winner is hedge else "lost"})
+        loser = hedge if winner is primary else primary
+        if loser.done() and not loser.cancelled() and loser.exception() is None:
+            await loser.result().aclose()
+        self.record_latency(time.monotonic() - start)
+        return winner.result()
+
+
+def _first_successful(pending):
+    """
+    Wait for the first future which doesn't raise. If all of them raise, the first one is returned.
+    """
+    first = pending[0]
+    pending = set(pending)
+    while pending:
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future
+    return first
+
+
+hedgers = {name: Hedger(name, **options) for name, options in settings.HEDGING.items()}
+
+
+def get_hedger(upstream):
+    return hedgers[upstream]
+
+
+hedges = meter.create_counter(
+    "iiif.upstream.hedges",
+    description="Hedged requests to the source server, and whether the hedge won, lost or was skipped",
+)
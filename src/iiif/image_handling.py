@@ -2,6 +2,7 @@ import json
 import logging
 from copy import deepcopy
 from io import BytesIO
+from math import ceil
 
 from django.http import HttpResponse
 from PIL import Image
@@ -26,6 +27,14 @@ MISSING_REGION_PARAMETER = (
 )
 NON_OVERLAPPING_REGION_PARAMETER = "The region parameter should overlap with the image."
 NON_POSITIVE_WIDTH_HEIGHT_REGION_PARAMETER = "The region parameter should have a positive width and height value"
+NON_EXISTING_PAGE_PARAMETER = "The requested page does not exist in this file."
+
+# TIFF tag 254 (NewSubfileType). If bit 0 is set, the frame is a reduced-resolution version of the previous page.
+TIFF_TAG_NEW_SUBFILE_TYPE = 254
+TIFF_REDUCED_RESOLUTION_SUBFILE = 0x1
+
+# Tiles of files which can't be shown are left blank in this color
+SPRITE_BACKGROUND_COLOR = "#eeeeee"
 
 BASE_INFO_JSON = {
     "@context": "http://iiif.io/api/image/2/context.json",
@@ -45,25 +54,158 @@ BASE_INFO_JSON = {
 }
 
 
-def generate_info_json(image_base_url, content, content_type):
+def get_image_dimensions(content, content_type, page=None):
+    """
+    Get the dimensions of the image, which is everything needed to generate the info.json
+
+    :param content: The image data
+    :param content_type: The content type of the image
+    :param page: The requested page of a multi-page file (zero-based), or None for the first page
+    :return: Dict with the width, height, available sizes and format of the image
+    """
+    img = Image.open(BytesIO(content))
+    levels = get_levels_for_page(img, page)
+    _, width, height = levels[0]
+
+    return {
+        "width": width,
+        "height": height,
+        # List the reduced-resolution levels too, so that viewers can request the sizes which are cheap to serve
+        "sizes": [{"width": level_width, "height": level_height} for _, level_width, level_height in reversed(levels)],
+        "format": content_type_to_format(content_type).replace("jpeg", "jpg"),
+    }
+
+
+def create_info_json(image_base_url, dimensions):
+    """
+    Create the info.json for the image from its dimensions
+
+    :param image_base_url: The base url of the image
+    :param dimensions: The dimensions as returned by get_image_dimensions
+    :return: The info.json as a dict
+    """
+    info_json = deepcopy(BASE_INFO_JSON)
+    info_json["@id"] = image_base_url
+    info_json["width"] = dimensions["width"]
+    info_json["height"] = dimensions["height"]
+    info_json["sizes"] = dimensions["sizes"]
+    info_json["profile"][1]["formats"] = [dimensions["format"]]
+
+    return info_json
+
+
+def generate_info_json(image_base_url, content, content_type, page=None):
     """
     Generate the info.json for the image
 
     :param image_base_url: The base url of the image
     :param content: The image data
     :param content_type: The content type of the image
+    :param page: The requested page of a multi-page file (zero-based), or None for the first page
     :return: The info.json
     """
+    dimensions = get_image_dimensions(content, content_type, page)
+    return json.dumps(create_info_json(image_base_url, dimensions))
+
+
+def get_page_levels(img):
+    """
+    Group the frames of an image per page. Frames of a (pyramidal) TIFF which are flagged as a reduced-resolution
+    subfile are added as extra levels to the full resolution page preceding them. Any other image is considered
+    to be a single page with a single level.
+
+    Note that reduced-resolution images stored as SubIFDs (instead of in the main IFD chain) are not detected.
+
+    :param img: The opened image
+    :return: List of pages, each page being a list of (frame, width, height) tuples sorted from large to small
+    """
+    if img.format != "TIFF":
+        return [[(0, img.width, img.height)]]
+
+    pages = []
+    for frame in range(img.n_frames):
+        img.seek(frame)
+        level = (frame, img.width, img.height)
+        is_reduced_resolution = img.tag_v2.get(TIFF_TAG_NEW_SUBFILE_TYPE, 0) & TIFF_REDUCED_RESOLUTION_SUBFILE
+        if is_reduced_resolution and pages:
+            pages[-1].append(level)
+        else:
+            pages.append([level])
+    img.seek(0)
+
+    return [sorted(levels, key=lambda level: level[1] * level[2], reverse=True) for levels in pages]
+
+
+def get_levels_for_page(img, page):
+    pages = get_page_levels(img)
+    page = page or 0
+    if not 0 <= page < len(pages):
+        raise utils.ImmediateHttpResponse(response=HttpResponse(NON_EXISTING_PAGE_PARAMETER, status=400))
+    return pages[page]
+
+
+def select_page(page, region, scaling, content):
+    """
+    Select the requested page of a (multi-page) file and, if the file contains reduced-resolution versions of
+    that page, the smallest one that still satisfies the requested scaling. Reduced-resolution levels are only
+    used when the full region is requested, because region coordinates refer to the full resolution page.
+
+    :param page: The requested page (zero-based), or None for the first page
+    :param region: The region string from the url
+    :param scaling: The scaling string from the url
+    :param content: The image data
+    :return: The image data of the selected page/level, or the original data if that is the first frame
+    """
     img = Image.open(BytesIO(content))
+    levels = get_levels_for_page(img, page)
+    frame = levels[0][0]
+
+    if region.lower() == "full" and scaling.lower() != "full":
+        img.seek(frame)
+        requested_width, requested_height = parse_scaling_string(scaling)
+        target_width, target_height = calculate_scaled_dimensions(img, requested_width, requested_height)
+        for level_frame, level_width, level_height in reversed(levels):
+            if level_width >= target_width and level_height >= target_height:
+                frame = level_frame
+                break
+
+    if frame == 0:
+        return content
 
-    info_json = deepcopy(BASE_INFO_JSON)
-    info_json["@id"] = image_base_url
-    info_json["width"] = img.width
-    info_json["height"] = img.height
-    info_json["sizes"] = [{"width": img.width, "height": img.height}]
-    info_json["profile"][1]["formats"] = [content_type_to_format(content_type).replace("jpeg", "jpg")]
+    img.seek(frame)
+    image_stream = BytesIO()
+    img.save(image_stream, format=img.format)
+    return image_stream.getvalue()
 
-    return json.dumps(info_json)
+
+def create_sprite(thumbnails, tile_size, columns):
+    """
+    Combine thumbnails into one grid image (sprite). Every thumbnail gets a square tile in the grid, filled from
+    the top left corner.
+
+    :param thumbnails: List of jpeg data of the thumbnails, or None for a blank tile
+    :param tile_size: The width and height of a tile
+    :param columns: The maximum number of tiles per row
+    :return: Tuple with the jpeg data of the sprite and a list with the x, y, width and height of every thumbnail
+    """
+    columns = max(1, min(columns, len(thumbnails)))
+    rows = max(1, ceil(len(thumbnails) / columns))
+    sprite = Image.new("RGB", (columns * tile_size, rows * tile_size), color=SPRITE_BACKGROUND_COLOR)
+
+    tiles = []
+    for position, thumbnail in enumerate(thumbnails):
+        x = (position % columns) * tile_size
+        y = (position // columns) * tile_size
+        width = height = tile_size
+        if thumbnail is not None:
+            img = Image.open(BytesIO(thumbnail))
+            sprite.paste(img, (x, y))
+            width, height = img.size
+        tiles.append({"x": x, "y": y, "width": width, "height": height})
+
+    image_stream = BytesIO()
+    sprite.save(image_stream, format="jpeg")
+    return image_stream.getvalue(), tiles
 
 
 def parse_scaling_string(scaling):
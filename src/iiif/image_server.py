@@ -1,16 +1,21 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from io import BytesIO
-from math import floor
 
+import httpx
 import requests
 from django.conf import settings
 from django.http import HttpResponse
 from PIL import Image
 from requests.exceptions import RequestException
 
+from iiif import async_client, hedging, upstream
+from iiif.deadline import Deadline
 from main.utils import ImmediateHttpResponse
 from zip_consumer import zip_tools
+from zip_consumer.file_cache import file_cache_lookups, get_file_cache, get_file_cache_key
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +24,12 @@ RESPONSE_CONTENT_ERROR_RESPONSE_FROM_IMAGE_SERVER = (
 )
 
 
+# Shared by all zip jobs in the process
+zip_download_source_limits = {
+    source: threading.BoundedSemaphore(limit) for source, limit in settings.ZIP_DOWNLOAD_SOURCE_LIMITS.items()
+}
+
+
 class FilenameNotFoundInDocumentInMetadataError(Exception):
     pass
 
@@ -95,43 +106,133 @@ def _create_image(
 create_non_image_file_thumbnail = partial(_create_image, size=(180, 180), color="green")
 
 
-def get_file(url_info, metadata):
+def is_server_error(file_response):
+    # Server errors count as failures for the circuit breaker, a missing file doesn't
+    return file_response is not None and file_response.status_code >= 500
+
+
+def get_variant_timeout(deadline, variants_left):
+    # Split the time which is left over the variants which still have to be tried
+    return deadline.timeout(5, deadline.remaining() / variants_left, "retrieving the file")
+
+
+def raise_image_server_error(e, deadline):
+    if deadline.expired:
+        raise deadline.exceeded("retrieving the file") from e
+    raise create_image_server_error(e) from e
+
+
+def request_file(source, file_url, headers, timeout, call):
+    # The response is streamed, so the time until the headers arrive can be told apart from the download of the file.
+    # With hedging, the hedger also uses it to close the losing response.
+    send = partial(requests.get, file_url, headers=headers, verify=False, timeout=timeout, stream=True)
+    file_response = hedging.get_hedger(source).get(send) if settings.HEDGED_REQUESTS else send()
+    call.responded()
+    # Reading the content downloads the file while the upstream slot is still held, the response keeps it
+    _ = file_response.content
+    return file_response
+
+
+def get_file(url_info, metadata, deadline=None, extra_headers=None):
+    """
+    Retrieve a file from its source server, trying the variants of its filename. All variants together may take
+    until the deadline, which is FILE_REQUEST_TIMEOUT seconds if no deadline is given.
+    """
+    deadline = deadline or Deadline(settings.FILE_REQUEST_TIMEOUT)
     file_url, headers = create_file_url_and_headers(url_info, metadata)
+    headers = headers | (extra_headers or {})
     file_response = None
     successful_url = None
     last_error = None
 
     file_url_variants = _get_filename_variants(file_url)
-    max_timeout = floor(25 / len(file_url_variants))  # Calculate the correct max_timeout
-    for file_url_variant in file_url_variants:
-        try:
-            file_response = requests.get(
-                file_url_variant,
-                headers=headers,
-                verify=False,
-                timeout=(5, max_timeout),
-            )
-            if file_response.status_code != 404:
-                successful_url = file_url_variant
-                break
-        except RequestException as e:
-            log.warning(f"Request failed for {file_url_variant}: {e.__class__.__name__}")
-            last_error = e
-
-            # Try the next variant
-            continue
-
-    # If all variants failed, raise error
-    if file_response is None and last_error:
-        message = f"{RESPONSE_CONTENT_ERROR_RESPONSE_FROM_IMAGE_SERVER} {last_error.__class__.__name__}"
-        log.error(message)
-        file_response = HttpResponse(message, status=502)
-        raise ImmediateHttpResponse(response=file_response) from last_error
+    deadline.check("retrieving the file")
+    with upstream.guard(url_info["source"], deadline) as call:
+        for index, file_url_variant in enumerate(file_url_variants):
+            # Only the request of the last variant which was tried counts for the circuit breaker
+            call.start()
+            try:
+                file_response = request_file(
+                    url_info["source"],
+                    file_url_variant,
+                    headers,
+                    get_variant_timeout(deadline, len(file_url_variants) - index),
+                    call,
+                )
+                if file_response.status_code != 404:
+                    successful_url = file_url_variant
+                    break
+            except RequestException as e:
+                log.warning(f"Request failed for {file_url_variant}: {e.__class__.__name__}")
+                last_error = e
+
+                # Try the next variant
+                continue
+
+        # If all variants failed, raise error
+        if file_response is None and last_error:
+            raise_image_server_error(last_error, deadline)
+        call.failed = is_server_error(file_response)
 
     log.info(f"Reached finally, {file_response=}")
     return file_response, successful_url or file_url
 
 
+def create_image_server_error(e):
+    message = f"{RESPONSE_CONTENT_ERROR_RESPONSE_FROM_IMAGE_SERVER} {e.__class__.__name__}"
+    log.error(message)
+    return ImmediateHttpResponse(response=HttpResponse(message, status=502))
+
+
+async def request_file_async(client, source, file_url, headers, timeout, call):
+    # The async variant of request_file
+    async def send():
+        return await client.send(client.build_request("GET", file_url, headers=headers, timeout=timeout), stream=True)
+
+    file_response = await (hedging.get_hedger(source).get_async(send) if settings.HEDGED_REQUESTS else send())
+    call.responded()
+    await file_response.aread()
+    return file_response
+
+
+async def get_file_async(url_info, metadata, deadline=None):
+    # The async variant of get_file
+    deadline = deadline or Deadline(settings.FILE_REQUEST_TIMEOUT)
+    file_url, headers = create_file_url_and_headers(url_info, metadata)
+    file_response = None
+    successful_url = None
+    last_error = None
+
+    file_url_variants = _get_filename_variants(file_url)
+    client = async_client.get_async_client(verify=False)
+    deadline.check("retrieving the file")
+    async with upstream.guard_async(url_info["source"], deadline) as call:
+        for index, file_url_variant in enumerate(file_url_variants):
+            connect_timeout, read_timeout = get_variant_timeout(deadline, len(file_url_variants) - index)
+            call.start()
+            try:
+                file_response = await request_file_async(
+                    client,
+                    url_info["source"],
+                    file_url_variant,
+                    headers,
+                    httpx.Timeout(read_timeout, connect=connect_timeout),
+                    call,
+                )
+                if file_response.status_code != 404:
+                    successful_url = file_url_variant
+                    break
+            except httpx.HTTPError as e:
+                log.warning(f"Request failed for {file_url_variant}: {e.__class__.__name__}")
+                last_error = e
+
+        if file_response is None and last_error:
+            raise_image_server_error(last_error, deadline)
+        call.failed = is_server_error(file_response)
+
+    return file_response, successful_url or file_url
+
+
 def handle_file_response_codes(file_response, file_url):
 
     if file_response is None:
@@ -156,13 +257,12 @@ def handle_file_response_codes(file_response, file_url):
 
 
 def prepare_zip_downloads():
-    # Create a tmp folder to store downloaded source files
-    zipjob_uuid, tmp_folder_path = zip_tools.create_tmp_folder()
+    zipjob_uuid = zip_tools.create_zipjob_uuid()
 
     # Init contents of txt info file which is sent along in the zip
     info_txt_contents = "The following files were requested:\n"
 
-    return zipjob_uuid, tmp_folder_path, info_txt_contents
+    return zipjob_uuid, info_txt_contents
 
 
 def download_file_for_zip(
@@ -171,29 +271,92 @@ def download_file_for_zip(
     url_info,
     fail_reason,
     metadata,
-    tmp_folder_path,
+    zip_writer,
 ):
+    return info_txt_contents + get_file_for_zip(iiif_url, url_info, fail_reason, metadata, zip_writer)
+
+
+def get_file_for_zip(iiif_url, url_info, fail_reason, metadata, zip_writer):
+    """
+    Add a file to a zip, unless it may not be zipped
+
+    :return: The line about the file for the report.txt
+    """
     filename = get_filename(url_info, metadata)
-    info_txt_contents += f"{filename}: "
 
     if fail_reason:
-        info_txt_contents += f"excluded, {fail_reason}\n"
-        return info_txt_contents
+        return f"{filename}: excluded, {fail_reason}\n"
+
+    if filename in zip_writer:
+        # Another page of the same file, or a file from the checkpoint of an earlier attempt of the job
+        return f"{filename}: included\n"
 
     try:
-        file_response, file_url = get_file(url_info, metadata)
-        handle_file_response_codes(file_response, file_url)
+        content, content_type = get_file_content_for_zip(url_info, metadata)
     except ImmediateHttpResponse as e:
         log.exception(f"HTTP Exception while retrieving {iiif_url} from the source system: ({e.response.content})")
-        info_txt_contents += "excluded, Error occurred while getting file from the source system\n"
-        return info_txt_contents
+        return f"{filename}: excluded, Error occurred while getting file from the source system\n"
     except Exception as e:
         log.exception(f"Exception while retrieving {iiif_url} from the source system: ({e}).")
-        info_txt_contents += "excluded, Error occurred while getting file from the source system\n"
-        return info_txt_contents
+        return f"{filename}: excluded, Error occurred while getting file from the source system\n"
+
+    zip_writer.add_file(filename, content, content_type)
+    return f"{filename}: included\n"
+
+
+def get_file_content_for_zip(url_info, metadata):
+    """
+    Retrieve a file for a zip. When it's in the file cache, it's only downloaded when it was changed on the source
+    server. Whether the file may be zipped should be checked before.
+
+    :return: Tuple of the content and content type of the file
+    """
+    file_cache = get_file_cache()
+    cache_key = get_file_cache_key(url_info["source"], create_url(url_info, metadata))
+    cached_file = file_cache.get(cache_key) if file_cache is not None else None
+
+    # Don't put more load on a source server than the web server would
+    with zip_download_source_limits[url_info["source"]]:
+        file_response, file_url = get_file(
+            url_info, metadata, extra_headers=cached_file.validators if cached_file is not None else None
+        )
+
+    if cached_file is not None and file_response is not None and file_response.status_code == 304:
+        content = file_cache.read(cache_key, cached_file)
+        if content is not None:
+            file_cache_lookups.add(1, {"outcome": "unchanged"})
+            return content, cached_file.content_type
+
+        # The file was removed from the cache by another job in the meantime
+        cached_file = None
+        with zip_download_source_limits[url_info["source"]]:
+            file_response, file_url = get_file(url_info, metadata)
+
+    handle_file_response_codes(file_response, file_url)
+    if file_cache is not None:
+        file_cache_lookups.add(1, {"outcome": "changed" if cached_file is not None else "not_cached"})
+        file_cache.set(cache_key, file_response.content, file_response.headers)
+    return file_response.content, file_response.headers.get("Content-Type")
+
+
+def _get_file_for_zip_or_error(iiif_url, url_info, fail_reason, metadata, zip_writer):
+    try:
+        return get_file_for_zip(iiif_url, url_info, fail_reason, metadata, zip_writer)
+    except Exception as e:
+        # Whatever goes wrong with one file, the other files should still be zipped
+        log.exception(f"Exception while adding {iiif_url} to the zip: ({e}).")
+        return f"{iiif_url}: excluded, Error occurred while adding the file to the zip\n"
 
-    # Save image file to tmp folder
-    zip_tools.save_file_to_folder(tmp_folder_path, filename, file_response.content)
-    info_txt_contents += "included\n"
 
-    return info_txt_contents
+def download_files_for_zip(files, zip_writer):
+    """
+    Add the files to a zip as soon as they are downloaded. At most ZIP_DOWNLOAD_MAX_WORKERS files are downloaded at
+    once.
+
+    :param files: List of (iiif_url, url_info, fail_reason, metadata) tuples
+    :param zip_writer: The ZipStreamWriter of the zip
+    :return: The lines for the report.txt, in the same order as the files
+    """
+    with ThreadPoolExecutor(max_workers=settings.ZIP_DOWNLOAD_MAX_WORKERS) as executor:
+        futures = [executor.submit(_get_file_for_zip_or_error, *file, zip_writer) for file in files]
+    return [future.result() for future in futures]
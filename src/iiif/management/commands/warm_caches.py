@@ -0,0 +1,112 @@
+import contextlib
+import itertools
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from iiif.warm_up import WarmUpResult, get_dossiers_from_access_log, warm_up_dossier
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Warm the metadata, dimensions and thumbnail caches for dossiers, given as arguments or taken from the most "
+        "requested dossiers in access logs. Meant to run after a deploy, with a cache which is shared with the web "
+        "server (see CACHE_BACKEND)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("dossiers", nargs="*", help="Dossier identifiers, like edepot:ST_00015")
+        parser.add_argument(
+            "--access-log",
+            action="append",
+            default=[],
+            help="Access log to take the most requested dossiers from, - for stdin. Can be given more than once.",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=100, help="The number of dossiers to take from the access logs"
+        )
+        parser.add_argument("--concurrency", type=int, default=4, help="The number of dossiers warmed at once")
+        parser.add_argument(
+            "--thumbnail-size",
+            type=int,
+            action="append",
+            dest="thumbnail_sizes",
+            help=f"Size of the thumbnails to create, can be given more than once (default {settings.SPRITE_TILE_SIZE})",
+        )
+        parser.add_argument(
+            "--no-thumbnails",
+            action="store_true",
+            help="Only warm the metadata and dimensions",
+        )
+
+    def handle(self, *args, **options):
+        if isinstance(caches["default"], (LocMemCache, DummyCache)):
+            # The caches of the web server wouldn't be warmed, only the cache of this process
+            raise CommandError(
+                f"The cache backend {settings.CACHE_BACKEND} isn't shared with the web server, configure a shared "
+                "cache with CACHE_BACKEND and CACHE_LOCATION"
+            )
+
+        dossiers = list(dict.fromkeys(options["dossiers"] + self.read_access_logs(options)))
+        if not dossiers:
+            raise CommandError("Give dossier identifiers or an access log")
+
+        if options["no_thumbnails"]:
+            thumbnail_sizes = []
+        else:
+            thumbnail_sizes = options["thumbnail_sizes"] or [settings.SPRITE_TILE_SIZE]
+
+        self.stdout.write(f"Warming the caches for {len(dossiers)} dossiers")
+        start = time.monotonic()
+        files = errors = failed_dossiers = 0
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            futures = [executor.submit(self.warm_up_dossier, dossier, thumbnail_sizes) for dossier in dossiers]
+            for done, future in enumerate(as_completed(futures), start=1):
+                result, duration = future.result()
+                progress = f"[{done}/{len(dossiers)}] {result.dossier_identifier}"
+                if result.error:
+                    failed_dossiers += 1
+                    self.stdout.write(self.style.WARNING(f"{progress}: failed, {result.error}"))
+                    continue
+                files += result.files
+                errors += result.errors
+                self.stdout.write(f"{progress}: {result.files} files, {result.errors} errors ({duration:.1f}s)")
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Warmed {len(dossiers) - failed_dossiers} dossiers with {files} files in "
+                f"{time.monotonic() - start:.1f}s ({failed_dossiers} dossiers and {errors} files failed)"
+            )
+        )
+
+    def read_access_logs(self, options):
+        if not options["access_log"]:
+            return []
+        with contextlib.ExitStack() as stack:
+            try:
+                access_logs = [
+                    sys.stdin if path == "-" else stack.enter_context(open(path, errors="replace"))
+                    for path in options["access_log"]
+                ]
+            except OSError as e:
+                raise CommandError(f"Could not read access log: {e}") from e
+            return get_dossiers_from_access_log(itertools.chain(*access_logs), options["limit"])
+
+    def warm_up_dossier(self, dossier, thumbnail_sizes):
+        start = time.monotonic()
+        try:
+            result = warm_up_dossier(dossier, thumbnail_sizes)
+        except Exception as e:
+            # One failing dossier shouldn't stop the others from being warmed
+            logger.exception(f"Warming the caches for {dossier} failed")
+            result = WarmUpResult(dossier, 0, 0, f"{e.__class__.__name__}: {e}")
+        return result, time.monotonic() - start
@@ -0,0 +1,85 @@
+from iiif import parsing
+from iiif.dimensions import get_cached_dimensions
+
+PRESENTATION_CONTEXT = "http://iiif.io/api/presentation/2/context.json"
+IMAGE_CONTEXT = "http://iiif.io/api/image/2/context.json"
+IMAGE_PROFILE = "http://iiif.io/api/image/2/level2.json"
+
+
+def get_file_url_info(dossier_info, document_barcode, filenr):
+    return {
+        **dossier_info,
+        "document_barcode": document_barcode,
+        "filenr": str(filenr),
+        "page": None,
+    }
+
+
+def create_canvas(image_base_url, label, dimensions):
+    """
+    Create a canvas showing a single file. The width and height are only added if the dimensions of the file
+    are known, because retrieving every file of a dossier just for its dimensions is too expensive.
+    """
+    canvas_id = f"{image_base_url}/canvas"
+    image_format = dimensions["format"] if dimensions else "jpg"
+    resource = {
+        "@id": f"{image_base_url}/full/full/0/default.{image_format}",
+        "@type": "dctypes:Image",
+        "format": f"image/{image_format.replace('jpg', 'jpeg')}",
+        "service": {
+            "@context": IMAGE_CONTEXT,
+            "@id": image_base_url,
+            "profile": IMAGE_PROFILE,
+        },
+    }
+    canvas = {
+        "@id": canvas_id,
+        "@type": "sc:Canvas",
+        "label": label,
+        "images": [
+            {
+                "@type": "oa:Annotation",
+                "motivation": "sc:painting",
+                "on": canvas_id,
+                "resource": resource,
+            }
+        ],
+    }
+    if dimensions:
+        for item in (canvas, resource):
+            item["width"] = dimensions["width"]
+            item["height"] = dimensions["height"]
+    return canvas
+
+
+def create_manifest(manifest_url, iiif_base_url, dossier_identifier, dossier_info, documents):
+    """
+    Create a IIIF Presentation (2.1) manifest for a dossier
+
+    :param manifest_url: The absolute url of the manifest itself
+    :param iiif_base_url: The absolute url under which the iiif urls of the files are served
+    :param dossier_identifier: The dossier identifier, like "edepot:ST_00015"
+    :param dossier_info: The dossier info as returned by parsing.get_dossier_info
+    :param documents: List of (document, [filenr, ...]) tuples with the files to show
+    :return: The manifest as a dict
+    """
+    canvases = []
+    for document, filenrs in documents:
+        for filenr in filenrs:
+            url_info = get_file_url_info(dossier_info, document["barcode"], filenr)
+            iiif_url = parsing.create_iiif_url(dossier_info, document["barcode"], filenr)
+            label = f"{document.get('subdossier_titel') or document['barcode']} ({filenr + 1})"
+            canvases.append(create_canvas(f"{iiif_base_url}{iiif_url}", label, get_cached_dimensions(url_info)))
+
+    return {
+        "@context": PRESENTATION_CONTEXT,
+        "@id": manifest_url,
+        "@type": "sc:Manifest",
+        "label": dossier_identifier,
+        "sequences": [
+            {
+                "@type": "sc:Sequence",
+                "canvases": canvases,
+            }
+        ],
+    }
@@ -1,16 +1,32 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from uuid import uuid4
 
+import httpx
 import requests
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from requests.exceptions import RequestException
 
+from iiif import async_client, parsing, upstream
 from main.utils import ImmediateHttpResponse
 
 log = logging.getLogger(__name__)
 
 RESPONSE_CONTENT_ERROR_RESPONSE_FROM_METADATA_SERVER = "The iiif-metadata-server cannot be reached"
 
+# Refreshes the metadata of dossiers in the background, while the stale metadata is still used
+metadata_refresh_executor = ThreadPoolExecutor(max_workers=settings.METADATA_REFRESH_MAX_WORKERS)
+
+
+class MetadataServerError(ImmediateHttpResponse):
+    """
+    The metadata server couldn't be reached or responded with a server error
+    """
+
 
 def get_metadata_url(url_info):
     # Test with:
@@ -20,8 +36,117 @@ def get_metadata_url(url_info):
     )
 
 
-def do_metadata_request(metadata_url):
-    return requests.get(metadata_url, timeout=(15, 25))
+METADATA_REQUEST_TIMEOUT = (15, 25)
+
+
+def get_metadata_request_timeout(deadline):
+    if deadline is None:
+        return METADATA_REQUEST_TIMEOUT
+    return deadline.timeout(*METADATA_REQUEST_TIMEOUT, "getting the metadata")
+
+
+def do_metadata_request(metadata_url, timeout=METADATA_REQUEST_TIMEOUT):
+    return requests.get(metadata_url, timeout=timeout)
+
+
+class MetadataEntry(NamedTuple):
+    metadata: dict
+    version: str
+
+
+class CachedMetadataEntry(NamedTuple):
+    entry: MetadataEntry
+    retrieved_at: float
+
+    @property
+    def age(self):
+        return time.time() - self.retrieved_at
+
+    @property
+    def is_expired(self):
+        return self.age >= settings.METADATA_CACHE_TIMEOUT
+
+    @property
+    def needs_refresh(self):
+        return self.age >= settings.METADATA_CACHE_TIMEOUT - settings.METADATA_STALE_WHILE_REVALIDATE
+
+
+def get_metadata_cache_key(url_info):
+    return f"iiif-metadata:{url_info['stadsdeel']}_{url_info['dossier']}"
+
+
+def create_cached_metadata_entry(metadata):
+    return CachedMetadataEntry(MetadataEntry(metadata, uuid4().hex), time.time())
+
+
+def get_metadata_cache_timeout():
+    # The entry is kept after it has expired, so it can still be used when the metadata server fails
+    return settings.METADATA_CACHE_TIMEOUT + settings.METADATA_STALE_IF_ERROR
+
+
+def store_metadata_entry(cache_key, metadata):
+    cached = create_cached_metadata_entry(metadata)
+    cache.set(cache_key, cached, get_metadata_cache_timeout())
+    return cached.entry
+
+
+def is_metadata_server_failure(e):
+    # An unavailable (or overloaded) metadata server, as opposed to a dossier which doesn't exist
+    return isinstance(e, MetadataServerError) or e.response.status_code >= 500
+
+
+def use_stale_metadata_entry(cached, e):
+    if cached is None or not is_metadata_server_failure(e):
+        raise e
+    log.warning(f"Using metadata of {cached.age:.0f} seconds old, because the metadata server failed")
+    return cached.entry
+
+
+def refresh_metadata_entry(url_info, iiif_url, cache_key):
+    try:
+        store_metadata_entry(cache_key, request_metadata(url_info, iiif_url))
+    except ImmediateHttpResponse as e:
+        log.warning(f"Refreshing the metadata for {iiif_url} failed with status {e.response.status_code}")
+    except Exception:
+        log.exception(f"Refreshing the metadata for {iiif_url} failed")
+    finally:
+        cache.delete(f"{cache_key}:refreshing")
+
+
+def schedule_metadata_refresh(url_info, iiif_url, cache_key):
+    # Only one refresh of the metadata of a dossier runs at a time. The lock expires in case the refresh never ends.
+    if cache.add(f"{cache_key}:refreshing", True, timeout=sum(METADATA_REQUEST_TIMEOUT)):
+        metadata_refresh_executor.submit(refresh_metadata_entry, url_info, iiif_url, cache_key)
+
+
+async def schedule_metadata_refresh_async(url_info, iiif_url, cache_key):
+    # The async variant of schedule_metadata_refresh
+    if await cache.aadd(f"{cache_key}:refreshing", True, timeout=sum(METADATA_REQUEST_TIMEOUT)):
+        metadata_refresh_executor.submit(refresh_metadata_entry, url_info, iiif_url, cache_key)
+
+
+def get_metadata_entry(url_info, iiif_url, deadline=None):
+    """
+    Get the metadata of a dossier, together with a version which changes every time the metadata is retrieved from
+    the metadata server. Anything derived from the metadata can be cached using this version, so that it never
+    outlives the metadata itself.
+
+    The metadata is shared between requests. The cache timeout is the maximum time it takes for changes in the
+    metadata (like access restrictions) to be picked up. Near the end of that time the metadata is refreshed in the
+    background, so requests don't have to wait for it. Only when the metadata server fails, metadata which has expired
+    (at most METADATA_STALE_IF_ERROR seconds ago) is used instead of returning an error.
+    """
+    cache_key = get_metadata_cache_key(url_info)
+    cached = cache.get(cache_key)
+    if cached is not None and not cached.is_expired:
+        if cached.needs_refresh:
+            schedule_metadata_refresh(url_info, iiif_url, cache_key)
+        return cached.entry
+
+    try:
+        return store_metadata_entry(cache_key, request_metadata(url_info, iiif_url, deadline))
+    except ImmediateHttpResponse as e:
+        return use_stale_metadata_entry(cached, e)
 
 
 def get_metadata(url_info, iiif_url, metadata_cache):
@@ -31,16 +156,37 @@ def get_metadata(url_info, iiif_url, metadata_cache):
     if metadata:
         return metadata, metadata_cache
 
+    metadata = get_metadata_entry(url_info, iiif_url).metadata
+
+    # Store the metadata in the cache so that it can be used while getting many
+    # files for a zip
+    metadata_cache[cache_key] = metadata
+
+    return metadata, metadata_cache
+
+
+def request_metadata(url_info, iiif_url, deadline=None):
     # Get the image metadata from the metadata server
     try:
         metadata_url = get_metadata_url(url_info)
-        meta_response = do_metadata_request(metadata_url)
+        timeout = get_metadata_request_timeout(deadline)
+        with upstream.guard("metadata", deadline) as call:
+            meta_response = do_metadata_request(metadata_url, timeout)
+            call.failed = meta_response.status_code >= 500
     except RequestException as e:
-        log.error(f"{RESPONSE_CONTENT_ERROR_RESPONSE_FROM_METADATA_SERVER} because of this error {e}")
-        raise ImmediateHttpResponse(
-            response=HttpResponse(RESPONSE_CONTENT_ERROR_RESPONSE_FROM_METADATA_SERVER, status=502)
-        ) from e
+        raise create_metadata_server_error(e, deadline) from e
+
+    return handle_metadata_response(meta_response, iiif_url, metadata_url)
 
+
+def create_metadata_server_error(e, deadline=None):
+    if deadline and deadline.expired:
+        return deadline.exceeded("getting the metadata")
+    log.error(f"{RESPONSE_CONTENT_ERROR_RESPONSE_FROM_METADATA_SERVER} because of this error {e}")
+    return MetadataServerError(response=HttpResponse(RESPONSE_CONTENT_ERROR_RESPONSE_FROM_METADATA_SERVER, status=502))
+
+
+def handle_metadata_response(meta_response, iiif_url, metadata_url):
     if meta_response.status_code == 404:
         raise ImmediateHttpResponse(response=HttpResponse("No metadata could be found for this dossier", status=404))
     if meta_response.status_code != 200:
@@ -49,16 +195,62 @@ def get_metadata(url_info, iiif_url, metadata_cache):
             f"the metadata for {iiif_url} from the stadsarchief metadata server "
             f"on url {metadata_url}."
         )
-        raise ImmediateHttpResponse(
+        error_class = MetadataServerError if meta_response.status_code >= 500 else ImmediateHttpResponse
+        raise error_class(
             response=HttpResponse(
                 f"We had a problem retrieving the metadata. We got status code {meta_response.status_code}",
                 status=400,
             )
         )
-    metadata = meta_response.json()
+    return meta_response.json()
 
-    # Store the metadata in the cache so that it can be used while getting many
-    # files for a zip
-    metadata_cache[cache_key] = metadata
 
-    return metadata, metadata_cache
+async def do_metadata_request_async(metadata_url, timeout=METADATA_REQUEST_TIMEOUT):
+    connect_timeout, read_timeout = timeout
+    return await async_client.get_async_client().get(
+        metadata_url, timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+    )
+
+
+async def request_metadata_async(url_info, iiif_url, deadline=None):
+    # The async variant of request_metadata
+    try:
+        metadata_url = get_metadata_url(url_info)
+        timeout = get_metadata_request_timeout(deadline)
+        async with upstream.guard_async("metadata", deadline) as call:
+            meta_response = await do_metadata_request_async(metadata_url, timeout)
+            call.failed = meta_response.status_code >= 500
+    except httpx.HTTPError as e:
+        raise create_metadata_server_error(e, deadline) from e
+
+    return handle_metadata_response(meta_response, iiif_url, metadata_url)
+
+
+async def get_metadata_entry_async(url_info, iiif_url, deadline=None):
+    # The async variant of get_metadata_entry
+    cache_key = get_metadata_cache_key(url_info)
+    cached = await cache.aget(cache_key)
+    if cached is not None and not cached.is_expired:
+        if cached.needs_refresh:
+            await schedule_metadata_refresh_async(url_info, iiif_url, cache_key)
+        return cached.entry
+
+    try:
+        metadata = await request_metadata_async(url_info, iiif_url, deadline)
+    except ImmediateHttpResponse as e:
+        return use_stale_metadata_entry(cached, e)
+
+    cached = create_cached_metadata_entry(metadata)
+    await cache.aset(cache_key, cached, get_metadata_cache_timeout())
+    return cached.entry
+
+
+def get_iiif_urls_from_metadata(metadata, dossier_info):
+    """
+    Create the iiif urls of all files of all documents in the metadata of a dossier
+    """
+    return [
+        parsing.create_iiif_url(dossier_info, document["barcode"], filenr)
+        for document in metadata["documenten"]
+        for filenr, _ in enumerate(document.get("bestanden", []))
+    ]
@@ -2,6 +2,8 @@ import json
 import logging
 import re
 import urllib
+from functools import lru_cache
+from typing import NamedTuple
 
 from django.conf import settings
 from django.http import HttpResponse
@@ -11,12 +13,41 @@ from main.utils import ImmediateHttpResponse
 log = logging.getLogger(__name__)
 
 
+# Separates the file number from the (optional) page number in the identifier, e.g. ST_00015~ST00000126_0@2
+PAGE_SEPARATOR = "@"
+IIIF_API_VERSION = "2"
+IIIF_SOURCES = ("edepot", "wabo")
+
+
 class InvalidIIIFUrlError(Exception):
     pass
 
 
-def get_info_from_iiif_url(iiif_url, source_file):
+class IIIFRequest(NamedTuple):
+    source: str
+    formatting: str | None
+    region: str | None
+    scaling: str | None
+    info_json: bool  # Whether the info.json is requested instead of the image itself
+    stadsdeel: str
+    dossier: str
+    document_barcode: str
+    filenr: str
+    page: int | None
+
+
+# The identifier of a file, e.g. ST_00015~ST00000126_1@2 (stadsdeel_dossier~document_barcode_filenr@page)
+IDENTIFIER_PATTERN = re.compile(
+    r"(?P<stadsdeel>[^_~]*)_(?P<dossier>[^_~]*)~(?P<document_barcode>[^_~]*)_(?P<filenr>[^_~@]*)(?:@(?P<page>[^_~]*))?"
+)
+
+
+@lru_cache(maxsize=settings.IIIF_URL_PARSER_CACHE_SIZE)
+def parse_iiif_url(iiif_url, source_file):
     """
+    Parse a iiif url into an (immutable) IIIFRequest. The results are cached, because the same urls are requested
+    over and over again by viewers.
+
     # PRE-WABO
 
     "https://acc.bouwdossiers.amsterdam.nl/iiif/2/edepot:ST_00015~ST00000126_1.jpg/info.json"
@@ -38,52 +69,100 @@ def get_info_from_iiif_url(iiif_url, source_file):
     "https://acc.bouwdossiers.amsterdam.nl/iiif/2/wabo:SDZ_TA-38657~628547_1/full/full/0/default.jpg""
     - SDZ=stadsdeel TA-38657=dossier 628547=document_barcode 1=file/bestand
 
+    # PAGES
+
+    "https://acc.bouwdossiers.amsterdam.nl/iiif/2/edepot:ST_00015~ST00000126_1@2/full/1000,900/0/default.jpg"
+
+    For multi-page files (e.g. TIFF) a zero-based page number can be appended to the file number using an @.
+    Without it, the first page is used.
+
     # TODO: rewrite, don't think this still works.
     At the end of the url, this can be appended '?source_file=true', which means we'll bypass
     all image related code and go directly for the source file. This can be needed when the file is
     not an image, but for example a txt, xls, zip or something else.
     """  # noqa: E501
 
+    head, separator, tail = iiif_url.partition(":")
+    head_parts = head.split("/", 2)
+    if not separator or len(head_parts) < 2:
+        raise InvalidIIIFUrlError(f"No source found in iiif url: {iiif_url}")
+
+    # Anything after a second colon is ignored
+    identifier, has_formatting, formatting = tail.partition(":")[0].partition("/")
+    formatting = formatting.partition("?")[0] if has_formatting else ""
+
+    info_json = False
+    region = None
+    scaling = None
+    if formatting == "info.json":
+        info_json = True
+        formatting = None
+    elif "/" in formatting:
+        region, scaling = formatting.split("/", 2)[:2]
+    elif not source_file:
+        raise InvalidIIIFUrlError(f"No formatting or info.json provided in iiif url: {iiif_url}")
+
+    match = IDENTIFIER_PATTERN.fullmatch(identifier.replace(" ", "%20"))
+    if match is None:
+        raise InvalidIIIFUrlError(f"Invalid file identifier in iiif url: {iiif_url}")
+
+    page = match["page"]
     try:
-        source = iiif_url.split(":")[0].split("/")[1]  # "edepot" or "wabo"
-        relevant_url_part = iiif_url.split(":")[1].split("/")[0].replace(" ", "%20")
-        formatting = iiif_url.split(":")[1].split("/", 1)[1].split("?")[0] if "/" in iiif_url.split(":")[1] else ""
-
-        info_json = False
-        scaling = None
-        region = None
-        if formatting == "info.json":
-            info_json = True
-            formatting = None
-        elif "/" in formatting:
-            region = formatting.split("/")[0]
-            scaling = formatting.split("/")[1]
-        elif source_file:
-            pass
-        else:
-            raise InvalidIIIFUrlError(f"No formatting or info.json provided in iiif url: {iiif_url}")
-
-        url_info = {
-            "source": source,
-            "formatting": formatting,
-            "region": region,
-            "scaling": scaling,
-            "info_json": info_json,  # Whether the info.json is requested instead of the image itself
-        }
-        stadsdeel_dossier, olo_and_document = relevant_url_part.split("~")
-        stadsdeel, dossier = stadsdeel_dossier.split("_")
-        document_barcode, filenr = olo_and_document.split("_")
-        return {
-            **url_info,
-            "stadsdeel": stadsdeel,
-            "dossier": dossier,
-            "document_barcode": document_barcode,
-            "filenr": filenr,
-        }
-
-    except Exception as e:
+        page = int(page) if page else None
+    except ValueError as e:
+        raise InvalidIIIFUrlError(f"Invalid page in iiif url: {iiif_url}") from e
+
+    return IIIFRequest(
+        head_parts[1],
+        formatting,
+        region,
+        scaling,
+        info_json,
+        match["stadsdeel"],
+        match["dossier"],
+        match["document_barcode"],
+        match["filenr"],
+        page,
+    )
+
+
+def get_info_from_iiif_url(iiif_url, source_file):
+    """
+    Get the information from a iiif url as a dict (see parse_iiif_url). Every call returns a new dict built from the
+    cached IIIFRequest, so callers can't change the cached result.
+    """
+    try:
+        return parse_iiif_url(iiif_url, source_file)._asdict()
+    except InvalidIIIFUrlError as e:
         log.error(f"Invalid iiif url: {iiif_url} ({e})")
-        raise InvalidIIIFUrlError(f"Invalid iiif url: {iiif_url}") from e
+        raise
+
+
+def get_dossier_info(dossier_identifier):
+    """
+    Parse a dossier identifier like "edepot:ST_00015" or "wabo:SDZ_TA-38657" into its source, stadsdeel and dossier
+    """
+    try:
+        source, stadsdeel_dossier = dossier_identifier.split(":")
+        stadsdeel, dossier = stadsdeel_dossier.split("_")
+    except (AttributeError, ValueError) as e:
+        raise ImmediateHttpResponse(response=HttpResponse("Invalid formatted dossier", status=400)) from e
+
+    if source not in IIIF_SOURCES or not stadsdeel or not dossier:
+        raise ImmediateHttpResponse(response=HttpResponse("Invalid formatted dossier", status=400))
+
+    return {"source": source, "stadsdeel": stadsdeel, "dossier": dossier}
+
+
+def create_iiif_url(dossier_info, document_barcode, filenr, page=None):
+    # The inverse of get_info_from_iiif_url, without any formatting
+    iiif_url = (
+        f"{IIIF_API_VERSION}/{dossier_info['source']}:{dossier_info['stadsdeel']}_{dossier_info['dossier']}"
+        f"~{document_barcode}_{filenr}"
+    )
+    if page is not None:
+        iiif_url += f"{PAGE_SEPARATOR}{page}"
+    return iiif_url
 
 
 def get_email_address(request, jwt_token):
@@ -140,6 +219,39 @@ def check_zip_payload(payload):
         raise ImmediateHttpResponse(response=HttpResponse("No urls detected in json", status=400))
 
 
+def check_batch_payload(payload, max_files):
+    if not payload.get("dossier") and not payload.get("urls"):
+        raise ImmediateHttpResponse(response=HttpResponse("No dossier or urls detected in json", status=400))
+
+    if len(payload.get("urls") or []) > max_files:
+        raise ImmediateHttpResponse(response=HttpResponse(f"No more than {max_files} urls allowed", status=400))
+
+
+def check_batch_size(iiif_urls, max_files):
+    # A dossier is only expanded to its files after check_batch_payload, and can have any number of files
+    if len(iiif_urls) > max_files:
+        raise ImmediateHttpResponse(
+            response=HttpResponse(
+                f"No more than {max_files} files allowed, the request is for {len(iiif_urls)} files", status=400
+            )
+        )
+
+
+def parse_sprite_tile_size(size):
+    try:
+        tile_size = int(size) if size else settings.SPRITE_TILE_SIZE
+    except (TypeError, ValueError) as e:
+        raise ImmediateHttpResponse(response=HttpResponse("Invalid sprite tile size", status=400)) from e
+
+    if not 0 < tile_size <= settings.SPRITE_MAX_TILE_SIZE:
+        raise ImmediateHttpResponse(
+            response=HttpResponse(
+                f"The sprite tile size should be between 1 and {settings.SPRITE_MAX_TILE_SIZE}", status=400
+            )
+        )
+    return tile_size
+
+
 def strip_full_iiif_url(url):
     if "/iiif/" not in url:
         raise ImmediateHttpResponse(response=HttpResponse("Misformed paths", status=400))
@@ -0,0 +1,113 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from PIL import Image
+
+from iiif import image_server
+from iiif.dimensions import get_file_dimensions
+from iiif.image_handling import is_image_content_type, select_page
+from iiif.image_server import create_non_image_file_thumbnail
+from main.utils import ImmediateHttpResponse
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CONTENT_RENDITION_FAILED = "The thumbnail of the file could not be created"
+
+
+def get_rendition_cache_key(url_info, size):
+    return (
+        f"iiif-rendition:{url_info['source']}:{url_info['stadsdeel']}_{url_info['dossier']}"
+        f"~{url_info['document_barcode']}_{url_info['filenr']}@{url_info.get('page') or 0}:{size}"
+    )
+
+
+def get_cached_rendition(url_info, size):
+    return cache.get(get_rendition_cache_key(url_info, size))
+
+
+def store_rendition(url_info, size, content):
+    # Big renditions would push many other entries out of the cache, so those are simply not cached
+    if len(content) > settings.RENDITION_CACHE_MAX_BYTES:
+        return
+    cache.set(get_rendition_cache_key(url_info, size), content, settings.RENDITION_CACHE_TIMEOUT)
+
+
+def create_thumbnail(file_content, file_type, page, size):
+    """
+    Create a jpeg thumbnail which fits in a square of size x size pixels. Files which are not an image get the
+    default thumbnail.
+    """
+    if not is_image_content_type(file_type):
+        file_content = create_non_image_file_thumbnail(file_format="jpeg")
+        page = None
+
+    # Start from the smallest reduced-resolution level of the page which is still big enough
+    img = Image.open(BytesIO(select_page(page, "full", f"{size},{size}", file_content)))
+    img.thumbnail((size, size), Image.LANCZOS)
+
+    image_stream = BytesIO()
+    img.convert("RGB").save(image_stream, format="jpeg")
+    return image_stream.getvalue()
+
+
+def get_rendition(url_info, metadata, size):
+    """
+    Get a thumbnail of a file from the rendition cache, or create it from the file on the source server.
+    Access to the file should be checked before calling this.
+    """
+    rendition = get_cached_rendition(url_info, size)
+    if rendition:
+        return rendition
+
+    file_response, file_url = image_server.get_file(url_info, metadata)
+    image_server.handle_file_response_codes(file_response, file_url)
+    file_type = file_response.headers.get("Content-Type")
+
+    rendition = create_thumbnail(file_response.content, file_type, url_info.get("page"), size)
+    store_rendition(url_info, size, rendition)
+    # The file is retrieved anyway, so the dimensions for the info.json come for free
+    get_file_dimensions(url_info, file_response.content, file_type)
+    return rendition
+
+
+def _get_rendition_or_error(url_info, metadata, size):
+    try:
+        return get_rendition(url_info, metadata, size)
+    except ImmediateHttpResponse as e:
+        return e.response
+    except Exception as e:
+        log.exception(f"Exception while creating the rendition of {url_info}: ({e})")
+        return HttpResponse(RESPONSE_CONTENT_RENDITION_FAILED, status=502)
+
+
+def get_renditions_concurrently(files, size):
+    """
+    Get the thumbnails of many files at once. Cached renditions are returned directly, the other files are
+    retrieved from the source servers in parallel.
+
+    :param files: Dict of iiif_url -> (url_info, metadata)
+    :param size: The maximum width and height of the thumbnails
+    :return: Dict of iiif_url -> jpeg data, or the HttpResponse describing why there is no thumbnail
+    """
+    results = {}
+    uncached_files = {}
+    for iiif_url, (url_info, metadata) in files.items():
+        rendition = get_cached_rendition(url_info, size)
+        if rendition:
+            results[iiif_url] = rendition
+        else:
+            uncached_files[iiif_url] = (url_info, metadata)
+
+    if uncached_files:
+        with ThreadPoolExecutor(max_workers=settings.RENDITION_MAX_WORKERS) as executor:
+            futures = {
+                iiif_url: executor.submit(_get_rendition_or_error, url_info, metadata, size)
+                for iiif_url, (url_info, metadata) in uncached_files.items()
+            }
+        results.update({iiif_url: future.result() for iiif_url, future in futures.items()})
+
+    return {iiif_url: results[iiif_url] for iiif_url in files}
@@ -0,0 +1,406 @@
+import asyncio
+import contextlib
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.http import HttpResponse
+from opentelemetry import metrics
+
+from main.utils import ImmediateHttpResponse
+
+log = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+RESPONSE_CONTENT_UPSTREAM_OVERLOADED = "Too many requests are waiting for the {upstream} server, please try again later"
+RESPONSE_CONTENT_UPSTREAM_UNAVAILABLE = "The {upstream} server is unavailable, please try again later"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class _Waiter:
+    """
+    A request waiting for a free slot of a bulkhead. A released slot is handed over directly to the first waiter,
+    so that a waiter can't be overtaken by new requests.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._set_result)
+
+    def _set_result(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Bulkhead:
+    """
+    Limits the number of concurrent requests to an upstream server. Requests above the limit wait in a bounded
+    queue for at most max_wait seconds. When the queue is full, or the wait takes too long, the request is rejected
+    with a 503 so that it doesn't occupy a worker thread while the upstream server is slow.
+
+    The same bulkhead is used by threads (sync views) and tasks (async views) in a process.
+    """
+
+    def __init__(self, name, max_concurrent, max_waiting, max_wait):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _try_acquire(self, waiter):
+        """
+        Take a slot if there is one free, otherwise queue the waiter. Returns whether a slot was taken.
+        """
+        with self._lock:
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                return True
+            if len(self._waiters) >= self.max_waiting:
+                raise self._rejection("queue_full")
+            self._waiters.append(waiter)
+            return False
+
+    def try_acquire(self):
+        """
+        Take a slot if there is one free, without waiting for one. Returns whether a slot was taken, which should be
+        given back with release.
+        """
+        with self._lock:
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                return True
+            return False
+
+    def _give_up(self, waiter):
+        """
+        Stop waiting after a timeout. If the slot was handed over in the meantime it's kept, and True is returned.
+        """
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                raise self._rejection("timeout")
+        return True
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # Hand the slot over to the first waiter, so the active count stays the same
+                self._waiters.popleft().wake()
+            else:
+                self.active -= 1
+
+    def _rejection(self, reason):
+        upstream_rejections.add(1, {"upstream": self.name, "reason": reason})
+        log.warning(
+            f"Rejected a request to the {self.name} server ({reason}): {self.active} active, {self.waiting} waiting"
+        )
+        response = HttpResponse(RESPONSE_CONTENT_UPSTREAM_OVERLOADED.format(upstream=self.name), status=503)
+        response["Retry-After"] = str(settings.UPSTREAM_RETRY_AFTER)
+        return ImmediateHttpResponse(response=response)
+
+    def _get_max_wait(self, deadline):
+        # Don't wait for a slot longer than the request may take
+        return self.max_wait if deadline is None else min(self.max_wait, deadline.remaining())
+
+    @contextlib.contextmanager
+    def acquire(self, deadline=None):
+        start = time.monotonic()
+        waiter = _Waiter()
+        if not self._try_acquire(waiter) and not waiter.event.wait(self._get_max_wait(deadline)):
+            self._give_up(waiter)
+        upstream_wait_time.record(time.monotonic() - start, {"upstream": self.name})
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def acquire_async(self, deadline=None):
+        start = time.monotonic()
+        waiter = _Waiter(asyncio.get_running_loop())
+        if not self._try_acquire(waiter):
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self._get_max_wait(deadline))
+            except TimeoutError:
+                self._give_up(waiter)
+            except asyncio.CancelledError:
+                # Don't keep a slot which was handed over just before the request was cancelled
+                with contextlib.suppress(ImmediateHttpResponse):
+                    if self._give_up(waiter):
+                        self.release()
+                raise
+        upstream_wait_time.record(time.monotonic() - start, {"upstream": self.name})
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class _Call:
+    """
+    A single request guarded by a circuit breaker. The caller marks it as failed when the upstream server
+    responds with a server error; exceptions are counted as failures automatically. When the response is streamed,
+    the caller marks when the response headers arrived, so the download of a big file isn't seen as a slow call.
+    """
+
+    def __init__(self):
+        self.started_at = None
+        self.responded_at = None
+        self.failed = False
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.responded_at = None
+
+    def responded(self):
+        self.responded_at = time.monotonic()
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an upstream server which is down or very slow.
+
+    The outcome of the last window_size requests is kept. When at least min_calls of them are known and the
+    share of failed or slow requests gets too high, the circuit opens and all requests fail immediately with a 503.
+    After open_duration seconds the circuit is half open: half_open_calls trial requests are let through. If those
+    all succeed the circuit closes again, otherwise it opens for another open_duration.
+    """
+
+    def __init__(
+        self,
+        name,
+        window_size,
+        min_calls,
+        failure_rate,
+        slow_call_duration,
+        slow_call_rate,
+        open_duration,
+        half_open_calls,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self._outcomes = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+        self._set_state(CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        self.opened_at = time.monotonic() if state == OPEN else None
+        self._outcomes.clear()
+        self._trial_calls = 0
+        self._trial_successes = 0
+
+    def _transition(self, state):
+        log.warning(f"Circuit breaker for the {self.name} server changed from {self.state} to {state}")
+        circuit_transitions.add(1, {"upstream": self.name, "state": state})
+        self._set_state(state)
+
+    def reset(self):
+        with self._lock:
+            self._set_state(CLOSED)
+
+    def _admit(self):
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_duration:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and self._trial_calls < self.half_open_calls:
+                self._trial_calls += 1
+                return True
+            raise self._rejection()
+
+    def _record(self, is_trial_call, failed, duration):
+        slow = duration >= self.slow_call_duration
+        with self._lock:
+            if is_trial_call:
+                if self.state != HALF_OPEN:
+                    return
+                if failed or slow:
+                    self._transition(OPEN)
+                    return
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+                return
+
+            if self.state != CLOSED:
+                return
+            self._outcomes.append((failed, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(failed for failed, _ in self._outcomes)
+            slow_calls = sum(slow for _, slow in self._outcomes)
+            if failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate:
+                self._transition(OPEN)
+
+    def _finish(self, is_trial_call, call):
+        if call.started_at is not None:
+            ended_at = call.responded_at if call.responded_at is not None else time.monotonic()
+            self._record(is_trial_call, call.failed, ended_at - call.started_at)
+        elif is_trial_call:
+            # The trial request was never sent, so let another request try
+            with self._lock:
+                if self.state == HALF_OPEN:
+                    self._trial_calls -= 1
+
+    def _rejection(self):
+        circuit_rejections.add(1, {"upstream": self.name})
+        remaining = self.opened_at + self.open_duration - time.monotonic() if self.state == OPEN else 0
+        retry_after = max(1, math.ceil(remaining))
+        response = HttpResponse(RESPONSE_CONTENT_UPSTREAM_UNAVAILABLE.format(upstream=self.name), status=503)
+        response["Retry-After"] = str(retry_after)
+        return ImmediateHttpResponse(response=response)
+
+    @contextlib.contextmanager
+    def call(self):
+        """
+        Guard a request to the upstream server. Raises a 503 right away while the circuit is open. Only the part
+        after call.start() counts, so time spent waiting for a bulkhead isn't seen as a slow upstream server, and
+        until call.responded() when it's called.
+        """
+        is_trial_call = self._admit()
+        call = _Call()
+        try:
+            yield call
+        except Exception:
+            call.failed = True
+            raise
+        except BaseException:
+            # A cancelled request says nothing about the upstream server
+            call.started_at = None
+            raise
+        finally:
+            self._finish(is_trial_call, call)
+
+    def status(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failures": sum(failed for failed, _ in self._outcomes),
+                "slow_calls": sum(slow for _, slow in self._outcomes),
+            }
+
+
+bulkheads = {
+    name: Bulkhead(name, limits["max_concurrent"], limits["max_waiting"], limits["max_wait"])
+    for name, limits in settings.UPSTREAM_LIMITS.items()
+}
+
+
+def get_bulkhead(upstream):
+    return bulkheads[upstream]
+
+
+circuit_breakers = {name: CircuitBreaker(name, **settings_) for name, settings_ in settings.CIRCUIT_BREAKERS.items()}
+
+
+def get_circuit_breaker(upstream):
+    return circuit_breakers[upstream]
+
+
+@contextlib.contextmanager
+def guard(upstream, deadline=None):
+    """
+    Guard a request to an upstream server with its circuit breaker and bulkhead. The yielded call should be marked
+    as failed when the upstream server responds with a server error.
+    """
+    with get_circuit_breaker(upstream).call() as call, get_bulkhead(upstream).acquire(deadline):
+        call.start()
+        yield call
+
+
+@contextlib.asynccontextmanager
+async def guard_async(upstream, deadline=None):
+    # The async variant of guard
+    with get_circuit_breaker(upstream).call() as call:
+        async with get_bulkhead(upstream).acquire_async(deadline):
+            call.start()
+            yield call
+
+
+def _observe(attribute):
+    def callback(options):
+        return [
+            metrics.Observation(getattr(bulkhead, attribute), {"upstream": name})
+            for name, bulkhead in bulkheads.items()
+        ]
+
+    return callback
+
+
+def _observe_circuit_states(options):
+    return [
+        metrics.Observation(CIRCUIT_STATES[breaker.state], {"upstream": name})
+        for name, breaker in circuit_breakers.items()
+    ]
+
+
+upstream_rejections = meter.create_counter(
+    "iiif.upstream.rejections",
+    description="Requests rejected because too many requests were waiting for the upstream server",
+)
+upstream_wait_time = meter.create_histogram(
+    "iiif.upstream.wait_time",
+    unit="s",
+    description="Time spent waiting for a free slot for the upstream server",
+)
+meter.create_observable_gauge(
+    "iiif.upstream.active",
+    callbacks=[_observe("active")],
+    description="Requests in flight to the upstream server",
+)
+meter.create_observable_gauge(
+    "iiif.upstream.waiting",
+    callbacks=[_observe("waiting")],
+    description="Requests waiting for a free slot for the upstream server",
+)
+meter.create_observable_gauge(
+    "iiif.upstream.max_concurrent",
+    callbacks=[_observe("max_concurrent")],
+    description="Configured maximum number of requests in flight to the upstream server",
+)
+circuit_rejections = meter.create_counter(
+    "iiif.upstream.circuit.rejections",
+    description="Requests rejected because the circuit breaker of the upstream server is open",
+)
+circuit_transitions = meter.create_counter(
+    "iiif.upstream.circuit.transitions",
+    description="State changes of the circuit breaker of the upstream server",
+)
+meter.create_observable_gauge(
+    "iiif.upstream.circuit.state",
+    callbacks=[_observe_circuit_states],
+    description="State of the circuit breaker of the upstream server (0 closed, 1 half open, 2 open)",
+)
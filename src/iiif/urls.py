@@ -1,7 +1,15 @@
+from django.conf import settings
 from django.urls import path
 
 from iiif import views
 
 urlpatterns = [
-    path("<path:iiif_url>", views.index, name="iiif_endpoint"),
+    path("info/", views.batch_info_json, name="batch_info_json_endpoint"),
+    path("sprite/", views.sprite, name="sprite_endpoint"),
+    path("manifest/<str:dossier_identifier>", views.manifest, name="manifest_endpoint"),
+    path(
+        "<path:iiif_url>",
+        views.index_async if settings.ASYNC_IIIF_VIEW else views.index,
+        name="iiif_endpoint",
+    ),
 ]
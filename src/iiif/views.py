@@ -1,11 +1,19 @@
+import asyncio
+import base64
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
 from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, set_response_etag
 from django.views.decorators.cache import add_never_cache_headers, patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
 from django.views.decorators.vary import vary_on_headers
 from toolz import partial, pipe
 
+from core.auth.decisions import get_access_decision
 from core.auth.document_access import (
     check_file_access_in_metadata,
     is_caching_allowed,
@@ -16,19 +24,33 @@ from core.auth.permissions import (
     get_user_scope,
 )
 from iiif import image_server, parsing
+from iiif.deadline import create_request_deadline
+from iiif.dimensions import (
+    get_cached_dimensions,
+    get_cached_dimensions_async,
+    get_file_dimensions,
+    probe_dimensions_concurrently,
+)
 from iiif.image_handling import (
+    create_info_json,
+    create_sprite,
     crop_image,
-    generate_info_json,
     is_image_content_type,
     scale_image,
+    select_page,
 )
 from iiif.image_server import create_non_image_file_thumbnail
-from iiif.metadata import get_metadata
+from iiif.manifest import create_manifest
+from iiif.metadata import get_iiif_urls_from_metadata, get_metadata, get_metadata_entry, get_metadata_entry_async
+from iiif.renditions import get_renditions_concurrently
 from main import utils
 
 log = logging.getLogger(__name__)
 HOUR = 3600
 
+# Used by the async views for the image processing, which would otherwise block the event loop
+image_processing_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_PROCESSING_MAX_WORKERS)
+
 
 def add_caching_headers(is_cacheable, response):
     if is_cacheable:
@@ -38,64 +60,340 @@ def add_caching_headers(is_cacheable, response):
     return response
 
 
+def create_info_json_response(request, is_cacheable, dimensions):
+    info_json = create_info_json(request.build_absolute_uri().split("/info.json")[0], dimensions)
+    return add_caching_headers(is_cacheable, HttpResponse(json.dumps(info_json), content_type="application/json"))
+
+
+def create_error_info(response):
+    return {"status": response.status_code, "message": response.content.decode("utf-8")}
+
+
+def read_file_request(request, iiif_url):
+    check_auth_availability(request)
+    mail_jwt_token, is_mail_login = read_out_mail_jwt_token(request)
+    user_scope = get_user_scope(request, mail_jwt_token)
+
+    is_source_file_requested = utils.str_to_bool(request.GET.get("source_file"))
+    url_info = parsing.get_url_info(iiif_url, is_source_file_requested)
+
+    check_wabo_for_mail_login(is_mail_login, url_info)
+    return url_info, user_scope, is_mail_login, is_source_file_requested
+
+
+def create_file_response(request, url_info, is_source_file_requested, is_cacheable, file_content, file_type):
+    page = url_info["page"]
+
+    if is_source_file_requested:
+        return add_caching_headers(is_cacheable, HttpResponse(file_content, file_type))
+
+    if url_info["info_json"]:
+        dimensions = get_file_dimensions(url_info, file_content, file_type)
+        return create_info_json_response(request, is_cacheable, dimensions)
+
+    if not is_image_content_type(file_type):
+        # The requested file is NOT an image itself, but we can create a thumbnail for it so let's create it.
+        file_content = create_non_image_file_thumbnail(file_format="jpeg")
+        file_type = "image/jpeg"
+        page = None
+
+    select = partial(
+        select_page,
+        page,
+        url_info["region"],
+        url_info["scaling"],
+    )
+    crop = partial(
+        crop_image,
+        file_type,
+        url_info["region"],
+    )
+    scale = partial(
+        scale_image,
+        file_type,
+        url_info["scaling"],
+    )
+    edited_image = pipe(file_content, select, crop, scale)
+
+    return add_caching_headers(is_cacheable, HttpResponse(edited_image, file_type))
+
+
 @csrf_exempt
 @vary_on_headers("Authorization")
 def index(request, iiif_url):
+    deadline = create_request_deadline()
+    try:
+        url_info, user_scope, is_mail_login, is_source_file_requested = read_file_request(request, iiif_url)
+        metadata, metadata_version = get_metadata_entry(url_info, iiif_url, deadline)
+
+        access_decision = get_access_decision(metadata, metadata_version, url_info, user_scope, is_mail_login)
+        access_decision.raise_if_denied()
+        is_cacheable = access_decision.is_cacheable
+
+        if url_info["info_json"] and not is_source_file_requested:
+            # The dimensions are all we need for the info.json, so the file doesn't have to be retrieved again
+            dimensions = get_cached_dimensions(url_info)
+            if dimensions:
+                return create_info_json_response(request, is_cacheable, dimensions)
+
+        file_response, file_url = image_server.get_file(url_info, metadata, deadline)
+        image_server.handle_file_response_codes(file_response, file_url)
+
+        deadline.check("processing the image")
+        return create_file_response(
+            request,
+            url_info,
+            is_source_file_requested,
+            is_cacheable,
+            file_response.content,
+            file_response.headers.get("Content-Type"),
+        )
+    except utils.ImmediateHttpResponse as e:
+        try:
+            log.exception("ImmediateHttpResponse in index:")
+        except Exception:
+            print("Logging failed")
+        return e.response
+
+
+@csrf_exempt
+@vary_on_headers("Authorization")
+async def index_async(request, iiif_url):
+    """
+    The async variant of index, used when the app is served through ASGI. The metadata and the file are retrieved
+    without blocking a thread, and the image processing is done in a thread pool. The cache (which can be on
+    another server) is only used through its async methods. The remaining checks are cheap and don't do any I/O.
+    """
+    deadline = create_request_deadline()
+    try:
+        url_info, user_scope, is_mail_login, is_source_file_requested = read_file_request(request, iiif_url)
+        metadata, metadata_version = await get_metadata_entry_async(url_info, iiif_url, deadline)
+
+        # The access decisions are kept in memory
+        access_decision = get_access_decision(metadata, metadata_version, url_info, user_scope, is_mail_login)
+        access_decision.raise_if_denied()
+        is_cacheable = access_decision.is_cacheable
+
+        if url_info["info_json"] and not is_source_file_requested:
+            # The dimensions are all we need for the info.json, so the file doesn't have to be retrieved again
+            dimensions = await get_cached_dimensions_async(url_info)
+            if dimensions:
+                return create_info_json_response(request, is_cacheable, dimensions)
+
+        file_response, file_url = await image_server.get_file_async(url_info, metadata, deadline)
+        image_server.handle_file_response_codes(file_response, file_url)
+
+        deadline.check("processing the image")
+        return await asyncio.get_running_loop().run_in_executor(
+            image_processing_executor,
+            create_file_response,
+            request,
+            url_info,
+            is_source_file_requested,
+            is_cacheable,
+            file_response.content,
+            file_response.headers.get("Content-Type"),
+        )
+    except utils.ImmediateHttpResponse as e:
+        log.exception("ImmediateHttpResponse in index_async:")
+        return e.response
+
+
+def get_batch_payload(request, max_files):
+    """
+    Get the payload of a batch request. Either of all files in a dossier (GET ?dossier=edepot:ST_00015 or
+    POST {"dossier": "edepot:ST_00015"}) or of a list of iiif urls (POST {"urls": [...]}).
+    """
+    payload = parsing.parse_payload(request) if request.method == "POST" else request.GET.dict()
+    parsing.check_batch_payload(payload, max_files)
+    return payload
+
+
+def get_batch_iiif_urls(payload, is_mail_login, max_files):
+    """
+    Get the iiif urls of the files in a batch request, of which there may be at most max_files
+    """
+    metadata_cache = {}
+    if payload.get("dossier"):
+        dossier_info = parsing.get_dossier_info(payload["dossier"])
+        check_wabo_for_mail_login(is_mail_login, dossier_info)
+        metadata, metadata_cache = get_metadata(dossier_info, payload["dossier"], metadata_cache)
+        iiif_urls = get_iiif_urls_from_metadata(metadata, dossier_info)
+    else:
+        iiif_urls = [parsing.strip_full_iiif_url(url) if "/iiif/" in url else url for url in payload["urls"]]
+    parsing.check_batch_size(iiif_urls, max_files)
+    return iiif_urls, metadata_cache
+
+
+def check_batch_access(iiif_urls, user_scope, is_mail_login, metadata_cache):
+    """
+    Check the access to every file in a batch. The metadata is retrieved once per dossier.
+
+    :return: Tuple with the normalised iiif urls in the original order, a dict of iiif_url -> (url_info, metadata)
+        of the files which may be served, a dict of iiif_url -> error info of the other files and whether all
+        served files may be cached
+    """
+    checked_urls = []
+    errors = {}
+    metadata_errors = {}
+    files = {}
+    is_cacheable = True
+    for iiif_url in iiif_urls:
+        try:
+            url_info = parsing.get_url_info(iiif_url, True)
+            iiif_url = parsing.create_iiif_url(
+                url_info, url_info["document_barcode"], url_info["filenr"], url_info["page"]
+            )
+            check_wabo_for_mail_login(is_mail_login, url_info)
+
+            # Don't ask the metadata server again for a dossier which failed before
+            dossier_key = f"{url_info['stadsdeel']}_{url_info['dossier']}"
+            if dossier_key in metadata_errors:
+                raise metadata_errors[dossier_key]
+            try:
+                metadata, metadata_cache = get_metadata(url_info, iiif_url, metadata_cache)
+            except utils.ImmediateHttpResponse as e:
+                metadata_errors[dossier_key] = e
+                raise
+
+            check_file_access_in_metadata(metadata, url_info, user_scope)
+        except utils.ImmediateHttpResponse as e:
+            checked_urls.append(iiif_url)
+            errors[iiif_url] = create_error_info(e.response)
+            continue
+
+        checked_urls.append(iiif_url)
+        is_cacheable = is_cacheable and is_caching_allowed(metadata, url_info)
+        files[iiif_url] = (url_info, metadata)
+
+    return checked_urls, files, errors, is_cacheable
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@vary_on_headers("Authorization")
+def batch_info_json(request):
+    """
+    Return the info.json of many files in one response. Either of all files in a dossier (GET ?dossier=edepot:ST_00015
+    or POST {"dossier": "edepot:ST_00015"}) or of a list of iiif urls (POST {"urls": [...]}). The user is authorised
+    once, the metadata is retrieved once per dossier and the dimensions of the files are probed concurrently.
+    """
     try:
         check_auth_availability(request)
         mail_jwt_token, is_mail_login = read_out_mail_jwt_token(request)
         user_scope = get_user_scope(request, mail_jwt_token)
+        payload = get_batch_payload(request, settings.BATCH_INFO_JSON_MAX_FILES)
+        iiif_urls, metadata_cache = get_batch_iiif_urls(payload, is_mail_login, settings.BATCH_INFO_JSON_MAX_FILES)
+    except utils.ImmediateHttpResponse as e:
+        log.error(e.response.content)
+        return e.response
 
-        is_source_file_requested = utils.str_to_bool(request.GET.get("source_file"))
-        url_info = parsing.get_url_info(iiif_url, is_source_file_requested)
+    _, files, errors, is_cacheable = check_batch_access(iiif_urls, user_scope, is_mail_login, metadata_cache)
 
-        check_wabo_for_mail_login(is_mail_login, url_info)
-        metadata, _ = get_metadata(url_info, iiif_url, {})
+    info_jsons = {}
+    for iiif_url, dimensions in probe_dimensions_concurrently(files).items():
+        if isinstance(dimensions, HttpResponse):
+            errors[iiif_url] = create_error_info(dimensions)
+            continue
+        # The iiif_url is already url encoded, so it's appended as is
+        info_jsons[iiif_url] = create_info_json(request.build_absolute_uri(f"/iiif/{iiif_url}"), dimensions)
 
-        check_file_access_in_metadata(metadata, url_info, user_scope)
-        is_cacheable = is_caching_allowed(metadata, url_info)
+    response = HttpResponse(
+        json.dumps({"info_jsons": info_jsons, "errors": errors}),
+        content_type="application/json",
+    )
+    return add_caching_headers(is_cacheable and not errors, response)
 
-        file_response, file_url = image_server.get_file(url_info, metadata)
-        image_server.handle_file_response_codes(file_response, file_url)
 
-        file_content = file_response.content
-        file_type = file_response.headers.get("Content-Type")
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@vary_on_headers("Authorization")
+def sprite(request):
+    """
+    Return the thumbnails of many files combined in one grid image (sprite), together with the position of every
+    thumbnail in the grid. The files are selected like in batch_info_json, and the tile size can be set with "size".
+    Files which the user is not allowed to view, or which can't be retrieved, get a blank tile.
+    """
+    try:
+        check_auth_availability(request)
+        mail_jwt_token, is_mail_login = read_out_mail_jwt_token(request)
+        user_scope = get_user_scope(request, mail_jwt_token)
+        payload = get_batch_payload(request, settings.SPRITE_MAX_FILES)
+        tile_size = parsing.parse_sprite_tile_size(payload.get("size"))
+        iiif_urls, metadata_cache = get_batch_iiif_urls(payload, is_mail_login, settings.SPRITE_MAX_FILES)
+    except utils.ImmediateHttpResponse as e:
+        log.error(e.response.content)
+        return e.response
 
-        if is_source_file_requested:
-            return add_caching_headers(is_cacheable, HttpResponse(file_content, file_type))
+    tile_urls, files, errors, is_cacheable = check_batch_access(iiif_urls, user_scope, is_mail_login, metadata_cache)
+    renditions = get_renditions_concurrently(files, tile_size)
 
-        if not is_image_content_type(file_type):
-            # The requested file is NOT an image itself, but we can create a thumbnail for it so let's create it.
-            file_content = create_non_image_file_thumbnail(file_format="jpeg")
-            file_type = "image/jpeg"
+    thumbnails = {}
+    for iiif_url, rendition in renditions.items():
+        if isinstance(rendition, HttpResponse):
+            errors[iiif_url] = create_error_info(rendition)
+        else:
+            thumbnails[iiif_url] = rendition
 
-        if url_info["info_json"]:
-            response_content = generate_info_json(
-                request.build_absolute_uri().split("/info.json")[0],
-                file_content,
-                file_type,
-            )
-            return add_caching_headers(
-                is_cacheable,
-                HttpResponse(response_content, content_type="application/json"),
-            )
+    # The order of the urls is kept, with a blank tile for every file without thumbnail
+    tile_urls = list(dict.fromkeys(tile_urls))
+    sprite_content, tiles = create_sprite(
+        [thumbnails.get(iiif_url) for iiif_url in tile_urls], tile_size, settings.SPRITE_COLUMNS
+    )
 
-        crop = partial(
-            crop_image,
-            file_type,
-            url_info["region"],
-        )
-        scale = partial(
-            scale_image,
-            file_type,
-            url_info["scaling"],
-        )
-        edited_image = pipe(file_content, crop, scale)
+    response = HttpResponse(
+        json.dumps(
+            {
+                "sprite": "data:image/jpeg;base64," + base64.b64encode(sprite_content).decode("ascii"),
+                "tile_size": tile_size,
+                "tiles": dict(zip(tile_urls, tiles, strict=True)),
+                "errors": errors,
+            }
+        ),
+        content_type="application/json",
+    )
+    return add_caching_headers(is_cacheable and not errors, response)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@vary_on_headers("Authorization")
+def manifest(request, dossier_identifier):
+    """
+    Return a IIIF Presentation manifest with all files in a dossier which the user is allowed to view. It is
+    built from the metadata only, so the width and height of a file are only embedded when they are cached.
+    """
+    try:
+        check_auth_availability(request)
+        mail_jwt_token, is_mail_login = read_out_mail_jwt_token(request)
+        user_scope = get_user_scope(request, mail_jwt_token)
 
-        return add_caching_headers(is_cacheable, HttpResponse(edited_image, file_type))
+        dossier_info = parsing.get_dossier_info(dossier_identifier)
+        check_wabo_for_mail_login(is_mail_login, dossier_info)
+        metadata, _ = get_metadata(dossier_info, dossier_identifier, {})
     except utils.ImmediateHttpResponse as e:
-        try:
-            log.exception("ImmediateHttpResponse in index:")
-        except Exception:
-            print("Logging failed")
+        log.error(e.response.content)
         return e.response
+
+    documents = []
+    is_cacheable = True
+    for document in metadata["documenten"]:
+        url_info = {**dossier_info, "document_barcode": document["barcode"]}
+        try:
+            check_file_access_in_metadata(metadata, url_info, user_scope)
+        except utils.ImmediateHttpResponse:
+            continue
+        is_cacheable = is_cacheable and is_caching_allowed(metadata, url_info)
+        documents.append((document, range(len(document.get("bestanden", [])))))
+
+    manifest_content = create_manifest(
+        request.build_absolute_uri(),
+        request.build_absolute_uri("/iiif/"),
+        dossier_identifier,
+        dossier_info,
+        documents,
+    )
+    response = HttpResponse(json.dumps(manifest_content), content_type="application/json")
+    set_response_etag(response)
+    response = get_conditional_response(request, etag=response.headers["ETag"], response=response)
+    return add_caching_headers(is_cacheable, response)
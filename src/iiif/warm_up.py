@@ -0,0 +1,59 @@
+import logging
+import re
+from collections import Counter
+from typing import NamedTuple
+
+from django.http import HttpResponse
+
+from iiif import parsing
+from iiif.dimensions import probe_dimensions_concurrently
+from iiif.metadata import get_iiif_urls_from_metadata, get_metadata_entry
+from iiif.renditions import get_renditions_concurrently
+from main.utils import ImmediateHttpResponse
+
+log = logging.getLogger(__name__)
+
+# A dossier identifier anywhere in a line of an access log, like in /iiif/2/edepot:ST_00015~ST00000126_0/info.json,
+# /iiif/manifest/wabo:SDZ_TA-38657 or /iiif/sprite/?dossier=edepot:ST_00015
+DOSSIER_IDENTIFIER_PATTERN = re.compile(rf"\b(?:{'|'.join(parsing.IIIF_SOURCES)}):[^_~/\s?&\"]+_[^_~/\s?&\"]+")
+
+
+class WarmUpResult(NamedTuple):
+    dossier_identifier: str
+    files: int
+    errors: int
+    error: str | None = None
+
+
+def get_dossiers_from_access_log(lines, limit):
+    """
+    Get the identifiers of the most requested dossiers from the lines of an access log, most requested first
+    """
+    counts = Counter(identifier for line in lines for identifier in set(DOSSIER_IDENTIFIER_PATTERN.findall(line)))
+    return [identifier for identifier, _ in counts.most_common(limit)]
+
+
+def warm_up_dossier(dossier_identifier, thumbnail_sizes):
+    """
+    Fill the caches for a dossier: its metadata, the dimensions of all its files and their thumbnails in the given
+    sizes. Creating a thumbnail stores the dimensions as well, so the files are only probed for their dimensions
+    when no thumbnails are requested. This doesn't check access; that is still done when the cache is used.
+    """
+    try:
+        dossier_info = parsing.get_dossier_info(dossier_identifier)
+        metadata = get_metadata_entry(dossier_info, dossier_identifier).metadata
+    except ImmediateHttpResponse as e:
+        return WarmUpResult(dossier_identifier, 0, 0, e.response.content.decode("utf-8"))
+
+    files = {
+        iiif_url: (parsing.get_url_info(iiif_url, True), metadata)
+        for iiif_url in get_iiif_urls_from_metadata(metadata, dossier_info)
+    }
+    if thumbnail_sizes:
+        all_results = [get_renditions_concurrently(files, size) for size in thumbnail_sizes]
+    else:
+        all_results = [probe_dimensions_concurrently(files)]
+    failed_files = {
+        iiif_url for results in all_results for iiif_url, result in results.items() if isinstance(result, HttpResponse)
+    }
+    return WarmUpResult(dossier_identifier, len(files), len(failed_files))
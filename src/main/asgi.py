@@ -0,0 +1,20 @@
+"""
+ASGI config for iiif_auth_proxy project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. Run it with for example:
+
+    uvicorn main.asgi:application --host 0.0.0.0 --port 8000
+
+Under ASGI the iiif endpoint is served by an async view, so that slow source servers don't block the process.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
+os.environ.setdefault("ASYNC_IIIF_VIEW", "true")
+
+application = get_asgi_application()
+application = OpenTelemetryMiddleware(application)
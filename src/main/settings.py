@@ -59,6 +59,13 @@ BOUWDOSSIER_READ_SCOPE = "BD/R"  # BouwDossiers_Read. Access to civil servants o
 BOUWDOSSIER_EXTENDED_SCOPE = (
     "BD/X"  # BouwDossiers_eXtended. Access civil servants of Amsterdam Municipality with special rights.
 )
+BOUWDOSSIER_SCOPES = frozenset(
+    (
+        BOUWDOSSIER_PUBLIC_SCOPE,
+        BOUWDOSSIER_READ_SCOPE,
+        BOUWDOSSIER_EXTENDED_SCOPE,
+    )
+)
 # IIIF_BASE_URL = os.getenv("IIIF_BASE_URL", "http://iiif.service.consul")
 # IIIF_PORT = os.getenv("IIIF_PORT", "8149")  # This port is static within the network
 EDEPOT_BASE_URL = os.getenv("EDEPOT_BASE_URL", "https://bwt.uitplaatsing.shcp03.archivingondemand.nl/rest/")
@@ -70,11 +77,17 @@ EDEPOT_AUTHORIZATION = os.getenv("EDEPOT_AUTHORIZATION", "dummy")
 WABO_AUTHORIZATION = os.getenv("WABO_AUTHORIZATION", "dummy")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ALGORITHM = "HS256"
+# The maximum number of decoded mail login tokens which are kept in memory per process
+JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", "10000"))
+# The maximum number of access decisions (per user scope and document) which are kept in memory per process
+ACCESS_DECISION_CACHE_MAX_ENTRIES = int(os.getenv("ACCESS_DECISION_CACHE_MAX_ENTRIES", "10000"))
 AZURITE_STORAGE_CONNECTION_STRING = os.getenv("AZURITE_STORAGE_CONNECTION_STRING")
 AZURITE_QUEUE_CONNECTION_STRING = os.getenv("AZURITE_QUEUE_CONNECTION_STRING")
 STORAGE_ACCOUNT_URL = os.getenv("STORAGE_ACCOUNT_URL")
 QUEUE_ACCOUNT_URL = os.getenv("QUEUE_ACCOUNT_URL")
 ZIP_QUEUE_NAME = "zip-queue"
+# Bulk submissions of zip jobs are put on the queue with this many requests at once
+QUEUE_SEND_MAX_CONCURRENCY = int(os.getenv("QUEUE_SEND_MAX_CONCURRENCY", "8"))
 LOGIN_ORIGIN_URL_TLD_WHITELIST = ["data.amsterdam.nl", "acc.dataportaal.amsterdam.nl"]
 
 
@@ -122,12 +135,131 @@ DATAPUNT_AUTHZ = {
     "FORCED_ANONYMOUS_ROUTES": ["/status/health"],
 }
 
+# The number of threads which serve requests in a process, keep it equal to threads in uwsgi.ini
+WEB_SERVER_THREADS = int(os.getenv("WEB_SERVER_THREADS", "4"))
+
+# Limits for the number of concurrent requests per upstream server (per process). Requests above the limit wait for
+# at most MAX_WAIT seconds in a queue of at most MAX_WAITING requests, otherwise they get a 503 with a Retry-After.
+# By default a slow upstream server can occupy all threads but one, which is left for the other requests.
+UPSTREAM_LIMITS = {
+    upstream: {
+        "max_concurrent": int(os.getenv(f"UPSTREAM_{upstream.upper()}_MAX_CONCURRENT", max(WEB_SERVER_THREADS - 1, 1))),
+        "max_waiting": int(os.getenv(f"UPSTREAM_{upstream.upper()}_MAX_WAITING", "16")),
+        "max_wait": float(os.getenv(f"UPSTREAM_{upstream.upper()}_MAX_WAIT", "5")),
+    }
+    for upstream in ("edepot", "wabo", "metadata")
+}
+UPSTREAM_RETRY_AFTER = int(os.getenv("UPSTREAM_RETRY_AFTER", "10"))
+
+# A circuit breaker per upstream server opens when too many of the recent requests fail or are slow. While it is open,
+# requests to that server fail immediately. After OPEN_DURATION seconds a few trial requests are let through.
+CIRCUIT_BREAKERS = {
+    upstream: {
+        "window_size": int(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_WINDOW_SIZE", "20")),
+        "min_calls": int(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_MIN_CALLS", "10")),
+        "failure_rate": float(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_FAILURE_RATE", "0.5")),
+        "slow_call_duration": float(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_SLOW_CALL_DURATION", "10")),
+        "slow_call_rate": float(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_SLOW_CALL_RATE", "0.8")),
+        "open_duration": float(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_OPEN_DURATION", "30")),
+        "half_open_calls": int(os.getenv(f"CIRCUIT_BREAKER_{upstream.upper()}_HALF_OPEN_CALLS", "3")),
+    }
+    for upstream in ("edepot", "wabo", "metadata")
+}
+
+# Hedged requests: when a source server doesn't respond within the HEDGE_PERCENTILE of its recent response times, the
+# same request is sent again and the first response is used. At most HEDGE_MAX_RATIO (up to 1) of the requests in
+# flight can be hedges, so the load on the source server is never more than doubled.
+HEDGED_REQUESTS = str_to_bool(os.getenv("HEDGED_REQUESTS", "false"))
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "32"))
+HEDGING = {
+    upstream: {
+        "percentile": float(os.getenv(f"HEDGE_{upstream.upper()}_PERCENTILE", "95")),
+        "default_delay": float(os.getenv(f"HEDGE_{upstream.upper()}_DEFAULT_DELAY", "2")),
+        "min_delay": float(os.getenv(f"HEDGE_{upstream.upper()}_MIN_DELAY", "0.1")),
+        "window_size": int(os.getenv(f"HEDGE_{upstream.upper()}_WINDOW_SIZE", "200")),
+        "min_samples": int(os.getenv(f"HEDGE_{upstream.upper()}_MIN_SAMPLES", "20")),
+        "max_ratio": float(os.getenv(f"HEDGE_{upstream.upper()}_MAX_RATIO", "0.25")),
+    }
+    for upstream in ("edepot", "wabo")
+}
+
+# The time a request to the iiif endpoint may take. This should stay below the harakiri timeout of uWSGI (30s), so
+# that there is time left to send a 504 when it runs out.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "27"))
+# The time retrieving a file from the source server may take, when it isn't limited by a request deadline
+FILE_REQUEST_TIMEOUT = float(os.getenv("FILE_REQUEST_TIMEOUT", "25"))
+
+# Serve the iiif endpoint with an async view. This is enabled by the ASGI entry point (main/asgi.py).
+ASYNC_IIIF_VIEW = str_to_bool(os.getenv("ASYNC_IIIF_VIEW", "false"))
+IMAGE_PROCESSING_MAX_WORKERS = int(os.getenv("IMAGE_PROCESSING_MAX_WORKERS", "4"))
+
+# The number of parsed iiif urls which are kept in memory per process
+IIIF_URL_PARSER_CACHE_SIZE = int(os.getenv("IIIF_URL_PARSER_CACHE_SIZE", "4096"))
+
+# Changes in the metadata, like access restrictions, are picked up after at most this many seconds
+METADATA_CACHE_TIMEOUT = int(os.getenv("METADATA_CACHE_TIMEOUT", "300"))
+# In the last METADATA_STALE_WHILE_REVALIDATE seconds of METADATA_CACHE_TIMEOUT the cached metadata is still used,
+# while it is refreshed in the background. When the metadata server fails, metadata which is at most
+# METADATA_STALE_IF_ERROR seconds past METADATA_CACHE_TIMEOUT is used instead of returning an error.
+METADATA_STALE_WHILE_REVALIDATE = int(os.getenv("METADATA_STALE_WHILE_REVALIDATE", "60"))
+METADATA_STALE_IF_ERROR = int(os.getenv("METADATA_STALE_IF_ERROR", "600"))
+METADATA_REFRESH_MAX_WORKERS = int(os.getenv("METADATA_REFRESH_MAX_WORKERS", "2"))
+
+# The dimensions of a file hardly ever change, so they can be cached for a long time
+DIMENSIONS_CACHE_TIMEOUT = int(os.getenv("DIMENSIONS_CACHE_TIMEOUT", 60 * 60 * 24))
+DIMENSIONS_PROBE_MAX_WORKERS = int(os.getenv("DIMENSIONS_PROBE_MAX_WORKERS", "8"))
+BATCH_INFO_JSON_MAX_FILES = int(os.getenv("BATCH_INFO_JSON_MAX_FILES", "1000"))
+
+# Thumbnails (renditions) are cached per file and size. Renditions bigger than RENDITION_CACHE_MAX_BYTES aren't cached.
+RENDITION_CACHE_TIMEOUT = int(os.getenv("RENDITION_CACHE_TIMEOUT", 60 * 60 * 24))
+RENDITION_CACHE_MAX_BYTES = int(os.getenv("RENDITION_CACHE_MAX_BYTES", 100 * 1024))
+RENDITION_MAX_WORKERS = int(os.getenv("RENDITION_MAX_WORKERS", "8"))
+SPRITE_TILE_SIZE = int(os.getenv("SPRITE_TILE_SIZE", "180"))
+SPRITE_MAX_TILE_SIZE = int(os.getenv("SPRITE_MAX_TILE_SIZE", "400"))
+SPRITE_COLUMNS = int(os.getenv("SPRITE_COLUMNS", "10"))
+SPRITE_MAX_FILES = int(os.getenv("SPRITE_MAX_FILES", "200"))
+
 STORAGE_ACCOUNT_CONTAINER_ZIP_QUEUE_JOBS_NAME = "zip-queue-jobs"
 
+# The files of a zip are downloaded concurrently, with at most ZIP_DOWNLOAD_<SOURCE>_MAX_CONCURRENT downloads from the
+# same source server at a time (for all jobs in the process). Keep these at most UPSTREAM_<SOURCE>_MAX_CONCURRENT, so
+# the downloads don't wait for the upstream limit.
+ZIP_DOWNLOAD_MAX_WORKERS = int(os.getenv("ZIP_DOWNLOAD_MAX_WORKERS", "8"))
+ZIP_DOWNLOAD_SOURCE_LIMITS = {
+    source: int(os.getenv(f"ZIP_DOWNLOAD_{source.upper()}_MAX_CONCURRENT", UPSTREAM_LIMITS[source]["max_concurrent"]))
+    for source in ("edepot", "wabo")
+}
+# The number of zip jobs a consumer process works on at once
+ZIP_CONSUMER_CONCURRENCY = int(os.getenv("ZIP_CONSUMER_CONCURRENCY", "2"))
+# Source files are cached on local disk (in a new directory in ZIP_FILE_CACHE_DIR, or the temp directory) for the zip
+# jobs of a consumer, up to ZIP_FILE_CACHE_MAX_SIZE bytes. 0 disables the cache.
+ZIP_FILE_CACHE_DIR = os.getenv("ZIP_FILE_CACHE_DIR") or None
+ZIP_FILE_CACHE_MAX_SIZE = int(os.getenv("ZIP_FILE_CACHE_MAX_SIZE", 1024 * 1024 * 1024))
+# When the zip queue is empty, the consumer waits ZIP_CONSUMER_MIN_POLL_INTERVAL seconds before receiving again, which
+# doubles with every empty receive up to ZIP_CONSUMER_MAX_POLL_INTERVAL seconds
+ZIP_CONSUMER_MIN_POLL_INTERVAL = float(os.getenv("ZIP_CONSUMER_MIN_POLL_INTERVAL", "1"))
+ZIP_CONSUMER_MAX_POLL_INTERVAL = float(os.getenv("ZIP_CONSUMER_MAX_POLL_INTERVAL", "30"))
+# A message on the zip queue is invisible to other consumers for ZIP_MESSAGE_VISIBILITY_TIMEOUT seconds, which is
+# extended every ZIP_MESSAGE_HEARTBEAT_INTERVAL seconds while the job is processed
+ZIP_MESSAGE_VISIBILITY_TIMEOUT = int(os.getenv("ZIP_MESSAGE_VISIBILITY_TIMEOUT", 5 * 60))
+ZIP_MESSAGE_HEARTBEAT_INTERVAL = int(os.getenv("ZIP_MESSAGE_HEARTBEAT_INTERVAL", 60))
+if ZIP_MESSAGE_HEARTBEAT_INTERVAL >= ZIP_MESSAGE_VISIBILITY_TIMEOUT:
+    raise ValueError("ZIP_MESSAGE_HEARTBEAT_INTERVAL must be shorter than ZIP_MESSAGE_VISIBILITY_TIMEOUT")
+# The lease of a zip job isn't renewed after ZIP_JOB_MAX_DURATION seconds, so a job which hangs is retried
+ZIP_JOB_MAX_DURATION = int(os.getenv("ZIP_JOB_MAX_DURATION", 60 * 60))
+# The progress of a zip job is saved every ZIP_CHECKPOINT_INTERVAL seconds, so a job which is retried only downloads
+# the files which weren't in the zip at the last checkpoint
+ZIP_CHECKPOINT_INTERVAL = int(os.getenv("ZIP_CHECKPOINT_INTERVAL", "30"))
+
 STORAGE_ACCOUNT_CONTAINER_NAME = "downloads"
+# A zip is uploaded in blocks of this size while it is created, with at most BLOB_UPLOAD_MAX_CONCURRENCY blocks at once
+BLOB_BLOCK_SIZE = int(os.getenv("BLOB_BLOCK_SIZE", 4 * 1024 * 1024))
+BLOB_UPLOAD_MAX_CONCURRENCY = int(os.getenv("BLOB_UPLOAD_MAX_CONCURRENCY", "4"))
 TEMP_URL_EXPIRY_DAYS = 7
 if TEMP_URL_EXPIRY_DAYS > 7:
     raise ValueError("TEMP_URL_EXPIRY_DAYS must be 7 days or less")
+# The user delegation key which signs the temp urls is cached, so a temp url can be valid this many seconds shorter
+USER_DELEGATION_KEY_REFRESH_MARGIN = int(os.getenv("USER_DELEGATION_KEY_REFRESH_MARGIN", 60 * 60))
 
 # Application definition
 DJANGO_APPS = [
@@ -209,6 +341,26 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+# The in-memory cache is local to a process. Deployments with several processes should share a cache with
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache and CACHE_LOCATION=redis://<host>:6379/0. The warm_caches
+# command refuses to run with a cache which is local to its process, as it wouldn't have any effect on the web server.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache")
+CACHES = {
+    "default": {
+        "BACKEND": CACHE_BACKEND,
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
+        "OPTIONS": (
+            {"MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", "10000"))}
+            if CACHE_BACKEND == "django.core.cache.backends.locmem.LocMemCache"
+            else {}
+        ),
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -305,14 +457,18 @@ LOGGING = {
 # OTEL
 APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.django import DjangoInstrumentor
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 from opentelemetry.instrumentation.logging import LoggingInstrumentor
 from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 from opentelemetry.instrumentation.urllib import URLLibInstrumentor
 from opentelemetry.instrumentation.urllib3 import URLLib3Instrumentor
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
@@ -323,20 +479,26 @@ trace.set_tracer_provider(TracerProvider(resource=resource))
 tracer = trace.get_tracer(__name__)
 
 exporter_name = os.environ.get("OTEL_EXPORTER", "otlp")
+metric_readers = []
 if exporter_name == "otlp":
     otlp_exporter = OTLPSpanExporter()
     span_processor = BatchSpanProcessor(otlp_exporter)
     trace.get_tracer_provider().add_span_processor(span_processor)
+    metric_readers.append(PeriodicExportingMetricReader(OTLPMetricExporter()))
 elif exporter_name == "console":
     console_exporter = ConsoleSpanExporter()
     console_processor = BatchSpanProcessor(console_exporter)
     trace.get_tracer_provider().add_span_processor(console_processor)
+    metric_readers.append(PeriodicExportingMetricReader(ConsoleMetricExporter()))
 else:
     pass
 
+metrics.set_meter_provider(MeterProvider(resource=resource, metric_readers=metric_readers))
+
 DjangoInstrumentor().instrument()
 Psycopg2Instrumentor().instrument()
 RequestsInstrumentor().instrument()
+HTTPXClientInstrumentor().instrument()
 URLLibInstrumentor().instrument()
 URLLib3Instrumentor().instrument()
 LoggingInstrumentor().instrument(set_logging_format=True)
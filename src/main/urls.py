@@ -14,10 +14,11 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
-from django.urls import include, path
+from django.urls import include, path, re_path
 
 urlpatterns = [
-    path("iiif/status/health", include("health.urls")),
+    # Without a trailing slash for the health check itself, with one for the other health routes
+    re_path(r"^iiif/status/health(?:$|/)", include("health.urls")),
     path("iiif/login-link-to-email/", include("auth_mail.urls")),
     path("iiif/zip/", include("zip_consumer.urls")),
     path("iiif/", include("iiif.urls")),
@@ -1,4 +1,7 @@
 import logging
+import time
+from collections import OrderedDict
+from threading import Lock
 
 from django.http import HttpResponse
 
@@ -33,3 +36,41 @@ def find(func, seq):
 
 def clamp(n, minn, maxn):
     return max(min(maxn, n), minn)
+
+
+class ExpiringLRUCache:
+    """
+    Thread-safe in-memory cache of a maximum number of entries, in which every entry expires at its own (unix)
+    timestamp. When the cache is full, the least recently used entry is removed.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
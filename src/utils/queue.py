@@ -1,4 +1,6 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from azure.identity import WorkloadIdentityCredential
 from azure.storage.queue import QueueClient, QueueServiceClient
@@ -7,7 +9,12 @@ from django.conf import settings
 log = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=1)
 def get_queue_client():
+    """
+    Get the client of the zip queue. It's created once per process, so its credential (which caches the access
+    token) and connection pool are reused by all requests to the queue.
+    """
     if settings.AZURITE_QUEUE_CONNECTION_STRING:
         queue_service_client = QueueServiceClient.from_connection_string(settings.AZURITE_QUEUE_CONNECTION_STRING)
         queue_client = queue_service_client.get_queue_client(settings.ZIP_QUEUE_NAME)
@@ -20,3 +27,23 @@ def get_queue_client():
         )
 
     return queue_client
+
+
+def _send_message(queue_client, content):
+    try:
+        queue_client.send_message(content)
+    except Exception as e:
+        log.exception(f"Exception while sending a message to the queue: ({e})")
+        return e
+
+
+def send_messages(contents, max_concurrency=settings.QUEUE_SEND_MAX_CONCURRENCY):
+    """
+    Send many messages to the queue at once. The queue has no batch operation, so the messages are sent concurrently
+    over the connections of the shared queue client.
+
+    :return: List with the exception for every message which couldn't be sent, or None when it was sent
+    """
+    queue_client = get_queue_client()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(lambda content: _send_message(queue_client, content), contents))
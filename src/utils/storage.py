@@ -1,20 +1,43 @@
 import logging
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobSasPermissions, BlobServiceClient, generate_blob_sas
 from django.conf import settings
+from opentelemetry import metrics
 
 log = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
 
+# The maximum validity of a user delegation key
+MAX_USER_DELEGATION_KEY_DAYS = 7
 
+# Cache of the user delegation key per storage account, with its expiry time
+_user_delegation_keys = {}
+_user_delegation_keys_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_credential():
+    # The credential caches its access token, so it's shared by all clients in the process
+    return DefaultAzureCredential()
+
+
+@lru_cache(maxsize=1)
 def get_blob_service_client():
+    """
+    Get the client of the storage account. It's created once per process, so its connection pool is reused by all
+    container and blob clients which are created from it.
+    """
     if settings.AZURITE_STORAGE_CONNECTION_STRING:
         # TODO: Move this code to a mocking of this function in the tests
         blob_service_client = BlobServiceClient.from_connection_string(settings.AZURITE_STORAGE_CONNECTION_STRING)
     else:
-        default_credential = DefaultAzureCredential()
-        blob_service_client = BlobServiceClient(settings.STORAGE_ACCOUNT_URL, credential=default_credential)
+        blob_service_client = BlobServiceClient(settings.STORAGE_ACCOUNT_URL, credential=get_credential())
     return blob_service_client
 
 
@@ -30,11 +53,140 @@ def get_blob_client(container_name, blob_name):
     return blob_client, blob_service_client
 
 
-def store_file_on_storage_account(storage_container, local_file_path, blob_name):
-    blob_client, blob_service_client = get_blob_client(storage_container, blob_name)
-    with open(file=local_file_path, mode="rb") as data:
-        blob_client.upload_blob(data)
-    return blob_client, blob_service_client
+def get_block_id(index, prefix=""):
+    # The ids of the blocks of a blob should all have the same length
+    return f"{prefix}{index:08d}"
+
+
+class BlobBlockWriter:
+    """
+    A write-only stream to a block blob. The data is uploaded while it is written: every block_size bytes are
+    staged as a block by one of max_concurrency threads, and the blocks are committed when the stream is closed.
+    When all threads are busy, writing waits for a block to be staged, so at most max_concurrency + 1 blocks are
+    kept in memory. When the stream is left because of an exception nothing is committed, and Azure removes the
+    staged blocks after a week.
+
+    An upload which failed can be resumed by passing the blocks which were staged already (as returned by stage,
+    see ZipJobCheckpoint) and writing the data from tell() onwards. When several writers could resume the same
+    upload, each should have its own block_id_prefix (of the same length), so they don't overwrite each other's
+    blocks.
+    before_commit is called right before the blocks are committed, and can raise to leave them uncommitted.
+    """
+
+    def __init__(
+        self,
+        blob_client,
+        block_size=settings.BLOB_BLOCK_SIZE,
+        max_concurrency=settings.BLOB_UPLOAD_MAX_CONCURRENCY,
+        staged_blocks=None,
+        block_id_prefix="",
+        before_commit=None,
+    ):
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self.block_id_prefix = block_id_prefix
+        self.before_commit = before_commit
+        self._blocks = list(staged_blocks or [])
+        self.size = sum(size for _, size in self._blocks)
+        self._uploaded_size = 0
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="blob-upload")
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._futures = []
+        self._error = None
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        self._raise_error()
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit_block(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def flush(self):
+        # Blocks are only staged when they are full, to stay below the maximum number of blocks of a blob
+        pass
+
+    def stage(self):
+        """
+        Stage the data written so far, also when the last block isn't full, and wait until all blocks are staged.
+
+        :return: The staged blocks, which can be passed to resume the upload from here
+        """
+        if self._buffer:
+            self._submit_block(bytes(self._buffer))
+            self._buffer.clear()
+        self._wait_for_blocks()
+        self._raise_error()
+        return list(self._blocks)
+
+    def _submit_block(self, data):
+        self._slots.acquire()
+        block_id = get_block_id(len(self._blocks), self.block_id_prefix)
+        self._blocks.append((block_id, len(data)))
+        future = self._executor.submit(self._stage_block, block_id, data)
+        future.add_done_callback(self._block_done)
+        self._futures.append(future)
+
+    def _stage_block(self, block_id, data):
+        start = time.monotonic()
+        self.blob_client.stage_block(block_id, data)
+        block_upload_time.record(time.monotonic() - start)
+        uploaded_bytes.add(len(data))
+        with self._lock:
+            self._uploaded_size += len(data)
+
+    def _block_done(self, future):
+        with self._lock:
+            if future.exception() is not None and self._error is None:
+                self._error = future.exception()
+        self._slots.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _wait_for_blocks(self):
+        for future in self._futures:
+            future.exception()
+        self._futures.clear()
+
+    def _wait(self):
+        self._wait_for_blocks()
+        self._executor.shutdown()
+
+    def close(self):
+        if self._buffer:
+            self._submit_block(bytes(self._buffer))
+            self._buffer.clear()
+        self._wait()
+        self._raise_error()
+        if self.before_commit is not None:
+            self.before_commit()
+        self.blob_client.commit_block_list([block_id for block_id, _ in self._blocks])
+
+        duration = time.monotonic() - self._started_at
+        throughput = self._uploaded_size / duration if duration else 0
+        upload_throughput.record(throughput)
+        log.info(
+            f"Uploaded {self._uploaded_size} bytes in {duration:.1f}s ({throughput / 1_000_000:.1f} MB/s) to "
+            f"{self.blob_client.blob_name}, which has {len(self._blocks)} blocks"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._wait()
 
 
 def store_blob_on_storage_account(storage_container, blob_name, blob):
@@ -54,20 +206,61 @@ def remove_blob_from_storage_account(storage_container, blob_name):
     blob_client.delete_blob()
 
 
+def get_user_delegation_key(blob_service_client, valid_for):
+    """
+    Get a user delegation key which is valid for at least valid_for minus USER_DELEGATION_KEY_REFRESH_MARGIN. Keys
+    are valid for the maximum of 7 days and are cached until they get too short-lived, so a key is requested from
+    the storage account at most about once per margin.
+
+    :return: Tuple of the key and its expiry time
+    """
+    now = datetime.now(timezone.utc)
+    account_name = blob_service_client.account_name
+    with _user_delegation_keys_lock:
+        key, key_expiry_time = _user_delegation_keys.get(account_name, (None, None))
+        min_expiry_time = now + valid_for - timedelta(seconds=settings.USER_DELEGATION_KEY_REFRESH_MARGIN)
+        if key is None or key_expiry_time < min_expiry_time:
+            key_expiry_time = now + timedelta(days=MAX_USER_DELEGATION_KEY_DAYS)
+            key = blob_service_client.get_user_delegation_key(now, key_expiry_time)
+            _user_delegation_keys[account_name] = (key, key_expiry_time)
+        return key, key_expiry_time
+
+
 def create_storage_account_temp_url(blob_client, blob_service_client, expiry_days=settings.TEMP_URL_EXPIRY_DAYS):
-    key_start_time = datetime.utcnow()
-    key_expiry_time = key_start_time + timedelta(days=expiry_days)
-    user_delegation_key = blob_service_client.get_user_delegation_key(key_start_time, key_expiry_time)
+    """
+    Create a url with a SAS token to download a blob. The url is valid for expiry_days, or up to
+    USER_DELEGATION_KEY_REFRESH_MARGIN seconds less when it's signed with a cached user delegation key.
+    """
+    valid_for = timedelta(days=expiry_days)
+    user_delegation_key, key_expiry_time = get_user_delegation_key(blob_service_client, valid_for)
 
     sas_token = generate_blob_sas(
         account_name=blob_client.account_name,
         container_name=blob_client.container_name,
         blob_name=blob_client.blob_name,
-        account_key=user_delegation_key,
+        user_delegation_key=user_delegation_key,
         permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(days=expiry_days),
+        # The SAS token is only valid as long as the key it was signed with
+        expiry=min(datetime.now(timezone.utc) + valid_for, key_expiry_time),
     )
 
     file_url = blob_client.url.replace(blob_service_client.url, settings.APP_BASE_URL)
 
     return f"{file_url}?{sas_token}"
+
+
+uploaded_bytes = meter.create_counter(
+    "storage.upload.bytes",
+    unit="By",
+    description="Bytes staged as blocks of blobs on the storage account",
+)
+block_upload_time = meter.create_histogram(
+    "storage.upload.block_duration",
+    unit="s",
+    description="Time it took to stage a block of a blob",
+)
+upload_throughput = meter.create_histogram(
+    "storage.upload.throughput",
+    unit="By/s",
+    description="Average upload speed of a blob, from opening until committing it",
+)
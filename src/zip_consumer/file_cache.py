@@ -0,0 +1,149 @@
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple
+
+from django.conf import settings
+from opentelemetry import metrics
+
+log = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+
+class CacheEntry(NamedTuple):
+    path: str
+    size: int
+    content_type: str | None
+    etag: str | None
+    last_modified: str | None
+
+    @property
+    def validators(self):
+        # The headers of a conditional request, to which the source server responds with a 304 when it's unchanged
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class FileCache:
+    """
+    Cache of source files on local disk, shared by the zip jobs in a process, so the files of popular dossiers don't
+    have to be downloaded for every zip. A cached file is only used after the source server confirmed that it's
+    unchanged, so only files with an ETag or Last-Modified header are cached: get returns the validators of a file,
+    and the file itself is only read after the confirmation. When the files together are bigger than
+    max_size bytes, the least recently used files are removed.
+
+    The cache doesn't check access; the files of a zip should be checked with file_can_be_zipped for every job.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        # The CacheEntry of every file, by key
+        self._entries = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key):
+        """
+        :return: The CacheEntry of the file, or None when it isn't cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def read(self, key, entry):
+        """
+        Read the content of a file which was returned by get, or None when the file was removed or replaced since
+        """
+        with self._lock:
+            if self._entries.get(key) is not entry:
+                return None
+            # A file which is opened can still be read when it's removed from the cache in the meantime
+            try:
+                f = open(entry.path, "rb")
+            except OSError as e:
+                log.warning(f"Could not read {key} from the file cache: {e}")
+                self._remove(key)
+                return None
+        with f:
+            return f.read()
+
+    def set(self, key, content, headers):
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not (etag or last_modified) or len(content) > self.max_size:
+            return
+
+        path = self._get_path(key)
+        # Other jobs could be reading the file, so the new version replaces it instead of overwriting it
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                f.write(content)
+        except OSError as e:
+            # E.g. a full disk, the file is still zipped
+            log.warning(f"Could not write {key} to the file cache: {e}")
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries[key].size
+            os.replace(f.name, path)
+            self._entries[key] = CacheEntry(path, len(content), headers.get("Content-Type"), etag, last_modified)
+            self._entries.move_to_end(key)
+            self.size += len(content)
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@lru_cache(maxsize=1)
+def get_file_cache():
+    """
+    Get the file cache of the process, in a new directory in ZIP_FILE_CACHE_DIR (or the temp directory) which is
+    removed when the process exits, or None when ZIP_FILE_CACHE_MAX_SIZE is 0
+    """
+    if not settings.ZIP_FILE_CACHE_MAX_SIZE:
+        return None
+    directory = tempfile.mkdtemp(prefix="zip-file-cache-", dir=settings.ZIP_FILE_CACHE_DIR)
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    log.info(f"Caching up to {settings.ZIP_FILE_CACHE_MAX_SIZE} bytes of source files in {directory}")
+    return FileCache(directory, settings.ZIP_FILE_CACHE_MAX_SIZE)
+
+
+def get_file_cache_key(source, file_pad):
+    return f"{source}:{file_pad}"
+
+
+file_cache_lookups = meter.create_counter(
+    "zip_consumer.file_cache.lookups",
+    description="Files for zips looked up in the file cache, by whether they were unchanged, changed or not cached",
+)
@@ -1,4 +1,5 @@
 import logging
+import signal
 
 from django.core.management.base import BaseCommand
 from opentelemetry import trace
@@ -22,6 +23,8 @@ class Command(BaseCommand):
 
         try:
             consumer = AzureZipQueueConsumer()
+            # Finish the jobs in progress when the pod is stopped, instead of leaving them for another consumer
+            signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop())
             consumer.run()
         except Exception as e:
             logger.exception(e)
@@ -1,11 +1,14 @@
 import json
 import logging
-import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import timeout_decorator
+from azure.core.exceptions import ResourceNotFoundError
 from django.conf import settings
 from django.template.loader import render_to_string
+from opentelemetry import metrics
 
 from auth_mail import mailing
 from core.auth.document_access import (
@@ -15,73 +18,233 @@ from iiif import image_server
 from iiif.metadata import get_metadata
 from utils.queue import get_queue_client
 from utils.storage import (
+    BlobBlockWriter,
     create_storage_account_temp_url,
+    get_blob_client,
     get_blob_from_storage_account,
     remove_blob_from_storage_account,
-    store_file_on_storage_account,
 )
 from zip_consumer import zip_tools
 
 logger = logging.getLogger(__name__)
+meter = metrics.get_meter(__name__)
+
+
+class MessageLeaseExpiredError(Exception):
+    pass
+
+
+class MessageLease:
+    """
+    The time in which a received message is invisible to other consumers. After that, another consumer can receive
+    the message and process it again. The lease is renewed while the message is processed, which changes the pop
+    receipt that is needed to update or delete the message. After max_duration seconds the lease isn't renewed
+    anymore and the job is abandoned, so a job which hangs doesn't keep its message from other consumers forever.
+    """
+
+    def __init__(self, message, visibility_timeout, max_duration=settings.ZIP_JOB_MAX_DURATION):
+        self.message = message
+        self.pop_receipt = message.pop_receipt
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + visibility_timeout
+        self.max_duration = max_duration
+        self.lost = False
+        self.abandoned = False
+        self.lock = threading.Lock()
+
+    @property
+    def expired(self):
+        return self.lost or self.abandoned or time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired:
+            raise MessageLeaseExpiredError(f"The lease of message {self.message.id} has expired")
+
+    def renew(self, queue_client, visibility_timeout):
+        with self.lock:
+            if self.expired:
+                # Another consumer may have received the message, so it can't be taken back
+                return
+            start = time.monotonic()
+            if start - self.started_at >= self.max_duration:
+                # The job can't be stopped, but it fails at its next check of the lease
+                logger.error(
+                    f"The job of message {self.message.id} is still running after {self.max_duration}s, abandoning it"
+                )
+                self.abandoned = True
+                return
+            try:
+                updated_message = queue_client.update_message(
+                    self.message.id, self.pop_receipt, visibility_timeout=visibility_timeout
+                )
+            except ResourceNotFoundError as e:
+                # The message was received by another consumer (so it has another pop receipt) or deleted
+                logger.error(f"The lease of message {self.message.id} is lost: {e}")
+                self.lost = True
+                return
+            except Exception as e:
+                # Try again at the next heartbeat, while the lease is still valid
+                logger.warning(f"Could not renew the lease of message {self.message.id}: {e}")
+                return
+            self.pop_receipt = updated_message.pop_receipt
+            self.expires_at = start + visibility_timeout
 
 
 class AzureZipQueueConsumer:
     # Be careful with the visibility timeout! If the message is still processing when the visibility timeout
     # expires, the message will be put back on the queue and will be processed again. This can lead to duplicate
-    # messages!!! Always use a timeout decorator to prevent this.
-    # We set it to an hour, because some zips can simply be very, very large
-    MESSAGE_VISIBILITY_TIMEOUT = 3600
+    # messages!!! So the leases of the messages being processed are renewed every heartbeat interval, and a job
+    # checks its lease before it emails the user or deletes the message.
+    # The timeout is short, so the message of a crashed consumer is processed again within minutes.
+    MESSAGE_VISIBILITY_TIMEOUT = settings.ZIP_MESSAGE_VISIBILITY_TIMEOUT
+    MESSAGE_HEARTBEAT_INTERVAL = settings.ZIP_MESSAGE_HEARTBEAT_INTERVAL
+    # A job which takes longer is abandoned, and its message is processed again after the visibility timeout
+    JOB_MAX_DURATION = settings.ZIP_JOB_MAX_DURATION
 
     # This consumer accepts messages with this name
     MESSAGE_VERSION_NAME = zip_tools.ZIP_MESSAGE_VERSION_NAME
 
-    def __init__(self, end_at_empty_queue=False):
+    def __init__(self, end_at_empty_queue=False, concurrency=settings.ZIP_CONSUMER_CONCURRENCY):
         self.queue_client = get_queue_client()
         self.end_at_empty_queue = end_at_empty_queue
+        self.concurrency = concurrency
+        self.stopping = threading.Event()
+        # The leases of the messages which are being processed, by message id
+        self._leases = {}
+        self._changed = threading.Condition()
+        self._heartbeat_stopped = threading.Event()
+        self._empty_polls = 0
+
+    def stop(self):
+        """
+        Stop receiving messages. The jobs which are being processed are finished before run returns.
+        """
+        logger.info(f"Stopping the zip consumer, waiting for {len(self._leases)} jobs to finish")
+        self.stopping.set()
+        with self._changed:
+            self._changed.notify_all()
+
+    def _wait(self, timeout=None):
+        # Wait until a job has finished, the consumer is stopped or the timeout has passed
+        with self._changed:
+            if not self.stopping.is_set():
+                self._changed.wait(timeout)
 
-    def get_queue_length(self):
-        properties = self.queue_client.get_queue_properties()
-        count = properties.approximate_message_count
-        return count
+    def renew_leases(self):
+        with self._changed:
+            leases = list(self._leases.values())
+        for lease in leases:
+            lease.renew(self.queue_client, self.MESSAGE_VISIBILITY_TIMEOUT)
+
+    def _heartbeat(self):
+        while not self._heartbeat_stopped.wait(self.MESSAGE_HEARTBEAT_INTERVAL):
+            self.renew_leases()
 
     def run(self):
-        while True:
-            count = self.get_queue_length()
-            message_iterator = None
-
-            if self.end_at_empty_queue:
-                # This part is only for testing purposes.
-                # To be able to exit the running process when the queue is empty.
-                message_iterator = list(self.queue_client.receive_messages(messages_per_page=10, visibility_timeout=5))
-                if count == 0 or len(message_iterator) == 0:
-                    break
+        """
+        Process the messages on the queue with at most concurrency jobs at once. Only as many messages are received
+        as there are free job slots, so a message is never waiting in this process while other consumers could
+        process it.
+        """
+        self._heartbeat_stopped.clear()
+        heartbeat = threading.Thread(target=self._heartbeat, name="zip-lease-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            self._run()
+        finally:
+            self._heartbeat_stopped.set()
+            heartbeat.join()
+        logger.info("Zip consumer stopped")
 
-            if count == 0:
-                time.sleep(5)
-                continue
+    def get_empty_queue_delay(self):
+        """
+        Get the time to wait before receiving again after the queue was empty. It doubles with every empty receive
+        up to ZIP_CONSUMER_MAX_POLL_INTERVAL, and half of it is random so that idle consumers don't poll in step.
+        """
+        delay = min(
+            settings.ZIP_CONSUMER_MAX_POLL_INTERVAL, settings.ZIP_CONSUMER_MIN_POLL_INTERVAL * 2**self._empty_polls
+        )
+        self._empty_polls += 1
+        return delay / 2 + random.uniform(0, delay / 2)
 
-            if message_iterator is None:
-                message_iterator = self.queue_client.receive_messages(
-                    max_messages=1, visibility_timeout=self.MESSAGE_VISIBILITY_TIMEOUT
-                )
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="zip-job") as executor:
+            while not self.stopping.is_set():
+                free_slots = self.concurrency - len(self._leases)
+                if free_slots <= 0:
+                    self._wait()
+                    continue
 
-            for message in message_iterator:
-                try:
-                    self.process_message(message)
-                except Exception as e:
-                    _job_content = json.loads(message.content)
-                    logger.error(
-                        f"An exception occurred during processing of message data uuid {_job_content['data']}: {e}"
+                messages = list(
+                    self.queue_client.receive_messages(
+                        max_messages=free_slots,
+                        messages_per_page=free_slots,
+                        visibility_timeout=self.MESSAGE_VISIBILITY_TIMEOUT,
                     )
-                    if message.dequeue_count > 5:
-                        logger.info(f"Deleting the message, dequeue count is too high. {message.dequeue_count=}")
-                        self.queue_client.delete_message(message.id, message.pop_receipt)
-                else:
-                    self.queue_client.delete_message(message.id, message.pop_receipt)
+                )
+                queue_polls.add(1, {"outcome": "messages" if messages else "empty"})
 
-    @timeout_decorator.timeout(MESSAGE_VISIBILITY_TIMEOUT)
-    def process_message(self, message):
+                if messages:
+                    # Receive again right away while there are messages and free job slots
+                    self._empty_polls = 0
+                    received_messages.add(len(messages))
+                    for message in messages:
+                        self._start_job(executor, message)
+                    continue
 
+                if self.end_at_empty_queue and not self._leases:
+                    # This part is only for testing purposes.
+                    # To be able to exit the running process when the queue is empty.
+                    break
+
+                start = time.monotonic()
+                self._wait(self.get_empty_queue_delay())
+                queue_idle_time.record(time.monotonic() - start)
+
+    def _start_job(self, executor, message):
+        with self._changed:
+            if message.id in self._leases:
+                # The lease of a job in this process expired and the message was received again
+                logger.warning(f"Message {message.id} is already being processed, not processing it again")
+                return
+            lease = MessageLease(message, self.MESSAGE_VISIBILITY_TIMEOUT, self.JOB_MAX_DURATION)
+            self._leases[message.id] = lease
+        executor.submit(self._handle_message, lease)
+
+    def _handle_message(self, lease):
+        message = lease.message
+        try:
+            self.process_message(message, lease)
+        except MessageLeaseExpiredError as e:
+            # Another consumer can have received the message already, so leave it to that consumer
+            logger.error(f"{e}, the job is abandoned")
+        except Exception as e:
+            _job_content = json.loads(message.content)
+            logger.error(f"An exception occurred during processing of message data uuid {_job_content['data']}: {e}")
+            if message.dequeue_count > 5:
+                logger.info(f"Deleting the message, dequeue count is too high. {message.dequeue_count=}")
+                self.delete_message(lease)
+        else:
+            self.delete_message(lease)
+        finally:
+            with self._changed:
+                del self._leases[message.id]
+                self._changed.notify_all()
+
+    def delete_message(self, lease):
+        # Holding the lock of the lease makes sure its pop receipt isn't changed by a renewal in the meantime
+        with lease.lock:
+            try:
+                lease.check()
+                self.queue_client.delete_message(lease.message.id, lease.pop_receipt)
+            except Exception as e:
+                logger.error(f"Could not delete message {lease.message.id}: {e}")
+
+    def process_message(self, message, lease=None):
+        """
+        Create the zip of a job, upload it and email the download link. When a lease is given, it's checked before
+        anything the user would notice twice is done.
+        """
         logger.info("Started process_message")
 
         if message.dequeue_count > 5:
@@ -99,15 +262,16 @@ class AzureZipQueueConsumer:
         )
         record = json.loads(blob)
 
-        # Prepare folder and report.txt file for downloads
-        (
-            zipjob_uuid,
-            tmp_folder_path,
-            info_txt_contents,
-        ) = image_server.prepare_zip_downloads()
+        # Prepare the report.txt file for downloads. When an earlier attempt of the job saved a checkpoint, its zip is
+        # continued
+        zipjob_uuid, info_txt_contents = image_server.prepare_zip_downloads()
+        checkpoint = zip_tools.ZipJobCheckpoint.load(job_blob_name, zipjob_uuid)
+        zipjob_uuid = checkpoint.zipjob_uuid
 
-        # Get metadata and files from image servers
+        # Get metadata and check access for all files
         metadata_cache = {}
+        files = []
+        zippable_filenames = []
         for iiif_url, image_info in record["urls"].items():
             metadata, metadata_cache = get_metadata(
                 image_info["url_info"],
@@ -116,25 +280,37 @@ class AzureZipQueueConsumer:
             )
 
             can_be_zipped, fail_reason = file_can_be_zipped(metadata, image_info["url_info"], record["scope"])
+            files.append((iiif_url, image_info["url_info"], fail_reason, metadata))
+            if can_be_zipped:
+                try:
+                    zippable_filenames.append(image_server.get_filename(image_info["url_info"], metadata))
+                except image_server.FilenameNotFoundInDocumentInMetadataError:
+                    # The file is reported as excluded when it's downloaded
+                    pass
 
-            info_txt_contents = image_server.download_file_for_zip(
-                iiif_url,
-                info_txt_contents,
-                image_info["url_info"],
-                fail_reason,
-                metadata,
-                tmp_folder_path,
-            )
-        # Store the info_file_along_with_the_image_files
-        zip_tools.save_file_to_folder(tmp_folder_path, "report.txt", info_txt_contents)
-
-        # Zip all files together
-        zip_file_path = zip_tools.create_local_zip_file(zipjob_uuid, tmp_folder_path)
-        zip_file_name = os.path.basename(zip_file_path)
-
-        blob_client, blob_service_client = store_file_on_storage_account(
-            settings.STORAGE_ACCOUNT_CONTAINER_NAME, zip_file_path, zip_file_name
+        # Download the files concurrently and stream them into a zip on the storage account, which is uploaded
+        # while the files are being downloaded
+        blob_client, blob_service_client = get_blob_client(
+            settings.STORAGE_ACCOUNT_CONTAINER_NAME, f"{zipjob_uuid}.zip"
         )
+        checkpoint.verify(blob_client, zippable_filenames)
+        with (
+            BlobBlockWriter(
+                blob_client,
+                staged_blocks=checkpoint.staged_blocks,
+                block_id_prefix=checkpoint.block_id_prefix,
+                # Another consumer may be continuing the zip when the lease is lost
+                before_commit=lease.check if lease is not None else None,
+            ) as blob_stream,
+            zip_tools.ZipStreamWriter(blob_stream, zipjob_uuid, checkpoint) as zip_writer,
+        ):
+            info_txt_contents += "".join(image_server.download_files_for_zip(files, zip_writer))
+            # Store the info_file_along_with_the_image_files. It isn't one of the files which may be zipped, so a
+            # checkpoint which includes it would be discarded
+            zip_writer.add_file("report.txt", info_txt_contents, save_checkpoint=False)
+
+        if lease is not None:
+            lease.check()
 
         temp_zip_download_url = create_storage_account_temp_url(blob_client, blob_service_client)
 
@@ -143,5 +319,20 @@ class AzureZipQueueConsumer:
 
         mailing.send_email(record["email_address"], email_subject, email_body)
 
+        checkpoint.delete()
         remove_blob_from_storage_account(settings.STORAGE_ACCOUNT_CONTAINER_ZIP_QUEUE_JOBS_NAME, job_blob_name)
-        zip_tools.cleanup_local_files(zip_file_path, tmp_folder_path)
+
+
+queue_polls = meter.create_counter(
+    "zip_consumer.polls",
+    description="Receives from the zip queue, and whether they returned messages or the queue was empty",
+)
+received_messages = meter.create_counter(
+    "zip_consumer.received_messages",
+    description="Messages received from the zip queue",
+)
+queue_idle_time = meter.create_histogram(
+    "zip_consumer.idle_time",
+    unit="s",
+    description="Time waited before receiving again after the zip queue was empty",
+)
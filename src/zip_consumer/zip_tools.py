@@ -1,53 +1,307 @@
 import json
+import logging
 import os
-import shutil
-from pathlib import Path
+import threading
+import time
 from uuid import uuid4
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
-from utils.queue import get_queue_client
+from azure.core.exceptions import ResourceNotFoundError
+from django.conf import settings
+
+from utils.queue import get_queue_client, send_messages
+from utils.storage import (
+    get_blob_from_storage_account,
+    remove_blob_from_storage_account,
+    store_blob_on_storage_account,
+)
+
+log = logging.getLogger(__name__)
 
-TMP_BOUWDOSSIER_ZIP_FOLDER = "/tmp/bouwdossier-zips/"
 ZIP_MESSAGE_VERSION_NAME = "zip_job_v1"
 
+# The compression (type and level) of a file in a zip. Files which are compressed already hardly get smaller, so they
+# are stored as they are. Scanned TIFFs are big, and level 3 compresses them almost as well as level 6 for a third of
+# the CPU time (see tests/benchmark_zip_compression.py). Text and old office files are small, so they get level 6.
+STORED = (ZIP_STORED, None)
+DEFLATED_FAST = (ZIP_DEFLATED, 3)
+DEFLATED = (ZIP_DEFLATED, 6)
+COMPRESSION_BY_EXTENSION = {
+    ".jpg": STORED,
+    ".jpeg": STORED,
+    ".png": STORED,
+    ".pdf": STORED,
+    ".zip": STORED,
+    ".docx": STORED,
+    ".xlsx": STORED,
+    ".tif": DEFLATED_FAST,
+    ".tiff": DEFLATED_FAST,
+    ".txt": DEFLATED,
+    ".csv": DEFLATED,
+    ".xls": DEFLATED,
+    ".doc": DEFLATED,
+}
+COMPRESSION_BY_CONTENT_TYPE = {
+    "image/jpeg": STORED,
+    "image/png": STORED,
+    "application/pdf": STORED,
+    "application/zip": STORED,
+    "image/tiff": DEFLATED_FAST,
+    "text/plain": DEFLATED,
+    "text/csv": DEFLATED,
+    "application/vnd.ms-excel": DEFLATED,
+    "application/msword": DEFLATED,
+}
 
-def store_zip_job(job_name):
-    zip_job = json.dumps(
+# The attributes of a ZipInfo which are needed to write its record in the central directory of a zip
+ZIP_INFO_ATTRIBUTES = (
+    "date_time",
+    "compress_type",
+    "create_system",
+    "create_version",
+    "extract_version",
+    "reserved",
+    "flag_bits",
+    "volume",
+    "internal_attr",
+    "external_attr",
+    "header_offset",
+    "CRC",
+    "compress_size",
+    "file_size",
+)
+
+
+def create_zip_job_message(job_name):
+    return json.dumps(
         {
             "version": ZIP_MESSAGE_VERSION_NAME,
             "data": job_name,
         }
     )
 
+
+def store_zip_job(job_name):
     queue_client = get_queue_client()
-    queue_client.send_message(zip_job)
+    queue_client.send_message(create_zip_job_message(job_name))
+
+
+def store_zip_jobs(job_names):
+    """
+    Put many zip jobs on the queue at once, e.g. for a bulk submission. The blobs of the jobs should be stored
+    already.
+
+    :return: The names of the jobs which couldn't be put on the queue
+    """
+    errors = send_messages([create_zip_job_message(job_name) for job_name in job_names])
+    return [job_name for job_name, error in zip(job_names, errors) if error is not None]
+
+
+def create_zipjob_uuid():
+    return str(uuid4())
+
+
+def get_compression(filename, content_type=None):
+    """
+    Get the compression of a file in a zip by its extension or, when the extension is unknown, its content type.
+    Other files are stored as they are.
+
+    :return: Tuple of the compression type and level
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in COMPRESSION_BY_EXTENSION:
+        return COMPRESSION_BY_EXTENSION[extension]
+    if content_type:
+        return COMPRESSION_BY_CONTENT_TYPE.get(content_type.split(";")[0].strip().lower(), STORED)
+    return STORED
+
+
+def serialize_zip_info(zip_info):
+    data = {attribute: getattr(zip_info, attribute) for attribute in ZIP_INFO_ATTRIBUTES}
+    return data | {"filename": zip_info.filename, "extra": zip_info.extra.hex(), "comment": zip_info.comment.hex()}
+
+
+def deserialize_zip_info(data):
+    zip_info = ZipInfo(data["filename"])
+    for attribute in ZIP_INFO_ATTRIBUTES:
+        setattr(zip_info, attribute, data[attribute])
+    zip_info.date_time = tuple(data["date_time"])
+    zip_info.extra = bytes.fromhex(data["extra"])
+    zip_info.comment = bytes.fromhex(data["comment"])
+    return zip_info
+
+
+class ZipJobCheckpoint:
+    """
+    The progress of a zip job: the blocks of the zip which were staged on the storage account, and the entries of the
+    files which are in those blocks. It's saved in a blob next to the job blob every interval seconds, so when the job
+    is retried the zip can be continued from the last checkpoint, and only the other files have to be downloaded.
+
+    Every attempt of a job stages its blocks with its own block_id_prefix, so an attempt of which the lease was lost
+    can't overwrite the blocks which another attempt continues from.
+    """
+
+    def __init__(
+        self, job_blob_name, zipjob_uuid, staged_blocks=(), entries=(), interval=settings.ZIP_CHECKPOINT_INTERVAL
+    ):
+        self.blob_name = f"{job_blob_name}.checkpoint"
+        self.zipjob_uuid = zipjob_uuid
+        self.staged_blocks = list(staged_blocks)
+        self.entries = list(entries)
+        self.interval = interval
+        self.block_id_prefix = uuid4().hex[:8]
+        self.stored = bool(self.staged_blocks)
+        self._saved_at = time.monotonic()
+
+    @classmethod
+    def load(cls, job_blob_name, zipjob_uuid):
+        """
+        Get the checkpoint of a job, or a new checkpoint for a zip named zipjob_uuid when the job doesn't have one
+        """
+        try:
+            _, blob = get_blob_from_storage_account(
+                settings.STORAGE_ACCOUNT_CONTAINER_ZIP_QUEUE_JOBS_NAME, f"{job_blob_name}.checkpoint"
+            )
+        except ResourceNotFoundError:
+            return cls(job_blob_name, zipjob_uuid)
+
+        data = json.loads(blob)
+        checkpoint = cls(
+            job_blob_name,
+            data["zipjob_uuid"],
+            staged_blocks=[tuple(block) for block in data["staged_blocks"]],
+            entries=[deserialize_zip_info(entry) for entry in data["entries"]],
+        )
+        checkpoint.stored = True
+        log.info(f"Continuing zip {checkpoint.zipjob_uuid} with the {len(checkpoint.entries)} files of its checkpoint")
+        return checkpoint
+
+    @property
+    def filenames(self):
+        # The names of the files in the zip, without its folder
+        return {entry.filename.removeprefix(f"{self.zipjob_uuid}/") for entry in self.entries}
+
+    def restart(self):
+        # Start the zip from the beginning again, under the same name
+        self.staged_blocks = []
+        self.entries = []
+
+    def verify(self, blob_client, filenames):
+        """
+        Restart the zip when the checkpoint can't be continued: when its blocks aren't staged anymore (they are
+        removed when the zip is committed, or when they aren't committed within a week), or when it contains files
+        which may not be zipped anymore.
+
+        :param filenames: The names of the files which may be in the zip
+        """
+        if not self.staged_blocks:
+            return
+        _, uncommitted_blocks = blob_client.get_block_list("uncommitted")
+        sizes = {block.id: block.size for block in uncommitted_blocks}
+        if any(sizes.get(block_id) != size for block_id, size in self.staged_blocks):
+            log.warning(f"The blocks of the checkpoint of zip {self.zipjob_uuid} are gone, starting again")
+            self.restart()
+        elif not self.filenames <= set(filenames):
+            log.warning(f"The checkpoint of zip {self.zipjob_uuid} has files which may not be zipped, starting again")
+            self.restart()
+
+    def is_due(self):
+        return time.monotonic() - self._saved_at >= self.interval
+
+    def save(self, blob_stream, entries):
+        """
+        Save the progress of the zip after the given entries were written to blob_stream. The data which was written
+        is staged first, so the checkpoint doesn't depend on data which is still in memory.
+        """
+        self.staged_blocks = blob_stream.stage()
+        self.entries = list(entries)
+        self._saved_at = time.monotonic()
+        data = {
+            "zipjob_uuid": self.zipjob_uuid,
+            "staged_blocks": self.staged_blocks,
+            "entries": [serialize_zip_info(entry) for entry in self.entries],
+        }
+        try:
+            store_blob_on_storage_account(
+                settings.STORAGE_ACCOUNT_CONTAINER_ZIP_QUEUE_JOBS_NAME, self.blob_name, json.dumps(data)
+            )
+        except Exception as e:
+            # The job can go on without it, a retry just starts from an earlier checkpoint
+            log.warning(f"Could not save the checkpoint of zip {self.zipjob_uuid}: {e}")
+            return
+        self.stored = True
+        log.info(f"Saved the checkpoint of zip {self.zipjob_uuid} with {len(self.entries)} files")
+
+    def delete(self):
+        if not self.stored:
+            return
+        try:
+            remove_blob_from_storage_account(settings.STORAGE_ACCOUNT_CONTAINER_ZIP_QUEUE_JOBS_NAME, self.blob_name)
+        except ResourceNotFoundError:
+            pass
+        self.stored = False
+
+
+class ZipStreamWriter:
+    """
+    Writes a zip to a stream while the files are added, so the zip never has to be stored locally. The stream
+    doesn't need to be seekable. Files can be added from several threads; they are put in the zip in the order in
+    which they are added, in a folder named folder_name. Each file is compressed according to get_compression.
 
+    ZIP64 is enabled, so a zip can be bigger than 4 GB and have more than 65535 files. The ZIP64 records are only
+    written when they are needed, so smaller zips can be opened by any tool.
 
-def create_tmp_folder():
-    os.makedirs(TMP_BOUWDOSSIER_ZIP_FOLDER, exist_ok=True)
-    zipjob_uuid = str(uuid4())
-    tmp_folder_path = os.path.join(TMP_BOUWDOSSIER_ZIP_FOLDER, zipjob_uuid)
-    os.mkdir(tmp_folder_path)
-    return zipjob_uuid, tmp_folder_path
+    With a ZipJobCheckpoint the zip is continued after the files of the checkpoint, which should be in the data before
+    stream.tell(), and the checkpoint is saved when it's due after a file was added.
+    """
 
+    def __init__(self, stream, folder_name, checkpoint=None):
+        self.folder_name = folder_name
+        self.checkpoint = checkpoint
+        self._stream = stream
+        self._zip_file = ZipFile(stream, "w", allowZip64=True)
+        self._filenames = set()
+        self._lock = threading.Lock()
+        if checkpoint is not None:
+            for entry in checkpoint.entries:
+                self._zip_file.filelist.append(entry)
+                self._zip_file.NameToInfo[entry.filename] = entry
+            self._filenames.update(checkpoint.filenames)
 
-def save_file_to_folder(folder, filename, content):
-    file_path = os.path.join(folder, filename)
-    open_mode = "w" if isinstance(content, str) else "wb"
-    encoding = "utf-8" if "b" not in open_mode else None
-    with open(file_path, open_mode, encoding=encoding) as f:
-        f.write(content)
+    def __contains__(self, filename):
+        return filename in self._filenames
 
+    def add_file(self, filename, content, content_type=None, save_checkpoint=True):
+        """
+        Add a file to the zip, and save the checkpoint when it's due. A checkpoint with a file which isn't checked by
+        ZipJobCheckpoint.verify (like the report) can't be continued, so such a file should be added without saving
+        the checkpoint.
+        """
+        compress_type, compress_level = get_compression(filename, content_type)
+        with self._lock:
+            if filename in self._filenames:
+                # Several pages of the same file have the same filename, and the file only has to be zipped once
+                log.info(f"Not adding {filename} to the zip again")
+                return
+            self._filenames.add(filename)
+            self._zip_file.writestr(
+                os.path.join(self.folder_name, filename),
+                content,
+                compress_type=compress_type,
+                compresslevel=compress_level,
+            )
+            if save_checkpoint and self.checkpoint is not None and self.checkpoint.is_due():
+                self.checkpoint.save(self._stream, self._zip_file.filelist)
 
-def create_local_zip_file(zipjob_uuid, folder_path):
-    zip_file_path = os.path.join(TMP_BOUWDOSSIER_ZIP_FOLDER, f"{zipjob_uuid}.zip")
-    with ZipFile(zip_file_path, "w") as zip_obj:
-        for file in Path(folder_path).glob("*"):
-            zip_obj.write(file, arcname=os.path.join(zipjob_uuid, file.name))
-    return zip_file_path
+    def close(self):
+        # Writes the central directory at the end of the zip
+        with self._lock:
+            self._zip_file.close()
 
+    def __enter__(self):
+        return self
 
-def cleanup_local_files(zip_file_path, tmp_folder_path):
-    # Cleanup the local zip file and folder with images
-    os.remove(zip_file_path)
-    shutil.rmtree(tmp_folder_path)
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An incomplete zip isn't used, so it doesn't need a central directory
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,9 @@
+from django.urls import include, path
+
+from iiif import views
+
+# The urls as served through ASGI, with the async variant of the iiif endpoint
+urlpatterns = [
+    path("iiif/<path:iiif_url>", views.index_async, name="iiif_endpoint"),
+    path("", include("main.urls")),
+]
@@ -0,0 +1,40 @@
+"""
+Micro-benchmark of the iiif url parser against the legacy parser. Run from the root of the repository with the
+same environment as the tests, e.g.:
+
+    python tests/benchmark_parsing.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src"), os.path.join(os.path.dirname(__file__), "..")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from iiif import parsing  # noqa: E402
+from tests import legacy_parsing  # noqa: E402
+
+URLS = [
+    "2/edepot:ST_00015~ST00000126_1/info.json",
+    "2/edepot:ST_00015~ST00000126_1@2/full/1000,900/0/default.jpg",
+    "2/wabo:SDZ_TA-38657~628547_1/full/full/0/default.jpg",
+    "2/wabo:SDO_10316333~ECS0000004420-000-00-00_2/24,24,48,48/full/0/default.jpg",
+]
+NUMBER = 100_000
+
+
+def benchmark(name, function):
+    seconds = min(timeit.repeat(lambda: [function(url, False) for url in URLS], number=NUMBER // len(URLS), repeat=5))
+    print(f"{name:<45} {seconds / NUMBER * 1_000_000:.2f} µs per url")
+
+
+if __name__ == "__main__":
+    benchmark("legacy get_info_from_iiif_url", legacy_parsing.get_info_from_iiif_url)
+    benchmark("parse_iiif_url (uncached)", parsing.parse_iiif_url.__wrapped__)
+    benchmark("parse_iiif_url (cached)", parsing.parse_iiif_url)
+    benchmark("get_info_from_iiif_url (cached, as dict)", parsing.get_info_from_iiif_url)
@@ -0,0 +1,95 @@
+"""
+Benchmark of the compression of the files in a zip, on a set of files like those in the bouwdossiers. Compares
+storing everything, deflating everything and the compression policy of zip_tools. Run from the root of the repository
+with the same environment as the tests, e.g.:
+
+    python tests/benchmark_zip_compression.py
+"""
+
+import os
+import random
+import sys
+import time
+from io import BytesIO
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "src"), os.path.join(os.path.dirname(__file__), "..")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+from zip_consumer import zip_tools  # noqa: E402
+
+REPEAT = 3
+
+
+def create_scanned_page(width=2480, height=3508):
+    # An A4 page at 300 dpi with lines of "words" and some scanner noise
+    random.seed(1)
+    page = Image.new("L", (width, height), 235)
+    draw = ImageDraw.Draw(page)
+    for y in range(200, height - 200, 60):
+        x = 200
+        while x < width - 300:
+            word_width = random.randint(30, 200)
+            draw.rectangle([x, y, x + word_width, y + 30], fill=random.randint(20, 80))
+            x += word_width + 25
+    page = page.filter(ImageFilter.GaussianBlur(1))
+    return Image.blend(page, Image.effect_noise((width, height), 12), 0.15)
+
+
+def save(image, file_format, **options):
+    stream = BytesIO()
+    image.save(stream, file_format, **options)
+    return stream.getvalue()
+
+
+def create_files():
+    page = create_scanned_page()
+    with open(os.path.join(os.path.dirname(__file__), "test-images", "test-image-pyramid-2-pages.tif"), "rb") as f:
+        pyramid_tiff = f.read()
+    files = {f"page_{i}.jpg": save(page.rotate(i * 0.5).convert("RGB"), "JPEG", quality=85) for i in range(4)} | {
+        "drawing.png": save(page.point(lambda value: 255 if value > 128 else 0), "PNG"),
+        "permit.pdf": save(page.convert("RGB"), "PDF", quality=85),
+        "scan_grayscale.tif": save(page, "TIFF"),
+        "scan_bilevel.tif": save(page.point(lambda value: 255 if value > 128 else 0).convert("1"), "TIFF"),
+        "pyramid.tif": pyramid_tiff,
+        "report.txt": "".join(f"SJ10027690_{i:05d}.jpg: included\n" for i in range(500)).encode(),
+    }
+    return files
+
+
+def create_zip(files, get_compression):
+    stream = BytesIO()
+    with ZipFile(stream, "w", allowZip64=True) as zip_file:
+        for filename, content in files.items():
+            compress_type, compress_level = get_compression(filename)
+            zip_file.writestr(filename, content, compress_type=compress_type, compresslevel=compress_level)
+    return stream.getvalue()
+
+
+def benchmark(name, files, get_compression):
+    megabytes = sum(len(content) for content in files.values()) / 1_000_000
+    cpu_times = []
+    for _ in range(REPEAT):
+        start = time.process_time()
+        zip_content = create_zip(files, get_compression)
+        cpu_times.append(time.process_time() - start)
+    cpu_time = min(cpu_times)
+    print(
+        f"{name:<25} {cpu_time / megabytes * 1000:6.1f} ms CPU per MB   "
+        f"{len(zip_content) / 1_000_000:6.2f} MB ({len(zip_content) / 1_000_000 / megabytes:.0%})"
+    )
+
+
+if __name__ == "__main__":
+    files = create_files()
+    print(f"{len(files)} files, {sum(len(content) for content in files.values()) / 1_000_000:.2f} MB")
+    benchmark("stored", files, lambda filename: (ZIP_STORED, None))
+    benchmark("deflated, level 6", files, lambda filename: (ZIP_DEFLATED, 6))
+    benchmark("deflated, level 3", files, lambda filename: (ZIP_DEFLATED, 3))
+    benchmark("compression policy", files, zip_tools.get_compression)
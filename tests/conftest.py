@@ -3,6 +3,12 @@ from pathlib import Path
 from typing import Callable
 
 import pytest
+from django.core.cache import caches
+
+from core.auth.decisions import access_decision_cache
+from core.auth.jwt_tokens import decoded_token_cache
+from iiif import upstream
+from utils import storage
 
 
 @pytest.fixture
@@ -13,3 +19,20 @@ def test_image_data_factory() -> Callable[[str], bytes]:
         return image_path.read_bytes()
 
     return _get_image
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # Make sure nothing cached in one test can influence another test
+    for cache in caches.all():
+        cache.clear()
+    decoded_token_cache.clear()
+    access_decision_cache.clear()
+    storage._user_delegation_keys.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers():
+    # Failures simulated in one test shouldn't open a circuit in another test
+    for breaker in upstream.circuit_breakers.values():
+        breaker.reset()
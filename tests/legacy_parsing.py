@@ -0,0 +1,50 @@
+"""
+The iiif url parser as it was before it was replaced by the precompiled parser in iiif.parsing. It is only kept to
+check that both parsers give the same results, and to benchmark them against each other.
+"""
+
+from iiif.parsing import PAGE_SEPARATOR, InvalidIIIFUrlError
+
+
+def get_info_from_iiif_url(iiif_url, source_file):
+    try:
+        source = iiif_url.split(":")[0].split("/")[1]  # "edepot" or "wabo"
+        relevant_url_part = iiif_url.split(":")[1].split("/")[0].replace(" ", "%20")
+        formatting = iiif_url.split(":")[1].split("/", 1)[1].split("?")[0] if "/" in iiif_url.split(":")[1] else ""
+
+        info_json = False
+        scaling = None
+        region = None
+        if formatting == "info.json":
+            info_json = True
+            formatting = None
+        elif "/" in formatting:
+            region = formatting.split("/")[0]
+            scaling = formatting.split("/")[1]
+        elif source_file:
+            pass
+        else:
+            raise InvalidIIIFUrlError(f"No formatting or info.json provided in iiif url: {iiif_url}")
+
+        url_info = {
+            "source": source,
+            "formatting": formatting,
+            "region": region,
+            "scaling": scaling,
+            "info_json": info_json,  # Whether the info.json is requested instead of the image itself
+        }
+        stadsdeel_dossier, olo_and_document = relevant_url_part.split("~")
+        stadsdeel, dossier = stadsdeel_dossier.split("_")
+        document_barcode, file_and_page = olo_and_document.split("_")
+        filenr, _, page = file_and_page.partition(PAGE_SEPARATOR)
+        return {
+            **url_info,
+            "stadsdeel": stadsdeel,
+            "dossier": dossier,
+            "document_barcode": document_barcode,
+            "filenr": filenr,
+            "page": int(page) if page else None,
+        }
+
+    except Exception as e:
+        raise InvalidIIIFUrlError(f"Invalid iiif url: {iiif_url}") from e
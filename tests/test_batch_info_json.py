@@ -0,0 +1,207 @@
+import json
+from unittest.mock import patch
+
+from django.conf import settings
+
+from core.auth.constants import RESPONSE_CONTENT_COPYRIGHT, RESPONSE_CONTENT_RESTRICTED
+from core.auth.jwt_tokens import create_mail_login_token
+from tests.test_settings import PRE_WABO_INFO_JSON_URL, PRE_WABO_METADATA_CONTENT
+from tests.tools import MockResponse, create_authz_token
+
+BATCH_METADATA_CONTENT = {
+    "access": settings.ACCESS_PUBLIC,
+    "documenten": [
+        {
+            "barcode": "ST00000126",
+            "access": settings.ACCESS_PUBLIC,
+            "bestanden": [
+                {"filename": "ST00000126_1.jpg", "file_pad": "ST/15/ST00000126_1.jpg"},
+                {"filename": "ST00000126_2.jpg", "file_pad": "ST/15/ST00000126_2.jpg"},
+            ],
+        },
+        {
+            "barcode": "ST00000127",
+            "access": settings.ACCESS_PUBLIC,
+            "copyright": settings.COPYRIGHT_YES,
+            "bestanden": [{"filename": "ST00000127.jpg", "file_pad": "ST/15/ST00000127.jpg"}],
+        },
+        {
+            "barcode": "ST00000128",
+            "access": settings.ACCESS_RESTRICTED,
+            "bestanden": [{"filename": "ST00000128.jpg", "file_pad": "ST/15/ST00000128.jpg"}],
+        },
+    ],
+}
+
+
+class TestBatchInfoJson:
+    def setup_method(self):
+        self.url = "/iiif/info/"
+        self.read_header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_get_info_jsons_for_dossier(
+        self,
+        mock_do_metadata_request,
+        mock_requests_get,
+        client,
+        test_image_data_factory,
+    ):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+
+        response = client.get(self.url, {"dossier": "edepot:ST_00015"}, **self.read_header)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/json"
+
+        content = json.loads(response.content)
+        assert sorted(content["info_jsons"]) == [
+            "2/edepot:ST_00015~ST00000126_0",
+            "2/edepot:ST_00015~ST00000126_1",
+            "2/edepot:ST_00015~ST00000127_0",
+        ]
+        info_json = content["info_jsons"]["2/edepot:ST_00015~ST00000126_1"]
+        assert info_json["@id"] == "http://testserver/iiif/2/edepot:ST_00015~ST00000126_1"
+        assert info_json["width"] == 96
+        assert info_json["height"] == 85
+        assert content["errors"] == {
+            "2/edepot:ST_00015~ST00000128_0": {"status": 401, "message": RESPONSE_CONTENT_RESTRICTED},
+        }
+
+        # One metadata request for the whole dossier and one request per accessible file
+        assert mock_do_metadata_request.call_count == 1
+        assert mock_requests_get.call_count == 3
+
+        # The second time all dimensions come from the cache
+        response = client.get(self.url, {"dossier": "edepot:ST_00015"}, **self.read_header)
+        assert response.status_code == 200
+        assert mock_requests_get.call_count == 3
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_get_info_jsons_for_urls(
+        self,
+        mock_do_metadata_request,
+        mock_requests_get,
+        client,
+        test_image_data_factory,
+    ):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+
+        mail_login_token = create_mail_login_token("batch@amsterdam.nl", settings.SECRET_KEY)
+        response = client.post(
+            self.url + "?auth=" + mail_login_token,
+            json.dumps(
+                {
+                    "urls": [
+                        "https://bouwdossiers.amsterdam.nl/iiif/2/edepot:ST_00015~ST00000126_0/info.json",
+                        "2/edepot:ST_00015~ST00000127_0",
+                    ]
+                }
+            ),
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+        assert "no-cache" in response.headers["Cache-Control"]
+
+        content = json.loads(response.content)
+        assert list(content["info_jsons"]) == ["2/edepot:ST_00015~ST00000126_0"]
+        assert content["errors"] == {
+            "2/edepot:ST_00015~ST00000127_0": {"status": 401, "message": RESPONSE_CONTENT_COPYRIGHT},
+        }
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_get_info_jsons_with_failing_file(
+        self,
+        mock_do_metadata_request,
+        mock_requests_get,
+        client,
+        test_image_data_factory,
+    ):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+
+        def side_effect(url, *args, **kwargs):
+            if "st00000126_2" in url.lower():
+                return MockResponse(404)
+            return MockResponse(
+                200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+            )
+
+        mock_requests_get.side_effect = side_effect
+
+        response = client.post(
+            self.url,
+            json.dumps({"urls": ["2/edepot:ST_00015~ST00000126_0", "2/edepot:ST_00015~ST00000126_1"]}),
+            content_type="application/json",
+            **self.read_header,
+        )
+        assert response.status_code == 200
+
+        content = json.loads(response.content)
+        assert list(content["info_jsons"]) == ["2/edepot:ST_00015~ST00000126_0"]
+        assert content["errors"]["2/edepot:ST_00015~ST00000126_1"]["status"] == 404
+
+    @patch("iiif.metadata.do_metadata_request")
+    def test_metadata_is_requested_once_per_failing_dossier(self, mock_do_metadata_request, client):
+        mock_do_metadata_request.return_value = MockResponse(500)
+
+        response = client.post(
+            self.url,
+            json.dumps({"urls": ["2/edepot:ST_00015~ST00000126_0", "2/edepot:ST_00015~ST00000126_1"]}),
+            content_type="application/json",
+            **self.read_header,
+        )
+        assert response.status_code == 200
+        assert len(json.loads(response.content)["errors"]) == 2
+        assert mock_do_metadata_request.call_count == 1
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_dossier_with_too_many_files(self, mock_do_metadata_request, mock_requests_get, client, settings):
+        settings.BATCH_INFO_JSON_MAX_FILES = 3
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+
+        response = client.get(self.url, {"dossier": "edepot:ST_00015"}, **self.read_header)
+
+        # The dossier has 4 files, which is only known after its metadata was retrieved
+        assert response.status_code == 400
+        assert response.content == b"No more than 3 files allowed, the request is for 4 files"
+        mock_requests_get.assert_not_called()
+
+    def test_invalid_payloads(self, client):
+        response = client.get(self.url, **self.read_header)
+        assert response.status_code == 400
+
+        response = client.get(self.url, {"dossier": "ST_00015"}, **self.read_header)
+        assert response.status_code == 400
+
+        response = client.get(self.url, {"dossier": "somewhere:ST_00015"}, **self.read_header)
+        assert response.status_code == 400
+
+    def test_without_token(self, client):
+        response = client.get(self.url, {"dossier": "edepot:ST_00015"})
+        assert response.status_code == 401
+
+
+@patch("requests.get")
+@patch("iiif.metadata.do_metadata_request")
+def test_info_json_uses_cached_dimensions(mock_do_metadata_request, mock_requests_get, client, test_image_data_factory):
+    mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+    mock_requests_get.return_value = MockResponse(
+        200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+    )
+    header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    first_response = client.get("/iiif/" + PRE_WABO_INFO_JSON_URL, **header)
+    second_response = client.get("/iiif/" + PRE_WABO_INFO_JSON_URL, **header)
+
+    assert first_response.status_code == 200
+    assert json.loads(first_response.content) == json.loads(second_response.content)
+    assert mock_requests_get.call_count == 1
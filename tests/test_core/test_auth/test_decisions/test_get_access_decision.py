@@ -0,0 +1,80 @@
+from unittest.mock import patch
+
+import pytest
+from django.conf import settings
+
+from core.auth.constants import RESPONSE_CONTENT_COPYRIGHT, RESPONSE_CONTENT_NO_WABO_WITH_MAIL_LOGIN
+from core.auth.decisions import AccessDecision, access_decision_cache, decide_access, get_access_decision
+from main.utils import ImmediateHttpResponse
+
+METADATA = {
+    "access": settings.ACCESS_PUBLIC,
+    "documenten": [
+        {"barcode": "ST00001", "access": settings.ACCESS_PUBLIC},
+        {"barcode": "ST00002", "access": settings.ACCESS_PUBLIC, "copyright": settings.COPYRIGHT_YES},
+    ],
+}
+
+
+def get_url_info(barcode, source="edepot"):
+    return {"source": source, "stadsdeel": "ST", "dossier": "00015", "document_barcode": barcode, "filenr": "0"}
+
+
+@pytest.mark.parametrize(
+    "url_info, scope, is_mail_login, expected",
+    [
+        (get_url_info("ST00001"), settings.BOUWDOSSIER_PUBLIC_SCOPE, True, AccessDecision(None, None, True)),
+        (get_url_info("ST00002"), settings.BOUWDOSSIER_READ_SCOPE, False, AccessDecision(None, None, False)),
+        (
+            get_url_info("ST00002"),
+            settings.BOUWDOSSIER_PUBLIC_SCOPE,
+            True,
+            AccessDecision(401, RESPONSE_CONTENT_COPYRIGHT, False),
+        ),
+        (
+            get_url_info("ST00001", source="wabo"),
+            settings.BOUWDOSSIER_PUBLIC_SCOPE,
+            True,
+            AccessDecision(401, RESPONSE_CONTENT_NO_WABO_WITH_MAIL_LOGIN, False),
+        ),
+    ],
+)
+def test_decide_access(url_info, scope, is_mail_login, expected):
+    """The decision should contain both whether access is allowed and whether the response is cacheable"""
+    assert decide_access(METADATA, url_info, scope, is_mail_login) == expected
+
+
+def test_decision_is_cached_per_metadata_version():
+    """The decision should only be made once for the same metadata version"""
+    with patch("core.auth.decisions.decide_access", wraps=decide_access) as mock_decide_access:
+        for filenr in ("0", "1"):
+            url_info = {**get_url_info("ST00001"), "filenr": filenr}
+            decision = get_access_decision(METADATA, "v1", url_info, settings.BOUWDOSSIER_READ_SCOPE, False)
+            assert decision.is_allowed
+        assert mock_decide_access.call_count == 1
+
+        get_access_decision(METADATA, "v2", get_url_info("ST00001"), settings.BOUWDOSSIER_READ_SCOPE, False)
+        assert mock_decide_access.call_count == 2
+
+        get_access_decision(METADATA, "v2", get_url_info("ST00001"), settings.BOUWDOSSIER_PUBLIC_SCOPE, True)
+        assert mock_decide_access.call_count == 3
+
+
+def test_denied_decision_raises():
+    """A cached denial should result in the same response as the uncached check"""
+    for _ in range(2):
+        decision = get_access_decision(METADATA, "v1", get_url_info("ST00002"), settings.BOUWDOSSIER_PUBLIC_SCOPE, True)
+        with pytest.raises(ImmediateHttpResponse) as e:
+            decision.raise_if_denied()
+        assert e.value.response.status_code == 401
+        assert e.value.response.content.decode("utf-8") == RESPONSE_CONTENT_COPYRIGHT
+
+
+def test_decisions_are_kept_in_memory(settings):
+    """The decisions are kept per process, and expire with the metadata"""
+    settings.METADATA_CACHE_TIMEOUT = 0
+    with patch("core.auth.decisions.decide_access", wraps=decide_access) as mock_decide_access:
+        for _ in range(2):
+            get_access_decision(METADATA, "v1", get_url_info("ST00001"), settings.BOUWDOSSIER_READ_SCOPE, False)
+        assert mock_decide_access.call_count == 2
+    assert len(access_decision_cache) == 1
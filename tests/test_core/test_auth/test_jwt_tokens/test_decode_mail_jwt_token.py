@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import jwt
+import pytest
+import time_machine
+from django.conf import settings
+
+from core.auth.constants import RESPONSE_CONTENT_INVALID_SCOPE
+from core.auth.jwt_tokens import create_mail_login_token, decode_mail_jwt_token, decoded_token_cache
+from main.utils import ImmediateHttpResponse
+
+
+def test_valid_token_is_decoded_once():
+    """A valid token should only be verified the first time it is used"""
+    token = create_mail_login_token("test@amsterdam.nl", settings.JWT_SECRET_KEY)
+
+    with patch("core.auth.jwt_tokens.jwt.decode", wraps=jwt.decode) as mock_decode:
+        first = decode_mail_jwt_token(token)
+        second = decode_mail_jwt_token(token)
+
+    assert first == second
+    assert first["sub"] == "test@amsterdam.nl"
+    assert mock_decode.call_count == 1
+
+
+def test_cached_token_can_not_be_changed():
+    """Changing the returned claims should not change the cached claims"""
+    token = create_mail_login_token("test@amsterdam.nl", settings.JWT_SECRET_KEY)
+
+    decode_mail_jwt_token(token)["scopes"] = [settings.BOUWDOSSIER_EXTENDED_SCOPE]
+
+    assert decode_mail_jwt_token(token)["scopes"] == [settings.BOUWDOSSIER_PUBLIC_SCOPE]
+
+
+def test_cached_token_expires_exactly():
+    """A cached token should be rejected from the moment it expires"""
+    token = create_mail_login_token("test@amsterdam.nl", settings.JWT_SECRET_KEY, expiry_hours=1)
+    exp = decode_mail_jwt_token(token)["exp"]
+
+    with time_machine.travel(datetime.fromtimestamp(exp - 0.5, tz=timezone.utc), tick=False):
+        assert decode_mail_jwt_token(token)["exp"] == exp
+
+    with time_machine.travel(datetime.fromtimestamp(exp, tz=timezone.utc), tick=False):
+        with pytest.raises(ImmediateHttpResponse) as e:
+            decode_mail_jwt_token(token)
+        assert e.value.response.content == b"Expired JWT token signature"
+
+
+@pytest.mark.parametrize(
+    "token, key",
+    [
+        ("not-a-token", settings.JWT_SECRET_KEY),
+        (None, "another-key"),
+    ],
+)
+def test_invalid_tokens_are_not_cached(token, key):
+    """Invalid tokens should be rejected every time"""
+    token = token or create_mail_login_token("test@amsterdam.nl", key)
+
+    for _ in range(2):
+        with pytest.raises(ImmediateHttpResponse):
+            decode_mail_jwt_token(token)
+    assert len(decoded_token_cache) == 0
+
+
+@pytest.mark.parametrize("scopes", [{"scopes": ["BD/Z"]}, {"scopes": []}, {"scopes": None}, {}])
+def test_token_with_invalid_scope_is_rejected(scopes):
+    """A token with a scope which doesn't exist, or without any scope, should be rejected and not cached"""
+    exp = int((datetime.now(timezone.utc) + timedelta(hours=1)).timestamp())
+    token = jwt.encode(
+        {"sub": "test@amsterdam.nl", "exp": exp, **scopes},
+        settings.JWT_SECRET_KEY,
+        algorithm=settings.JWT_ALGORITHM,
+    )
+
+    with pytest.raises(ImmediateHttpResponse) as e:
+        decode_mail_jwt_token(token)
+    assert e.value.response.status_code == 401
+    assert e.value.response.content.decode("utf-8") == RESPONSE_CONTENT_INVALID_SCOPE
+    assert len(decoded_token_cache) == 0
@@ -0,0 +1,109 @@
+import time
+from unittest.mock import patch
+
+import pytest
+from django.conf import settings
+from requests.exceptions import ConnectionError, Timeout
+
+from iiif.deadline import Deadline
+from main.utils import ImmediateHttpResponse
+from tests.test_settings import PRE_WABO_IMG_URL_WITH_SCALING, PRE_WABO_METADATA_CONTENT
+from tests.tools import MockResponse, create_authz_token
+
+
+class TestDeadline:
+    def test_timeout_is_limited_to_remaining_time(self):
+        deadline = Deadline(10)
+        assert deadline.timeout(5, 25, "testing") == (5, pytest.approx(10, abs=0.1))
+        assert deadline.timeout(5, 3, "testing") == (5, 3)
+        assert not deadline.expired
+
+    def test_expired_deadline(self):
+        deadline = Deadline(0)
+        assert deadline.expired
+        with pytest.raises(ImmediateHttpResponse) as e:
+            deadline.check("testing")
+        assert e.value.response.status_code == 504
+        assert b"while testing" in e.value.response.content
+
+        with pytest.raises(ImmediateHttpResponse):
+            deadline.timeout(5, 25, "testing")
+
+
+class TestIndexDeadline:
+    def setup_method(self):
+        self.url = "/iiif/" + PRE_WABO_IMG_URL_WITH_SCALING
+        self.header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_file_variants_share_the_remaining_time(self, mock_do_metadata_request, mock_requests_get, client):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(404)
+
+        response = client.get(self.url, **self.header)
+        assert response.status_code == 404
+
+        metadata_timeout = mock_do_metadata_request.call_args.args[1]
+        assert metadata_timeout[0] == 15
+        assert metadata_timeout[1] == 25
+
+        read_timeouts = [call.kwargs["timeout"][1] for call in mock_requests_get.call_args_list]
+        assert len(read_timeouts) == 2
+        # The first variant gets half of the time which is left, the last variant all of it
+        assert read_timeouts[0] == pytest.approx(settings.REQUEST_DEADLINE / 2, abs=0.5)
+        assert read_timeouts[-1] == pytest.approx(settings.REQUEST_DEADLINE, abs=0.5)
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_504_when_file_retrieval_runs_out_of_time(
+        self, mock_do_metadata_request, mock_requests_get, client, settings
+    ):
+        settings.REQUEST_DEADLINE = 0.05
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+
+        def slow_request(*args, **kwargs):
+            time.sleep(0.06)
+            raise Timeout()
+
+        mock_requests_get.side_effect = slow_request
+
+        response = client.get(self.url, **self.header)
+        assert response.status_code == 504
+        # The other variants are not tried when there is no time left
+        assert mock_requests_get.call_count == 1
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_504_when_metadata_runs_out_of_time(self, mock_do_metadata_request, mock_requests_get, client, settings):
+        settings.REQUEST_DEADLINE = 0.05
+
+        def slow_request(*args, **kwargs):
+            time.sleep(0.06)
+            raise ConnectionError()
+
+        mock_do_metadata_request.side_effect = slow_request
+
+        response = client.get(self.url, **self.header)
+        assert response.status_code == 504
+        mock_requests_get.assert_not_called()
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_504_before_image_processing(
+        self, mock_do_metadata_request, mock_requests_get, client, settings, test_image_data_factory
+    ):
+        settings.REQUEST_DEADLINE = 0.05
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+
+        def slow_request(*args, **kwargs):
+            time.sleep(0.06)
+            return MockResponse(
+                200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+            )
+
+        mock_requests_get.side_effect = slow_request
+
+        response = client.get(self.url, **self.header)
+        assert response.status_code == 504
+        assert b"processing the image" in response.content
@@ -0,0 +1,129 @@
+import os
+import shutil
+from io import BytesIO
+from unittest.mock import patch
+from zipfile import ZipFile
+
+import pytest
+
+from iiif import image_server
+from tests.test_image_server import get_zip_files
+from tests.tools import MockResponse
+from zip_consumer.file_cache import FileCache, get_file_cache
+from zip_consumer.zip_tools import ZipStreamWriter
+
+
+class TestFileCache:
+    def test_least_recently_used_files_are_removed(self, tmp_path):
+        file_cache = FileCache(tmp_path, max_size=250)
+        file_cache.set("a", b"a" * 100, {"ETag": '"a"'})
+        file_cache.set("b", b"b" * 100, {"Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"})
+        assert file_cache.read("a", file_cache.get("a")) == b"a" * 100
+
+        file_cache.set("c", b"c" * 100, {"ETag": '"c"', "Content-Type": "image/jpeg"})
+
+        assert file_cache.get("b") is None
+        entry = file_cache.get("c")
+        assert (entry.content_type, entry.etag, entry.last_modified) == ("image/jpeg", '"c"', None)
+        assert file_cache.read("c", entry) == b"c" * 100
+        assert file_cache.size == 200
+        assert len(os.listdir(tmp_path)) == 2
+
+    def test_files_which_cant_be_validated_are_not_cached(self, tmp_path):
+        file_cache = FileCache(tmp_path, max_size=250)
+        file_cache.set("a", b"a" * 100, {"Content-Type": "image/jpeg"})
+        file_cache.set("b", b"b" * 300, {"ETag": '"b"'})
+
+        assert len(file_cache) == 0
+        assert os.listdir(tmp_path) == []
+
+    def test_changed_file_replaces_cached_file(self, tmp_path):
+        file_cache = FileCache(tmp_path, max_size=250)
+        file_cache.set("a", b"a" * 100, {"ETag": '"1"'})
+        file_cache.set("a", b"a" * 50, {"ETag": '"2"'})
+
+        assert file_cache.get("a").validators == {"If-None-Match": '"2"'}
+        assert file_cache.size == 50
+        assert len(os.listdir(tmp_path)) == 1
+
+    def test_replaced_file_is_not_read(self, tmp_path):
+        file_cache = FileCache(tmp_path, max_size=250)
+        file_cache.set("a", b"a" * 100, {"ETag": '"1"'})
+        entry = file_cache.get("a")
+        # Another job cached a newer version after the validators of this one were sent
+        file_cache.set("a", b"a" * 50, {"ETag": '"2"'})
+
+        assert file_cache.read("a", entry) is None
+
+
+def test_file_cache_directory_is_removed_at_exit(settings, tmp_path):
+    settings.ZIP_FILE_CACHE_DIR = str(tmp_path)
+    get_file_cache.cache_clear()
+    try:
+        with patch("atexit.register") as mock_register:
+            file_cache = get_file_cache()
+    finally:
+        get_file_cache.cache_clear()
+
+    assert os.path.dirname(file_cache.directory) == str(tmp_path)
+    mock_register.assert_called_once_with(shutil.rmtree, file_cache.directory, ignore_errors=True)
+
+
+class TestZipFromFileCache:
+    @pytest.fixture(autouse=True)
+    def file_cache(self, tmp_path):
+        file_cache = FileCache(tmp_path, max_size=1000)
+        with patch("iiif.image_server.get_file_cache", return_value=file_cache):
+            yield file_cache
+
+    def get_response(self, url, headers, **kwargs):
+        if headers.get("If-None-Match") == '"1"':
+            return MockResponse(304, content=b"")
+        return MockResponse(200, content=url.encode(), headers={"ETag": '"1"', "Content-Type": "image/jpeg"})
+
+    @patch("requests.get")
+    def test_unchanged_files_are_not_downloaded_again(self, mock_requests_get):
+        mock_requests_get.side_effect = self.get_response
+        url_info, metadata = get_zip_files()[0][1], get_zip_files()[0][3]
+
+        first = image_server.get_file_content_for_zip(url_info, metadata)
+        second = image_server.get_file_content_for_zip(url_info, metadata)
+
+        assert first == second
+        assert first[0].endswith(b"/ST/15/FILE_0.jpg")
+        assert first[1] == "image/jpeg"
+        # The second request was conditional and returned no content
+        assert mock_requests_get.call_count == 2
+        assert mock_requests_get.call_args.kwargs["headers"]["If-None-Match"] == '"1"'
+
+    @patch("requests.get")
+    def test_file_is_downloaded_again_when_it_was_removed_from_the_cache(self, mock_requests_get, file_cache):
+        mock_requests_get.side_effect = self.get_response
+        url_info, metadata = get_zip_files()[0][1], get_zip_files()[0][3]
+        image_server.get_file_content_for_zip(url_info, metadata)
+
+        # Another job removes the file after the conditional request was sent
+        with patch.object(file_cache, "read", return_value=None):
+            content, content_type = image_server.get_file_content_for_zip(url_info, metadata)
+
+        assert content.endswith(b"/ST/15/FILE_0.jpg")
+        assert mock_requests_get.call_count == 3
+        assert "If-None-Match" not in mock_requests_get.call_args.kwargs["headers"]
+
+    @patch("requests.get")
+    def test_cached_files_are_authorized_per_job(self, mock_requests_get, file_cache):
+        mock_requests_get.side_effect = self.get_response
+        with ZipStreamWriter(BytesIO(), "job") as zip_writer:
+            image_server.download_files_for_zip(get_zip_files(), zip_writer)
+        assert len(file_cache) == 6
+
+        # Another user may not zip file 4, although it's in the cache
+        stream = BytesIO()
+        with ZipStreamWriter(stream, "job") as zip_writer:
+            report = image_server.download_files_for_zip(get_zip_files({4: "restricted"}), zip_writer)
+
+        assert report[4] == "file_4.jpg: excluded, restricted\n"
+        with ZipFile(stream) as zip_file:
+            assert "job/file_4.jpg" not in zip_file.namelist()
+            assert len(zip_file.namelist()) == 5
+        assert mock_requests_get.call_count == 11
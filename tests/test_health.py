@@ -28,3 +28,17 @@ class TestViews(SimpleTestCase):
         response = self.http_client.get("/iiif/status/health")
         assert response.status_code == 500
         assert response.content == b"Debug mode not allowed in production"
+
+    def test_upstreams_view(self):
+        response = self.http_client.get("/iiif/status/health/upstreams")
+        assert response.status_code == 200
+        content = response.json()
+        assert set(content) == {"edepot", "wabo", "metadata"}
+        assert content["edepot"] == {
+            "state": "closed",
+            "calls": 0,
+            "failures": 0,
+            "slow_calls": 0,
+            "active": 0,
+            "waiting": 0,
+        }
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+from requests.exceptions import ConnectionError
+
+from iiif import parsing, upstream
+from iiif.hedging import Hedger
+from iiif.image_server import get_file
+from iiif.upstream import Bulkhead
+from tests.test_image_server_timeouts import ONE_PRE_WABO_METADATA_CONTENT
+from tests.test_settings import PRE_WABO_IMG_URL_BASE
+from tests.tools import MockResponse
+
+
+def create_hedger(**kwargs):
+    options = {
+        "percentile": 90,
+        "default_delay": 0.05,
+        "min_delay": 0.01,
+        "window_size": 10,
+        "min_samples": 5,
+        "max_ratio": 1,
+    }
+    return Hedger("edepot", **(options | kwargs))
+
+
+def wait_until_idle(hedger):
+    # The losing request keeps running in the background for a while
+    for _ in range(100):
+        if hedger.primaries == hedger.hedges == 0:
+            return
+        time.sleep(0.01)
+    raise AssertionError("The requests of the hedger are still running")
+
+
+class SlowThenFast:
+    """Every first request is slow, the requests after it are fast"""
+
+    def __init__(self, delay=0.3, error=None):
+        self.delay = delay
+        self.error = error
+        self.responses = []
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            is_first = not self.responses
+            response = MockResponse(200, content=b"slow" if is_first else b"fast")
+            self.responses.append(response)
+        if is_first:
+            time.sleep(self.delay)
+            if self.error:
+                raise self.error
+        return response
+
+
+class TestHedger:
+    def test_delay_is_a_percentile_of_recent_latencies(self):
+        hedger = create_hedger()
+        for latency in (0.1, 0.2, 0.3, 0.4):
+            hedger.record_latency(latency)
+        # Not enough samples yet
+        assert hedger.get_delay() == 0.05
+
+        for latency in (0.5, 0.6, 0.7, 0.8, 0.9, 1.0):
+            hedger.record_latency(latency)
+        assert hedger.get_delay() == 0.9
+
+        for _ in range(10):
+            hedger.record_latency(0.001)
+        assert hedger.get_delay() == 0.01
+
+    def test_fast_request_is_not_hedged(self):
+        hedger = create_hedger()
+        send = SlowThenFast(delay=0)
+        assert hedger.get(send).content == b"slow"
+        assert len(send.responses) == 1
+        wait_until_idle(hedger)
+
+    def test_hedge_wins_from_slow_request(self):
+        hedger = create_hedger()
+        send = SlowThenFast()
+        start = time.monotonic()
+        assert hedger.get(send).content == b"fast"
+        assert time.monotonic() - start < 0.2
+        assert len(send.responses) == 2
+
+        # The slow response is closed as soon as it arrives
+        wait_until_idle(hedger)
+        assert send.responses[0].closed
+
+    def test_failed_request_doesnt_win(self):
+        hedger = create_hedger()
+        send = SlowThenFast(delay=0.1, error=ConnectionError())
+        assert hedger.get(send).content == b"fast"
+
+    def test_failed_hedge_waits_for_original_request(self):
+        hedger = create_hedger()
+        send = SlowThenFast(delay=0.1)
+
+        def fail_hedge():
+            if not send.responses:
+                return send()
+            raise ConnectionError()
+
+        assert hedger.get(fail_hedge).content == b"slow"
+
+    def test_hedges_are_limited(self):
+        hedger = create_hedger(max_ratio=0.5)
+        hedger.hedges = 1
+        send = SlowThenFast(delay=0.1)
+        assert hedger.get(send).content == b"slow"
+        assert len(send.responses) == 1
+
+    def test_hedges_need_a_free_upstream_slot(self):
+        hedger = create_hedger()
+        bulkhead = Bulkhead("edepot", max_concurrent=2, max_waiting=0, max_wait=0)
+        with patch.dict(upstream.bulkheads, {"edepot": bulkhead}), bulkhead.acquire():
+            # The only other slot is taken by another request
+            with bulkhead.acquire():
+                send = SlowThenFast(delay=0.1)
+                assert hedger.get(send).content == b"slow"
+                assert len(send.responses) == 1
+
+            send = SlowThenFast()
+            assert hedger.get(send).content == b"fast"
+            # The slot of the hedge is released when it's done
+            wait_until_idle(hedger)
+            assert bulkhead.active == 1
+
+    def test_async_hedge_cancels_slow_request(self):
+        hedger = create_hedger()
+        cancelled = []
+
+        async def send():
+            is_first = not cancelled and hedger.hedges == 0
+            try:
+                if is_first:
+                    await asyncio.sleep(1)
+                return b"slow" if is_first else b"fast"
+            except asyncio.CancelledError:
+                cancelled.append(is_first)
+                raise
+
+        async def run():
+            result = await hedger.get_async(send)
+            await asyncio.sleep(0)
+            return result
+
+        assert asyncio.run(run()) == b"fast"
+        assert cancelled == [True]
+        assert hedger.primaries == hedger.hedges == 0
+
+
+@patch("requests.get")
+def test_get_file_with_hedged_requests(mock_requests_get, settings):
+    settings.HEDGED_REQUESTS = True
+    send = SlowThenFast()
+    mock_requests_get.side_effect = lambda *args, **kwargs: send()
+    url_info = parsing.get_url_info(PRE_WABO_IMG_URL_BASE, source_file=True)
+
+    with patch.dict("iiif.hedging.hedgers", {"edepot": create_hedger()}):
+        file_response, _ = get_file(url_info, ONE_PRE_WABO_METADATA_CONTENT)
+
+    assert file_response.content == b"fast"
+    assert mock_requests_get.call_count == 2
+    assert all(call.kwargs["stream"] for call in mock_requests_get.call_args_list)
@@ -316,6 +316,37 @@ class TestFileRetrievalWithAuthz:
         assert response.status_code == 200
         assert response.content == test_image_96x85_data
 
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_access_restriction_takes_effect_when_cached_metadata_expires(
+        self,
+        mock_do_metadata_request,
+        mock_requests_get,
+        client,
+        test_image_data_factory,
+    ):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+        header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+        now = datetime.now(timezone)
+
+        with time_machine.travel(now, tick=False):
+            assert client.get(self.url + PRE_WABO_IMG_URL_NO_SCALING, **header).status_code == 200
+
+        # The dossier is restricted, but the cached metadata is used until it expires
+        mock_do_metadata_request.return_value = MockResponse(
+            200, json_content={**PRE_WABO_METADATA_CONTENT, "access": settings.ACCESS_RESTRICTED}
+        )
+        stale_for = settings.METADATA_CACHE_TIMEOUT - settings.METADATA_STALE_WHILE_REVALIDATE - 1
+        with time_machine.travel(now + timedelta(seconds=stale_for), tick=False):
+            assert client.get(self.url + PRE_WABO_IMG_URL_NO_SCALING, **header).status_code == 200
+
+        with time_machine.travel(now + timedelta(seconds=settings.METADATA_CACHE_TIMEOUT), tick=False):
+            assert client.get(self.url + PRE_WABO_IMG_URL_NO_SCALING, **header).status_code == 401
+        assert mock_do_metadata_request.call_count == 2
+
     @patch("requests.get")
     @patch("iiif.metadata.do_metadata_request")
     def test_get_restricted_image_with_read_scope(
@@ -0,0 +1,151 @@
+import asyncio
+import json
+from io import BytesIO
+from unittest.mock import patch
+
+import httpx
+import pytest
+from django.conf import settings
+from django.core.cache import caches
+from PIL import Image
+
+from core.auth.constants import RESPONSE_CONTENT_RESTRICTED
+from iiif.async_client import get_async_client
+from tests.test_batch_info_json import BATCH_METADATA_CONTENT
+from tests.tools import create_authz_token
+
+IMAGE_URL = "/iiif/2/edepot:ST_00015~ST00000126_0/full/50,/0/default.jpg"
+
+
+def mock_async_client(handler):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return patch("iiif.async_client.get_async_client", side_effect=lambda verify=True: client)
+
+
+@pytest.mark.urls("async_urls")
+class TestAsyncIndex:
+    def setup_method(self):
+        self.read_header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+        self.requested_urls = []
+
+    def create_handler(self, test_image_data_factory, file_status=200):
+        def handler(request):
+            url = str(request.url)
+            self.requested_urls.append(url)
+            if url.startswith(settings.METADATA_SERVER_BASE_URL):
+                return httpx.Response(200, json=BATCH_METADATA_CONTENT)
+            if file_status != 200:
+                return httpx.Response(file_status)
+            return httpx.Response(
+                200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+            )
+
+        return handler
+
+    def test_get_scaled_image(self, client, test_image_data_factory):
+        with mock_async_client(self.create_handler(test_image_data_factory)):
+            response = client.get(IMAGE_URL, **self.read_header)
+
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "image/jpeg"
+        assert Image.open(BytesIO(response.content)).size == (50, 44)
+        assert self.requested_urls == [
+            f"{settings.METADATA_SERVER_BASE_URL}/iiif-metadata/bouwdossier/ST_00015/",
+            f"{settings.EDEPOT_BASE_URL}ST/15/ST00000126_1.jpg",
+        ]
+
+    def test_get_scaled_image_with_hedged_requests(self, client, test_image_data_factory, settings):
+        settings.HEDGED_REQUESTS = True
+        with mock_async_client(self.create_handler(test_image_data_factory)):
+            response = client.get(IMAGE_URL, **self.read_header)
+
+        assert response.status_code == 200
+        assert Image.open(BytesIO(response.content)).size == (50, 44)
+
+    def test_get_info_json(self, client, test_image_data_factory):
+        with mock_async_client(self.create_handler(test_image_data_factory)):
+            response = client.get("/iiif/2/edepot:ST_00015~ST00000126_0/info.json", **self.read_header)
+
+        assert response.status_code == 200
+        assert json.loads(response.content)["width"] == 96
+
+    def test_cache_is_not_used_on_the_event_loop(self, client, test_image_data_factory, settings):
+        # Every request refreshes the metadata in the background
+        settings.METADATA_STALE_WHILE_REVALIDATE = settings.METADATA_CACHE_TIMEOUT
+        cache_class = type(caches["default"])
+        blocking_calls = []
+
+        def check_not_on_event_loop(method):
+            def wrapper(*args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                except RuntimeError:
+                    pass
+                else:
+                    blocking_calls.append(method.__name__)
+                return method(*args, **kwargs)
+
+            return wrapper
+
+        with (
+            mock_async_client(self.create_handler(test_image_data_factory)),
+            patch("iiif.metadata.metadata_refresh_executor"),
+            patch.multiple(
+                cache_class,
+                **{name: check_not_on_event_loop(getattr(cache_class, name)) for name in ("get", "set", "add")},
+            ),
+        ):
+            for _ in range(2):
+                response = client.get("/iiif/2/edepot:ST_00015~ST00000126_0/info.json", **self.read_header)
+                assert response.status_code == 200
+
+        assert blocking_calls == []
+        # The second info.json was created from the cached dimensions
+        assert len(self.requested_urls) == 2
+
+    def test_restricted_file(self, client, test_image_data_factory):
+        with mock_async_client(self.create_handler(test_image_data_factory)):
+            response = client.get("/iiif/2/edepot:ST_00015~ST00000128_0/full/50,/0/default.jpg", **self.read_header)
+
+        assert response.status_code == 401
+        assert response.content.decode("utf-8") == RESPONSE_CONTENT_RESTRICTED
+
+    def test_file_not_found(self, client, test_image_data_factory):
+        with mock_async_client(self.create_handler(test_image_data_factory, file_status=404)):
+            response = client.get(IMAGE_URL, **self.read_header)
+
+        assert response.status_code == 404
+        # The metadata and both filename variants (as is and lowercase) are requested
+        assert len(self.requested_urls) == 3
+
+    def test_source_server_unreachable(self, client):
+        def handler(request):
+            if str(request.url).startswith(settings.METADATA_SERVER_BASE_URL):
+                return httpx.Response(200, json=BATCH_METADATA_CONTENT)
+            raise httpx.ConnectError("Connection refused", request=request)
+
+        with mock_async_client(handler):
+            response = client.get(IMAGE_URL, **self.read_header)
+
+        assert response.status_code == 502
+
+    def test_metadata_server_unreachable(self, client):
+        def handler(request):
+            raise httpx.ConnectTimeout("Timeout", request=request)
+
+        with mock_async_client(handler):
+            response = client.get(IMAGE_URL, **self.read_header)
+
+        assert response.status_code == 502
+
+
+def test_async_client_is_shared_per_event_loop():
+    async def get_clients():
+        return get_async_client(), get_async_client(), get_async_client(verify=False)
+
+    first_client, same_client, unverified_client = asyncio.run(get_clients())
+    other_loop_client, _, _ = asyncio.run(get_clients())
+
+    assert first_client is same_client
+    assert first_client is not unverified_client
+    assert first_client is not other_loop_client
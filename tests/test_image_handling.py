@@ -1,12 +1,19 @@
+import json
 import os
+from io import BytesIO
 
 import pytest
+from PIL import Image
 
 from iiif.image_handling import (
+    create_sprite,
     crop_image,
+    generate_info_json,
+    get_page_levels,
     parse_region_string,
     parse_scaling_string,
     scale_image,
+    select_page,
 )
 from main.utils import ImmediateHttpResponse
 
@@ -46,6 +53,9 @@ class TestImageFormatting:
             "rb",
         ) as f:
             self.img_85x85 = f.read()
+        with open(os.path.join(CURRENT_DIRECTORY, "test-images/test-image-pyramid-2-pages.tif"), "rb") as f:
+            # Page 0: 96x85 with reduced levels 48x42 and 24x21. Page 1: 85x96 with reduced level 42x48
+            self.tif_pyramid_2_pages = f.read()
 
     @pytest.mark.parametrize("param", [None, "", ",", "w,h"])
     def test_parse_invalid_scaling_string_raises(self, param):
@@ -93,3 +103,65 @@ class TestImageFormatting:
     def test_crop_outside_image(self):
         with pytest.raises(ImmediateHttpResponse):
             crop_image("image/jpeg", "100,100,50,50", self.img_96x85)
+
+    def test_get_page_levels(self):
+        img = Image.open(BytesIO(self.tif_pyramid_2_pages))
+        assert get_page_levels(img) == [
+            [(0, 96, 85), (1, 48, 42), (2, 24, 21)],
+            [(3, 85, 96), (4, 42, 48)],
+        ]
+
+        img = Image.open(BytesIO(self.img_96x85))
+        assert get_page_levels(img) == [[(0, 96, 85)]]
+
+    @pytest.mark.parametrize(
+        "page, region, scaling, expected_size",
+        [
+            (None, "full", "full", (96, 85)),
+            (None, "full", "50,", (96, 85)),
+            (None, "full", "48,", (48, 42)),
+            (None, "full", "20,20", (24, 21)),
+            (None, "0,0,10,10", "20,20", (96, 85)),
+            (1, "full", "full", (85, 96)),
+            (1, "full", ",48", (42, 48)),
+            (1, "full", ",10", (42, 48)),
+        ],
+    )
+    def test_select_page(self, page, region, scaling, expected_size):
+        content = select_page(page, region, scaling, self.tif_pyramid_2_pages)
+        assert Image.open(BytesIO(content)).size == expected_size
+
+    def test_select_page_returns_original_for_first_frame(self):
+        assert select_page(None, "full", "full", self.tif_pyramid_2_pages) == self.tif_pyramid_2_pages
+        assert select_page(None, "full", "50,50", self.img_96x85) == self.img_96x85
+
+    @pytest.mark.parametrize("page", [2, -1])
+    def test_select_non_existing_page_raises(self, page):
+        with pytest.raises(ImmediateHttpResponse):
+            select_page(page, "full", "full", self.tif_pyramid_2_pages)
+
+        with pytest.raises(ImmediateHttpResponse):
+            select_page(1, "full", "full", self.img_96x85)
+
+    def test_scale_image_from_reduced_level(self):
+        content = select_page(None, "full", "30,", self.tif_pyramid_2_pages)
+        scaled_content = scale_image("image/tiff", "30,", content)
+        assert Image.open(BytesIO(scaled_content)).size == (30, 26)
+
+    def test_generate_info_json_for_page(self):
+        info_json = json.loads(
+            generate_info_json("https://iiif/2/edepot:ST_1~1_0@1", self.tif_pyramid_2_pages, "image/tiff", 1)
+        )
+        assert info_json["width"] == 85
+        assert info_json["height"] == 96
+        assert info_json["sizes"] == [{"width": 42, "height": 48}, {"width": 85, "height": 96}]
+        assert info_json["profile"][1]["formats"] == ["tiff"]
+
+    def test_create_sprite(self):
+        content, tiles = create_sprite([self.img_96x85, None, self.img_50x44], 100, 2)
+        assert Image.open(BytesIO(content)).size == (200, 200)
+        assert tiles == [
+            {"x": 0, "y": 0, "width": 96, "height": 85},
+            {"x": 100, "y": 0, "width": 100, "height": 100},
+            {"x": 0, "y": 100, "width": 50, "height": 44},
+        ]
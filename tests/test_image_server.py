@@ -1,10 +1,16 @@
+import threading
+import time
+from io import BytesIO
 from unittest.mock import patch
+from zipfile import ZipFile
 
 from django.conf import settings
+from requests.exceptions import ConnectionError
 
 from iiif import image_server, parsing
 from tests.test_settings import PRE_WABO_IMG_URL_BASE
 from tests.tools import MockResponse
+from zip_consumer.zip_tools import ZipStreamWriter
 
 ONE_PRE_WABO_METADATA_CONTENT = {
     "access": settings.ACCESS_PUBLIC,
@@ -45,3 +51,111 @@ def test_get_file_404retry(mock_requests_get):
     assert file_url[-17:] == "ST/15/ST_TEST.doc"
 
     assert mock_requests_get.call_count == 3
+
+
+ZIP_METADATA_CONTENT = {
+    "access": settings.ACCESS_PUBLIC,
+    "documenten": [
+        {
+            "barcode": "ST00000126",
+            "access": settings.ACCESS_PUBLIC,
+            "bestanden": [
+                {"filename": f"file_{filenr}.jpg", "file_pad": f"ST/15/FILE_{filenr}.jpg", "url": ""}
+                for filenr in range(6)
+            ],
+        },
+    ],
+}
+
+
+def get_zip_files(fail_reasons=None):
+    fail_reasons = fail_reasons or {}
+    files = []
+    for filenr in range(6):
+        iiif_url = f"2/edepot:ST_00015~ST00000126_{filenr}"
+        url_info = parsing.get_url_info(iiif_url, source_file=True)
+        files.append((iiif_url, url_info, fail_reasons.get(filenr), ZIP_METADATA_CONTENT))
+    return files
+
+
+class TestDownloadFilesForZip:
+    def setup_method(self):
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def create_side_effect(self, failing_file=None):
+        def side_effect(url, *args, **kwargs):
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            # The first files are the slowest, so they finish last
+            filenr = int(url[-5])
+            time.sleep(0.01 * (6 - filenr))
+            with self.lock:
+                self.active -= 1
+            if filenr == failing_file:
+                raise ConnectionError()
+            return MockResponse(200, content=url.encode())
+
+        return side_effect
+
+    @patch("requests.get")
+    def test_files_are_downloaded_concurrently_in_order(self, mock_requests_get):
+        mock_requests_get.side_effect = self.create_side_effect(failing_file=2)
+
+        stream = BytesIO()
+        with ZipStreamWriter(stream, "job") as zip_writer:
+            report = image_server.download_files_for_zip(get_zip_files({4: "restricted"}), zip_writer)
+
+        assert report == [
+            "file_0.jpg: included\n",
+            "file_1.jpg: included\n",
+            "file_2.jpg: excluded, Error occurred while getting file from the source system\n",
+            "file_3.jpg: included\n",
+            "file_4.jpg: excluded, restricted\n",
+            "file_5.jpg: included\n",
+        ]
+        with ZipFile(stream) as zip_file:
+            # The files are zipped as soon as they are downloaded, so not in the order of the report
+            assert sorted(zip_file.namelist()) == [
+                "job/file_0.jpg",
+                "job/file_1.jpg",
+                "job/file_3.jpg",
+                "job/file_5.jpg",
+            ]
+            assert zip_file.read("job/file_0.jpg").endswith(b"FILE_0.jpg")
+        assert self.max_active > 1
+
+    @patch("requests.get")
+    def test_downloads_per_source_are_limited(self, mock_requests_get):
+        mock_requests_get.side_effect = self.create_side_effect()
+
+        with (
+            patch.dict(image_server.zip_download_source_limits, {"edepot": threading.BoundedSemaphore(1)}),
+            ZipStreamWriter(BytesIO(), "job") as zip_writer,
+        ):
+            report = image_server.download_files_for_zip(get_zip_files(), zip_writer)
+
+        assert len(report) == 6
+        assert self.max_active == 1
+
+    @patch("iiif.image_server.get_file", side_effect=Exception("unexpected"))
+    def test_unexpected_error_doesnt_stop_other_files(self, mock_get_file):
+        files = get_zip_files()
+        # A file which isn't in the metadata
+        files[1] = (
+            "2/edepot:ST_00015~ST00000999_0",
+            parsing.get_url_info("2/edepot:ST_00015~ST00000999_0", True),
+            None,
+            ZIP_METADATA_CONTENT,
+        )
+
+        with ZipStreamWriter(BytesIO(), "job") as zip_writer:
+            report = image_server.download_files_for_zip(files, zip_writer)
+
+        assert report[0] == "file_0.jpg: excluded, Error occurred while getting file from the source system\n"
+        assert (
+            report[1] == "2/edepot:ST_00015~ST00000999_0: excluded, Error occurred while adding the file to the zip\n"
+        )
+        assert len(report) == 6
@@ -0,0 +1,108 @@
+import json
+from unittest.mock import patch
+
+from django.conf import settings
+
+from core.auth.jwt_tokens import create_mail_login_token
+from tests.test_batch_info_json import BATCH_METADATA_CONTENT
+from tests.tools import MockResponse, create_authz_token
+
+
+class TestManifest:
+    def setup_method(self):
+        self.url = "/iiif/manifest/edepot:ST_00015"
+        self.read_header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    @patch("iiif.metadata.do_metadata_request")
+    def test_manifest_for_dossier(self, mock_do_metadata_request, client):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+
+        response = client.get(self.url, **self.read_header)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/json"
+        assert "ETag" in response.headers
+
+        manifest = json.loads(response.content)
+        assert manifest["@type"] == "sc:Manifest"
+        assert manifest["@id"] == "http://testserver" + self.url
+        canvases = manifest["sequences"][0]["canvases"]
+        # The restricted document is left out
+        assert [canvas["@id"] for canvas in canvases] == [
+            "http://testserver/iiif/2/edepot:ST_00015~ST00000126_0/canvas",
+            "http://testserver/iiif/2/edepot:ST_00015~ST00000126_1/canvas",
+            "http://testserver/iiif/2/edepot:ST_00015~ST00000127_0/canvas",
+        ]
+        service = canvases[0]["images"][0]["resource"]["service"]
+        assert service["@id"] == "http://testserver/iiif/2/edepot:ST_00015~ST00000126_0"
+        assert "width" not in canvases[0]
+
+        # The copyrighted document is included, so the manifest should not be cached
+        assert "no-cache" in response.headers["Cache-Control"]
+
+    @patch("iiif.metadata.do_metadata_request")
+    def test_manifest_with_extended_scope(self, mock_do_metadata_request, client):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_EXTENDED_SCOPE)}
+
+        response = client.get(self.url, **header)
+        assert response.status_code == 200
+        assert len(json.loads(response.content)["sequences"][0]["canvases"]) == 4
+
+    @patch("iiif.metadata.do_metadata_request")
+    def test_manifest_with_mail_login(self, mock_do_metadata_request, client):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mail_login_token = create_mail_login_token("manifest@amsterdam.nl", settings.SECRET_KEY)
+
+        response = client.get(self.url + "?auth=" + mail_login_token)
+        assert response.status_code == 200
+        canvases = json.loads(response.content)["sequences"][0]["canvases"]
+        # Only the public documents without copyright are included, so the manifest can be cached
+        assert len(canvases) == 2
+        assert "private" in response.headers["Cache-Control"]
+
+        response = client.get("/iiif/manifest/wabo:SDZ_TA-38657?auth=" + mail_login_token)
+        assert response.status_code == 401
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_manifest_embeds_cached_dimensions(
+        self, mock_do_metadata_request, mock_requests_get, client, test_image_data_factory
+    ):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+
+        response = client.get("/iiif/2/edepot:ST_00015~ST00000126_1/info.json", **self.read_header)
+        assert response.status_code == 200
+
+        response = client.get(self.url, **self.read_header)
+        canvases = json.loads(response.content)["sequences"][0]["canvases"]
+        assert "width" not in canvases[0]
+        assert canvases[1]["width"] == 96
+        assert canvases[1]["height"] == 85
+        assert canvases[1]["images"][0]["resource"]["width"] == 96
+
+        # The metadata is requested only once, because it is cached between requests
+        assert mock_do_metadata_request.call_count == 1
+
+    @patch("iiif.metadata.do_metadata_request")
+    def test_manifest_not_modified(self, mock_do_metadata_request, client):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+
+        response = client.get(self.url, **self.read_header)
+        response = client.get(self.url, HTTP_IF_NONE_MATCH=response.headers["ETag"], **self.read_header)
+        assert response.status_code == 304
+
+    @patch("iiif.metadata.do_metadata_request")
+    def test_manifest_errors(self, mock_do_metadata_request, client):
+        mock_do_metadata_request.return_value = MockResponse(404)
+
+        response = client.get(self.url, **self.read_header)
+        assert response.status_code == 404
+
+        response = client.get("/iiif/manifest/ST_00015", **self.read_header)
+        assert response.status_code == 400
+
+        response = client.get(self.url)
+        assert response.status_code == 401
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+from requests.exceptions import ConnectionError
+
+from iiif import parsing
+from iiif.metadata import get_metadata_entry
+from main.utils import ImmediateHttpResponse
+from tests.test_settings import PRE_WABO_IMG_URL_BASE, PRE_WABO_METADATA_CONTENT
+from tests.tools import MockResponse
+
+UPDATED_METADATA_CONTENT = {**PRE_WABO_METADATA_CONTENT, "access": "RESTRICTED"}
+
+
+@pytest.fixture
+def url_info():
+    return parsing.get_url_info(PRE_WABO_IMG_URL_BASE, source_file=True)
+
+
+@patch("iiif.metadata.do_metadata_request")
+class TestMetadataCache:
+    def test_fresh_metadata_is_cached(self, mock_do_metadata_request, url_info):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+
+        entry = get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+        assert get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE) == entry
+        assert mock_do_metadata_request.call_count == 1
+
+    def test_stale_metadata_is_refreshed_in_the_background(self, mock_do_metadata_request, url_info, settings):
+        settings.METADATA_STALE_WHILE_REVALIDATE = settings.METADATA_CACHE_TIMEOUT
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        entry = get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=UPDATED_METADATA_CONTENT)
+        executor = ThreadPoolExecutor(max_workers=1)
+        with patch("iiif.metadata.metadata_refresh_executor", executor):
+            # The stale metadata is returned right away
+            assert get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE) == entry
+            executor.shutdown(wait=True)
+
+        # Don't start another refresh, which would outlive this test
+        settings.METADATA_STALE_WHILE_REVALIDATE = 0
+        refreshed_entry = get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+        assert refreshed_entry.metadata == UPDATED_METADATA_CONTENT
+        assert refreshed_entry.version != entry.version
+
+    def test_one_refresh_at_a_time(self, mock_do_metadata_request, url_info, settings):
+        settings.METADATA_STALE_WHILE_REVALIDATE = settings.METADATA_CACHE_TIMEOUT
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+
+        executor = MagicMock()
+        with patch("iiif.metadata.metadata_refresh_executor", executor):
+            for _ in range(3):
+                get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+        assert executor.submit.call_count == 1
+
+    def test_expired_metadata_is_retrieved_again(self, mock_do_metadata_request, url_info, settings):
+        settings.METADATA_CACHE_TIMEOUT = 0
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+
+        # Changes in the access rights are picked up once the metadata has expired
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=UPDATED_METADATA_CONTENT)
+        assert get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE).metadata == UPDATED_METADATA_CONTENT
+        assert mock_do_metadata_request.call_count == 2
+
+    @pytest.mark.parametrize("failure", [ConnectionError(), MockResponse(503)])
+    def test_expired_metadata_is_used_when_server_fails(self, mock_do_metadata_request, url_info, settings, failure):
+        settings.METADATA_CACHE_TIMEOUT = 0
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        entry = get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+
+        if isinstance(failure, Exception):
+            mock_do_metadata_request.side_effect = failure
+        else:
+            mock_do_metadata_request.return_value = failure
+        assert get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE) == entry
+
+    def test_expired_metadata_is_not_used_for_missing_dossier(self, mock_do_metadata_request, url_info, settings):
+        settings.METADATA_CACHE_TIMEOUT = 0
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+
+        mock_do_metadata_request.return_value = MockResponse(404)
+        with pytest.raises(ImmediateHttpResponse) as e:
+            get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+        assert e.value.response.status_code == 404
+
+    def test_stale_if_error_is_limited(self, mock_do_metadata_request, url_info, settings):
+        settings.METADATA_CACHE_TIMEOUT = 0
+        settings.METADATA_STALE_IF_ERROR = 0
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+        get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+
+        mock_do_metadata_request.side_effect = ConnectionError()
+        with pytest.raises(ImmediateHttpResponse) as e:
+            get_metadata_entry(url_info, PRE_WABO_IMG_URL_BASE)
+        assert e.value.response.status_code == 502
@@ -0,0 +1,65 @@
+import pytest
+from hypothesis import given
+from hypothesis import strategies as st
+
+from iiif.parsing import IIIFRequest, InvalidIIIFUrlError, get_info_from_iiif_url, parse_iiif_url
+from tests import legacy_parsing
+
+# Mostly characters which have a meaning in iiif urls, so that the generated urls are often (almost) valid
+URL_CHARACTERS = st.sampled_from(list("/:~_@?. 0123456789-ABSTaz") + ["info.json", "full", "%20", "\t", "٢"])
+url_parts = st.lists(URL_CHARACTERS, max_size=12).map("".join)
+
+
+@st.composite
+def iiif_urls(draw):
+    source = draw(st.sampled_from(["edepot", "wabo", ""]) | url_parts)
+    identifier = (
+        f"{draw(url_parts)}_{draw(url_parts)}~{draw(url_parts)}_{draw(url_parts)}"
+        if draw(st.booleans())
+        else draw(url_parts)
+    )
+    formatting = draw(st.sampled_from(["/info.json", "/full/full/0/default.jpg", "/full/50,/0/default.jpg", ""]))
+    return f"{draw(st.sampled_from(['2/', '', 'iiif/2/']))}{source}:{identifier}{formatting}{draw(url_parts)}"
+
+
+def legacy_result(iiif_url, source_file):
+    try:
+        return legacy_parsing.get_info_from_iiif_url(iiif_url, source_file)
+    except InvalidIIIFUrlError:
+        return InvalidIIIFUrlError
+
+
+def result(iiif_url, source_file):
+    try:
+        return get_info_from_iiif_url(iiif_url, source_file)
+    except InvalidIIIFUrlError:
+        return InvalidIIIFUrlError
+
+
+@given(iiif_url=iiif_urls(), source_file=st.booleans())
+def test_parser_matches_legacy_parser_on_structured_urls(iiif_url, source_file):
+    assert result(iiif_url, source_file) == legacy_result(iiif_url, source_file)
+
+
+@given(iiif_url=st.text(), source_file=st.booleans())
+def test_parser_matches_legacy_parser_on_any_text(iiif_url, source_file):
+    assert result(iiif_url, source_file) == legacy_result(iiif_url, source_file)
+
+
+def test_parse_iiif_url_returns_immutable_cached_request():
+    iiif_request = parse_iiif_url("2/edepot:ST_00015~ST00000126_1@2/full/50,50/0/default.jpg", False)
+    assert isinstance(iiif_request, IIIFRequest)
+    assert iiif_request.page == 2
+    assert parse_iiif_url("2/edepot:ST_00015~ST00000126_1@2/full/50,50/0/default.jpg", False) is iiif_request
+
+    with pytest.raises(AttributeError):
+        iiif_request.page = 3
+
+
+def test_get_info_from_iiif_url_returns_new_dict():
+    url_info = get_info_from_iiif_url("2/edepot:ST_00015~ST00000126_1/info.json", False)
+    url_info["filenr"] = "2"
+    hits = parse_iiif_url.cache_info().hits
+    assert get_info_from_iiif_url("2/edepot:ST_00015~ST00000126_1/info.json", False)["filenr"] == "1"
+    # The dict is built from the cache of parse_iiif_url
+    assert parse_iiif_url.cache_info().hits == hits + 1
@@ -0,0 +1,52 @@
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+from azure.core.exceptions import ServiceRequestError
+
+from utils.queue import get_queue_client
+from zip_consumer import zip_tools
+
+AZURITE_QUEUE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "QueueEndpoint=http://127.0.0.1:10001/devstoreaccount1;"
+)
+
+
+class TestQueueClient:
+    @pytest.fixture(autouse=True)
+    def clear_client(self, settings):
+        settings.AZURITE_QUEUE_CONNECTION_STRING = AZURITE_QUEUE_CONNECTION_STRING
+        get_queue_client.cache_clear()
+        yield
+        get_queue_client.cache_clear()
+
+    def test_client_is_reused(self):
+        queue_client = get_queue_client()
+        assert queue_client.queue_name == "zip-queue"
+        assert get_queue_client() is queue_client
+
+
+class TestStoreZipJobs:
+    @patch("utils.queue.get_queue_client")
+    def test_jobs_are_queued_concurrently(self, mock_get_queue_client):
+        queue_client = Mock()
+        mock_get_queue_client.return_value = queue_client
+
+        def send_message(content):
+            if json.loads(content)["data"] == "job-3":
+                raise ServiceRequestError("Connection reset")
+
+        queue_client.send_message.side_effect = send_message
+        job_names = [f"job-{number}" for number in range(20)]
+
+        failed_job_names = zip_tools.store_zip_jobs(job_names)
+
+        assert failed_job_names == ["job-3"]
+        assert queue_client.send_message.call_count == 20
+        # All jobs use the same client
+        assert mock_get_queue_client.call_count == 1
+        sent = {json.loads(call.args[0])["data"] for call in queue_client.send_message.call_args_list}
+        assert sent == set(job_names)
+        assert json.loads(queue_client.send_message.call_args_list[0].args[0])["version"] == "zip_job_v1"
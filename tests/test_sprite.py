@@ -0,0 +1,132 @@
+import base64
+import json
+from io import BytesIO
+from unittest.mock import patch
+
+from django.conf import settings
+from PIL import Image
+
+from core.auth.constants import RESPONSE_CONTENT_RESTRICTED
+from tests.test_batch_info_json import BATCH_METADATA_CONTENT
+from tests.tools import MockResponse, create_authz_token
+
+
+def open_sprite(content):
+    data_uri = json.loads(content)["sprite"]
+    assert data_uri.startswith("data:image/jpeg;base64,")
+    return Image.open(BytesIO(base64.b64decode(data_uri.split(",", 1)[1])))
+
+
+class TestSprite:
+    def setup_method(self):
+        self.url = "/iiif/sprite/"
+        self.read_header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_sprite_for_dossier(self, mock_do_metadata_request, mock_requests_get, client, test_image_data_factory):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+
+        response = client.get(self.url, {"dossier": "edepot:ST_00015", "size": "50"}, **self.read_header)
+        assert response.status_code == 200
+
+        content = json.loads(response.content)
+        assert content["tile_size"] == 50
+        assert content["tiles"] == {
+            "2/edepot:ST_00015~ST00000126_0": {"x": 0, "y": 0, "width": 50, "height": 44},
+            "2/edepot:ST_00015~ST00000126_1": {"x": 50, "y": 0, "width": 50, "height": 44},
+            "2/edepot:ST_00015~ST00000127_0": {"x": 100, "y": 0, "width": 50, "height": 44},
+            # The restricted file gets a blank tile
+            "2/edepot:ST_00015~ST00000128_0": {"x": 150, "y": 0, "width": 50, "height": 50},
+        }
+        assert content["errors"] == {
+            "2/edepot:ST_00015~ST00000128_0": {"status": 401, "message": RESPONSE_CONTENT_RESTRICTED},
+        }
+        assert open_sprite(response.content).size == (200, 50)
+        assert "no-cache" in response.headers["Cache-Control"]
+
+        # The second time all thumbnails come from the rendition cache
+        assert mock_requests_get.call_count == 3
+        response = client.get(self.url, {"dossier": "edepot:ST_00015", "size": "50"}, **self.read_header)
+        assert response.status_code == 200
+        assert mock_requests_get.call_count == 3
+
+        # The dimensions of the files were stored while creating the thumbnails
+        response = client.get("/iiif/2/edepot:ST_00015~ST00000126_0/info.json", **self.read_header)
+        assert json.loads(response.content)["width"] == 96
+        assert mock_requests_get.call_count == 3
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_sprite_for_urls_keeps_order(
+        self, mock_do_metadata_request, mock_requests_get, client, test_image_data_factory
+    ):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+
+        def side_effect(url, *args, **kwargs):
+            if "st00000126_2" in url.lower():
+                return MockResponse(404)
+            return MockResponse(
+                200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+            )
+
+        mock_requests_get.side_effect = side_effect
+
+        urls = [
+            "2/edepot:ST_00015~ST00000126_1",
+            "https://bouwdossiers.amsterdam.nl/iiif/2/edepot:ST_00015~ST00000126_0/full/full/0/default.jpg",
+            "not-a-iiif-url",
+        ]
+        response = client.post(
+            self.url, json.dumps({"urls": urls}), content_type="application/json", **self.read_header
+        )
+        assert response.status_code == 200
+
+        content = json.loads(response.content)
+        assert list(content["tiles"]) == [
+            "2/edepot:ST_00015~ST00000126_1",
+            "2/edepot:ST_00015~ST00000126_0",
+            "not-a-iiif-url",
+        ]
+        assert content["tiles"]["2/edepot:ST_00015~ST00000126_0"] == {"x": 180, "y": 0, "width": 96, "height": 85}
+        assert content["errors"]["2/edepot:ST_00015~ST00000126_1"]["status"] == 404
+        assert content["errors"]["not-a-iiif-url"]["status"] == 400
+        assert open_sprite(response.content).size == (540, 180)
+
+    @patch("requests.get")
+    @patch("iiif.metadata.do_metadata_request")
+    def test_dossier_with_too_many_files(self, mock_do_metadata_request, mock_requests_get, client, settings):
+        settings.SPRITE_MAX_FILES = 3
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+
+        response = client.get(self.url, {"dossier": "edepot:ST_00015", "size": "50"}, **self.read_header)
+
+        # No thumbnails are made for a sprite which would be too big
+        assert response.status_code == 400
+        assert response.content == b"No more than 3 files allowed, the request is for 4 files"
+        mock_requests_get.assert_not_called()
+
+    def test_invalid_payloads(self, client):
+        response = client.get(self.url, **self.read_header)
+        assert response.status_code == 400
+
+        response = client.get(self.url, {"dossier": "edepot:ST_00015", "size": "a"}, **self.read_header)
+        assert response.status_code == 400
+
+        response = client.get(
+            self.url, {"dossier": "edepot:ST_00015", "size": settings.SPRITE_MAX_TILE_SIZE + 1}, **self.read_header
+        )
+        assert response.status_code == 400
+
+        urls = ["2/edepot:ST_00015~ST00000126_0"] * (settings.SPRITE_MAX_FILES + 1)
+        response = client.post(
+            self.url, json.dumps({"urls": urls}), content_type="application/json", **self.read_header
+        )
+        assert response.status_code == 400
+
+    def test_without_token(self, client):
+        response = client.get(self.url, {"dossier": "edepot:ST_00015"})
+        assert response.status_code == 401
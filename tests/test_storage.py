@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from unittest.mock import Mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import time_machine
+from azure.core.exceptions import ServiceResponseError
+from azure.storage.blob import UserDelegationKey
+
+from tests.tools import MockBlobClient
+from utils.storage import (
+    BlobBlockWriter,
+    create_storage_account_temp_url,
+    get_blob_client,
+    get_blob_service_client,
+)
+
+AZURITE_STORAGE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+)
+
+
+class SlowBlobClient(MockBlobClient):
+    def __init__(self):
+        super().__init__()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def stage_block(self, block_id, data):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        super().stage_block(block_id, data)
+
+
+class TestBlobBlockWriter:
+    def test_blocks_are_staged_concurrently(self):
+        blob_client = SlowBlobClient()
+        data = os.urandom(10_500)
+
+        with BlobBlockWriter(blob_client, block_size=1000, max_concurrency=3) as blob_stream:
+            for start in range(0, len(data), 700):
+                blob_stream.write(data[start : start + 700])
+
+        assert blob_client.max_active == 3
+        assert len(blob_client.committed_block_ids) == 11
+        assert blob_client.content == data
+
+    def test_failed_upload_is_not_committed(self):
+        blob_client = MockBlobClient(failing_block_ids={"00000002"})
+
+        with pytest.raises(ServiceResponseError):
+            with BlobBlockWriter(blob_client, block_size=1000, max_concurrency=2) as blob_stream:
+                blob_stream.write(os.urandom(5000))
+
+        assert blob_client.committed_block_ids is None
+
+    def test_failed_upload_can_be_resumed(self):
+        blob_client = MockBlobClient(failing_block_ids={"a00000003"})
+        data = os.urandom(5500)
+
+        with pytest.raises(ServiceResponseError):
+            with BlobBlockWriter(blob_client, block_size=1000, max_concurrency=1, block_id_prefix="a") as blob_stream:
+                blob_stream.write(data[:2500])
+                staged_blocks = blob_stream.stage()
+                blob_stream.write(data[2500:])
+
+        # The last block before stage() isn't full
+        assert staged_blocks == [("a00000000", 1000), ("a00000001", 1000), ("a00000002", 500)]
+
+        with BlobBlockWriter(
+            blob_client, block_size=1000, staged_blocks=staged_blocks, block_id_prefix="b"
+        ) as blob_stream:
+            assert blob_stream.tell() == 2500
+            blob_stream.write(data[blob_stream.tell() :])
+
+        assert blob_client.committed_block_ids == [block_id for block_id, _ in staged_blocks] + [
+            f"b{index:08d}" for index in range(3, 6)
+        ]
+        assert blob_client.content == data
+
+
+class TestBlobServiceClient:
+    @pytest.fixture(autouse=True)
+    def clear_client(self, settings):
+        settings.AZURITE_STORAGE_CONNECTION_STRING = AZURITE_STORAGE_CONNECTION_STRING
+        get_blob_service_client.cache_clear()
+        yield
+        get_blob_service_client.cache_clear()
+
+    def test_client_is_reused(self):
+        assert get_blob_service_client() is get_blob_service_client()
+
+        blob_client, blob_service_client = get_blob_client("downloads", "test.zip")
+        assert blob_service_client is get_blob_service_client()
+        # The blob client uses the connection pool of the service client
+        assert blob_client._pipeline._transport._transport is blob_service_client._pipeline._transport
+
+
+def create_user_delegation_key(start, expiry):
+    key = UserDelegationKey()
+    key.signed_oid = key.signed_tid = "00000000-0000-0000-0000-000000000000"
+    key.signed_start = start.strftime("%Y-%m-%dT%H:%M:%SZ")
+    key.signed_expiry = expiry.strftime("%Y-%m-%dT%H:%M:%SZ")
+    key.signed_service = "b"
+    key.signed_version = "2025-01-05"
+    key.value = "a2V5"
+    return key
+
+
+class TestTempUrl:
+    def setup_method(self):
+        self.blob_service_client = Mock(account_name="account", url="https://account.blob.core.windows.net/")
+        self.blob_service_client.get_user_delegation_key.side_effect = create_user_delegation_key
+        self.blob_client = Mock(
+            account_name="account",
+            container_name="downloads",
+            blob_name="test.zip",
+            url="https://account.blob.core.windows.net/downloads/test.zip",
+        )
+
+    def get_expiry(self, url):
+        expiry = parse_qs(urlparse(url).query)["se"][0]
+        return datetime.strptime(expiry, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+    @time_machine.travel(datetime(2025, 1, 1, tzinfo=timezone.utc), tick=False)
+    def test_user_delegation_key_is_cached(self, settings):
+        settings.USER_DELEGATION_KEY_REFRESH_MARGIN = 3600
+
+        url = create_storage_account_temp_url(self.blob_client, self.blob_service_client)
+        assert url.startswith("https://bouwdossiers.amsterdam.nl/downloads/test.zip?")
+        assert self.get_expiry(url) == datetime(2025, 1, 8, tzinfo=timezone.utc)
+
+        # Until the margin has passed the same key is used, which limits the validity of the url
+        with time_machine.travel(datetime(2025, 1, 1, 0, 59, tzinfo=timezone.utc), tick=False):
+            url = create_storage_account_temp_url(self.blob_client, self.blob_service_client)
+        assert self.get_expiry(url) == datetime(2025, 1, 8, tzinfo=timezone.utc)
+        assert self.blob_service_client.get_user_delegation_key.call_count == 1
+
+        with time_machine.travel(datetime(2025, 1, 1, 1, 1, tzinfo=timezone.utc), tick=False):
+            url = create_storage_account_temp_url(self.blob_client, self.blob_service_client)
+        assert self.get_expiry(url) == datetime(2025, 1, 8, 1, 1, tzinfo=timezone.utc)
+        assert self.blob_service_client.get_user_delegation_key.call_count == 2
+
+    @time_machine.travel(datetime(2025, 1, 1, tzinfo=timezone.utc), tick=False)
+    def test_short_lived_url_reuses_key_longer(self):
+        create_storage_account_temp_url(self.blob_client, self.blob_service_client)
+
+        with time_machine.travel(datetime(2025, 1, 5, tzinfo=timezone.utc), tick=False):
+            url = create_storage_account_temp_url(self.blob_client, self.blob_service_client, expiry_days=1)
+        assert self.get_expiry(url) == datetime(2025, 1, 6, tzinfo=timezone.utc)
+        assert self.blob_service_client.get_user_delegation_key.call_count == 1
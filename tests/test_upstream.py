@@ -0,0 +1,233 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from django.conf import settings
+from requests.exceptions import ConnectionError
+
+from iiif import parsing, upstream
+from iiif.image_server import get_file
+from iiif.upstream import Bulkhead, CircuitBreaker
+from main.utils import ImmediateHttpResponse
+from tests.test_settings import PRE_WABO_IMG_URL_BASE, PRE_WABO_IMG_URL_WITH_SCALING, PRE_WABO_METADATA_CONTENT
+from tests.tools import MockResponse, create_authz_token
+
+
+class TestBulkhead:
+    def test_acquire_within_limit(self):
+        bulkhead = Bulkhead("edepot", max_concurrent=2, max_waiting=0, max_wait=0)
+        with bulkhead.acquire(), bulkhead.acquire():
+            assert bulkhead.active == 2
+        assert bulkhead.active == 0
+
+    def test_reject_when_queue_is_full(self):
+        bulkhead = Bulkhead("edepot", max_concurrent=1, max_waiting=0, max_wait=1)
+        with bulkhead.acquire():
+            with pytest.raises(ImmediateHttpResponse) as e:
+                with bulkhead.acquire():
+                    pass
+        assert e.value.response.status_code == 503
+        assert e.value.response["Retry-After"] == str(settings.UPSTREAM_RETRY_AFTER)
+        assert bulkhead.active == 0
+
+    def test_reject_after_max_wait(self):
+        bulkhead = Bulkhead("edepot", max_concurrent=1, max_waiting=1, max_wait=0.01)
+        with bulkhead.acquire():
+            with pytest.raises(ImmediateHttpResponse):
+                with bulkhead.acquire():
+                    pass
+            assert bulkhead.waiting == 0
+        assert bulkhead.active == 0
+
+    def test_waiting_request_gets_released_slot(self):
+        bulkhead = Bulkhead("edepot", max_concurrent=1, max_waiting=1, max_wait=5)
+        acquired = threading.Event()
+
+        def wait_for_slot():
+            with bulkhead.acquire():
+                acquired.set()
+
+        with bulkhead.acquire():
+            thread = threading.Thread(target=wait_for_slot)
+            thread.start()
+            while bulkhead.waiting == 0:
+                pass
+            assert not acquired.is_set()
+        thread.join()
+
+        assert acquired.is_set()
+        assert bulkhead.active == 0
+
+    def test_async_requests_share_the_limit(self):
+        bulkhead = Bulkhead("metadata", max_concurrent=2, max_waiting=1, max_wait=5)
+        max_active = 0
+
+        async def request():
+            nonlocal max_active
+            async with bulkhead.acquire_async():
+                max_active = max(max_active, bulkhead.active)
+                await asyncio.sleep(0.01)
+
+        async def run_requests():
+            return await asyncio.gather(*(request() for _ in range(4)), return_exceptions=True)
+
+        results = asyncio.run(run_requests())
+
+        # Two requests get a slot, one waits for a slot and one is rejected
+        assert max_active == 2
+        assert [isinstance(result, ImmediateHttpResponse) for result in results] == [False, False, False, True]
+        assert bulkhead.active == 0
+
+
+def create_circuit_breaker(**kwargs):
+    options = {
+        "window_size": 4,
+        "min_calls": 2,
+        "failure_rate": 0.5,
+        "slow_call_duration": 10,
+        "slow_call_rate": 0.5,
+        "open_duration": 30,
+        "half_open_calls": 2,
+    }
+    return CircuitBreaker("wabo", **(options | kwargs))
+
+
+def do_call(breaker, failed=False, error=None):
+    with breaker.call() as call:
+        call.start()
+        if error:
+            raise error
+        call.failed = failed
+
+
+class TestCircuitBreaker:
+    def test_stays_closed_below_failure_rate(self):
+        breaker = create_circuit_breaker(window_size=10, min_calls=4)
+        for failed in (True, False, False, False, True, False):
+            do_call(breaker, failed=failed)
+        assert breaker.state == "closed"
+        assert breaker.status() == {"state": "closed", "calls": 6, "failures": 2, "slow_calls": 0}
+
+    def test_opens_on_failures_and_fails_fast(self):
+        breaker = create_circuit_breaker()
+        do_call(breaker, failed=True)
+        with pytest.raises(ConnectionError):
+            do_call(breaker, error=ConnectionError())
+        assert breaker.state == "open"
+
+        start = time.monotonic()
+        with pytest.raises(ImmediateHttpResponse) as e:
+            do_call(breaker)
+        assert time.monotonic() - start < 0.01
+        assert e.value.response.status_code == 503
+        assert int(e.value.response["Retry-After"]) == 30
+
+    def test_opens_on_slow_calls(self):
+        breaker = create_circuit_breaker(slow_call_duration=0)
+        do_call(breaker)
+        do_call(breaker)
+        assert breaker.state == "open"
+
+    def test_time_before_the_call_is_started_is_not_counted(self):
+        breaker = create_circuit_breaker(slow_call_duration=0.01)
+        for _ in range(2):
+            with breaker.call() as call:
+                time.sleep(0.02)
+                call.start()
+        assert breaker.state == "closed"
+
+        # Neither are errors before the call is started, like a rejection by a bulkhead
+        for _ in range(2):
+            with pytest.raises(ImmediateHttpResponse), breaker.call():
+                raise ImmediateHttpResponse(response=None)
+        assert breaker.state == "closed"
+
+    def test_half_open_trial_calls_close_the_circuit(self):
+        breaker = create_circuit_breaker(open_duration=0.01)
+        do_call(breaker, failed=True)
+        do_call(breaker, failed=True)
+        time.sleep(0.02)
+
+        with breaker.call() as first_call, breaker.call() as second_call:
+            assert breaker.state == "half_open"
+            # Only half_open_calls requests are let through at the same time
+            with pytest.raises(ImmediateHttpResponse):
+                do_call(breaker)
+            first_call.start()
+            second_call.start()
+        assert breaker.state == "closed"
+
+    def test_failed_trial_call_opens_the_circuit_again(self):
+        breaker = create_circuit_breaker(open_duration=0.01)
+        do_call(breaker, failed=True)
+        do_call(breaker, failed=True)
+        time.sleep(0.02)
+
+        do_call(breaker, failed=True)
+        assert breaker.state == "open"
+        with pytest.raises(ImmediateHttpResponse):
+            do_call(breaker)
+
+
+@patch("requests.get")
+@patch("iiif.metadata.do_metadata_request")
+def test_index_returns_503_when_circuit_is_open(mock_do_metadata_request, mock_requests_get, client):
+    mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+    mock_requests_get.side_effect = ConnectionError()
+    header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    with patch.dict(upstream.circuit_breakers, {"edepot": create_circuit_breaker()}):
+        for _ in range(2):
+            response = client.get("/iiif/" + PRE_WABO_IMG_URL_WITH_SCALING, **header)
+            assert response.status_code == 502
+        call_count = mock_requests_get.call_count
+
+        response = client.get("/iiif/" + PRE_WABO_IMG_URL_WITH_SCALING, **header)
+        assert response.status_code == 503
+        assert mock_requests_get.call_count == call_count
+
+        response = client.get("/iiif/status/health/upstreams")
+        assert response.json()["edepot"]["state"] == "open"
+
+
+class SlowDownloadResponse(MockResponse):
+    # The headers arrive right away, but the file takes a while to download
+    @property
+    def content(self):
+        time.sleep(0.02)
+        return b"file"
+
+    @content.setter
+    def content(self, content):
+        pass
+
+
+@patch("requests.get")
+def test_slow_download_is_not_a_slow_call(mock_requests_get):
+    mock_requests_get.return_value = SlowDownloadResponse(200)
+    url_info = parsing.get_url_info(PRE_WABO_IMG_URL_BASE, source_file=True)
+    breaker = create_circuit_breaker(slow_call_duration=0.01)
+
+    with patch.dict(upstream.circuit_breakers, {"edepot": breaker}):
+        for _ in range(4):
+            file_response, _ = get_file(url_info, PRE_WABO_METADATA_CONTENT)
+            assert file_response.content == b"file"
+
+    assert mock_requests_get.call_args.kwargs["stream"] is True
+    assert breaker.status() == {"state": "closed", "calls": 4, "failures": 0, "slow_calls": 0}
+
+
+@patch("requests.get")
+@patch("iiif.metadata.do_metadata_request")
+def test_index_returns_503_when_upstream_is_overloaded(mock_do_metadata_request, mock_requests_get, client):
+    mock_do_metadata_request.return_value = MockResponse(200, json_content=PRE_WABO_METADATA_CONTENT)
+    header = {"HTTP_AUTHORIZATION": "Bearer " + create_authz_token(settings.BOUWDOSSIER_READ_SCOPE)}
+
+    with patch.dict(upstream.bulkheads, {"edepot": Bulkhead("edepot", max_concurrent=0, max_waiting=0, max_wait=0)}):
+        response = client.get("/iiif/" + PRE_WABO_IMG_URL_WITH_SCALING, **header)
+
+    assert response.status_code == 503
+    assert response["Retry-After"] == str(settings.UPSTREAM_RETRY_AFTER)
+    mock_requests_get.assert_not_called()
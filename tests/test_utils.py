@@ -1,22 +1,24 @@
 import logging
 import os
-import shutil
 from collections import namedtuple
-from pathlib import Path
-from uuid import uuid4
-from zipfile import ZipFile
+from io import BytesIO
+from unittest.mock import Mock, patch
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
 import jwt
 import pytest
 import pytz
+import time_machine
+from azure.core.exceptions import ResourceNotFoundError
 from django.conf import settings
 
 from core.auth.document_access import img_is_public_copyright
 from core.auth.jwt_tokens import create_mail_login_token
 from iiif.image_server import create_file_url_and_headers, create_url, get_filename
 from iiif.parsing import InvalidIIIFUrlError, get_email_address, get_info_from_iiif_url
-from main.utils import ImmediateHttpResponse
+from main.utils import ExpiringLRUCache, ImmediateHttpResponse
 from tests.test_settings import (
+    EDEPOT_PREFIX,
     PRE_WABO_IMG_URL_DOUBLE_DOSSIER,
     PRE_WABO_IMG_URL_NO_SCALING,
     PRE_WABO_IMG_URL_WITH_CHARS_IN_DOSSIER,
@@ -28,7 +30,9 @@ from tests.test_settings import (
     WABO_IMG_URL,
     WABO_IMG_URL2,
 )
-from zip_consumer.zip_tools import TMP_BOUWDOSSIER_ZIP_FOLDER, create_local_zip_file
+from tests.tools import MockBlobClient
+from utils.storage import BlobBlockWriter
+from zip_consumer.zip_tools import ZipJobCheckpoint, ZipStreamWriter, get_compression
 
 log = logging.getLogger(__name__)
 timezone = pytz.timezone("UTC")
@@ -139,6 +143,21 @@ class TestUtils:
         assert url_info["formatting"] == "24,24,48,48/full/0/default.jpg"
         assert url_info["info_json"] is False
 
+    def test_get_info_from_pre_wabo_url_with_page(self):
+        url_info = get_info_from_iiif_url(EDEPOT_PREFIX + "ST_00015~ST00000126_1@2/full/50,50/0/default.jpg", False)
+        assert url_info["document_barcode"] == "ST00000126"
+        assert url_info["filenr"] == "1"
+        assert url_info["page"] == 2
+        assert url_info["scaling"] == "50,50"
+
+        url_info = get_info_from_iiif_url(PRE_WABO_IMG_URL_WITH_SCALING, False)
+        assert url_info["filenr"] == "0"
+        assert url_info["page"] is None
+
+    def test_get_info_from_pre_wabo_url_with_invalid_page(self):
+        with pytest.raises(InvalidIIIFUrlError):
+            get_info_from_iiif_url(EDEPOT_PREFIX + "ST_00015~ST00000126_1@two/info.json", False)
+
     def test_get_info_from_pre_wabo_url_wrong_formatted_url(self):
         with pytest.raises(InvalidIIIFUrlError):
             get_info_from_iiif_url("2/", False)
@@ -388,37 +407,202 @@ class TestUtils:
         assert public is True
         assert has_copyright is True
 
-    def test_create_local_zip_file(self):
-        # First create some files
-        uuid = str(uuid4())
-        folder_path = os.path.join(TMP_BOUWDOSSIER_ZIP_FOLDER, uuid)
-        os.makedirs(folder_path)
-        filenames = [f"content{i}.txt" for i in range(5)]
-        for filename in filenames:
-            with open(f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{uuid}/{filename}", "w") as f:
-                f.write("content")
-
-        # Create the zip file
-        create_local_zip_file(uuid, folder_path)
-
-        # Check whether the newly created zip file exists
-        assert Path(f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{uuid}.zip").is_file()
-
-        # Unzip the file
-        unzip_uuid = uuid4()
-        unzip_folder = f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{unzip_uuid}/"
-        os.mkdir(unzip_folder)
-        with ZipFile(f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{uuid}.zip", "r") as zip_ref:
-            zip_ref.extractall(unzip_folder)
-
-        os.path.isdir(os.path.join(unzip_folder, uuid))
-        extracted_files = sorted([file.name for file in Path(os.path.join(unzip_folder, uuid)).glob("*")])
-        assert extracted_files == filenames
-
-        # Cleanup so that other tests are not influenced
-        shutil.rmtree(folder_path)
-        os.remove(f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{uuid}.zip")
-        shutil.rmtree(unzip_folder)
+    def test_stream_zip_to_blob(self):
+        blob_client = MockBlobClient()
+        with (
+            BlobBlockWriter(blob_client, block_size=1000, max_concurrency=1) as blob_stream,
+            ZipStreamWriter(blob_stream, "job") as zip_writer,
+        ):
+            zip_writer.add_file("image.jpg", os.urandom(2500))
+            # The upload started while the zip is still being written
+            assert len(blob_client.staged_blocks) >= 1
+            assert blob_client.committed_block_ids is None
+            zip_writer.add_file("report.txt", "The following files were requested:\n")
+
+        assert blob_client.committed_block_ids == sorted(blob_client.staged_blocks)
+        assert all(len(block) == 1000 for block in list(blob_client.staged_blocks.values())[:-1])
+        with ZipFile(BytesIO(blob_client.content)) as zip_file:
+            assert zip_file.namelist() == ["job/image.jpg", "job/report.txt"]
+            assert zip_file.read("job/report.txt") == b"The following files were requested:\n"
+            assert len(zip_file.read("job/image.jpg")) == 2500
+
+    def test_stream_zip_to_blob_is_not_committed_after_an_error(self):
+        blob_client = MockBlobClient()
+        with pytest.raises(ConnectionError):
+            with BlobBlockWriter(blob_client, block_size=10) as blob_stream, ZipStreamWriter(blob_stream, "job"):
+                raise ConnectionError()
+
+        assert blob_client.committed_block_ids is None
+
+    def test_stream_zip_to_blob_is_not_committed_when_before_commit_raises(self):
+        blob_client = MockBlobClient()
+        before_commit = Mock(side_effect=RuntimeError("The lease expired"))
+        with pytest.raises(RuntimeError):
+            with (
+                BlobBlockWriter(blob_client, block_size=10, before_commit=before_commit) as blob_stream,
+                ZipStreamWriter(blob_stream, "job") as zip_writer,
+            ):
+                zip_writer.add_file("report.txt", "The following files were requested:\n")
+
+        assert len(blob_client.staged_blocks) >= 1
+        assert blob_client.committed_block_ids is None
+
+    def test_zip_stream_writer_adds_a_file_once(self):
+        stream = BytesIO()
+        with ZipStreamWriter(stream, "job") as zip_writer:
+            zip_writer.add_file("file.pdf", b"page 1")
+            zip_writer.add_file("file.pdf", b"page 2")
+
+        with ZipFile(stream) as zip_file:
+            assert zip_file.namelist() == ["job/file.pdf"]
+
+    @pytest.mark.parametrize(
+        "filename, content_type, expected",
+        [
+            ("SJ10027690_00001.jpg", "image/jpeg", (ZIP_STORED, None)),
+            ("plan.PDF", None, (ZIP_STORED, None)),
+            ("archive.zip", None, (ZIP_STORED, None)),
+            ("scan.tif", "image/tiff", (ZIP_DEFLATED, 3)),
+            ("report.txt", None, (ZIP_DEFLATED, 6)),
+            ("list.xls", None, (ZIP_DEFLATED, 6)),
+            # Without a known extension the content type is used
+            ("scan", "image/png", (ZIP_STORED, None)),
+            ("scan", "image/tiff; charset=binary", (ZIP_DEFLATED, 3)),
+            ("drawing.dwg", None, (ZIP_STORED, None)),
+        ],
+    )
+    def test_get_compression(self, filename, content_type, expected):
+        assert get_compression(filename, content_type) == expected
+
+    def test_zip_stream_writer_compresses_per_file(self, test_image_data_factory):
+        stream = BytesIO()
+        with ZipStreamWriter(stream, "job") as zip_writer:
+            zip_writer.add_file("image.jpg", test_image_data_factory("test-image-96x85.jpg"))
+            zip_writer.add_file("image.tif", test_image_data_factory("test-image-pyramid-2-pages.tif"))
+            zip_writer.add_file("report.txt", "file.jpg: included\n" * 100)
+
+        with ZipFile(stream) as zip_file:
+            assert [info.compress_type for info in zip_file.infolist()] == [ZIP_STORED, ZIP_DEFLATED, ZIP_DEFLATED]
+            assert zip_file.testzip() is None
+
+    def test_zip_stream_writer_uses_zip64_for_many_files(self):
+        stream = BytesIO()
+        with patch("zipfile.ZIP_FILECOUNT_LIMIT", 2), ZipStreamWriter(stream, "job") as zip_writer:
+            for filenr in range(3):
+                zip_writer.add_file(f"file_{filenr}.txt", "content")
+
+        # The zip64 end of central directory record
+        assert b"PK\x06\x06" in stream.getvalue()
+        with ZipFile(stream) as zip_file:
+            assert len(zip_file.namelist()) == 3
+
+    @pytest.fixture
+    def checkpoint_blobs(self):
+        blobs = {}
+
+        def get_blob(storage_container, blob_name):
+            if blob_name not in blobs:
+                raise ResourceNotFoundError("The specified blob does not exist")
+            return None, blobs[blob_name]
+
+        with (
+            patch(
+                "zip_consumer.zip_tools.store_blob_on_storage_account",
+                side_effect=lambda storage_container, blob_name, blob: blobs.update({blob_name: blob}),
+            ),
+            patch("zip_consumer.zip_tools.get_blob_from_storage_account", side_effect=get_blob),
+            patch(
+                "zip_consumer.zip_tools.remove_blob_from_storage_account",
+                side_effect=lambda storage_container, blob_name: blobs.pop(blob_name),
+            ),
+        ):
+            yield blobs
+
+    def test_zip_is_continued_from_checkpoint(self, checkpoint_blobs):
+        blob_client = MockBlobClient()
+        files = {f"file_{filenr}.tif": os.urandom(1500) for filenr in range(4)}
+
+        checkpoint = ZipJobCheckpoint.load("job", "zip")
+        checkpoint.interval = 0
+        with pytest.raises(ConnectionError):
+            with (
+                BlobBlockWriter(
+                    blob_client, block_size=1000, block_id_prefix=checkpoint.block_id_prefix
+                ) as blob_stream,
+                ZipStreamWriter(blob_stream, "zip", checkpoint) as zip_writer,
+            ):
+                zip_writer.add_file("file_0.tif", files["file_0.tif"])
+                zip_writer.add_file("file_1.tif", files["file_1.tif"])
+                checkpoint.interval = 60
+                zip_writer.add_file("file_2.tif", files["file_2.tif"])
+                raise ConnectionError()
+        assert list(checkpoint_blobs) == ["job.checkpoint"]
+
+        # The retry continues the zip of the checkpoint, after the files which were in it
+        checkpoint = ZipJobCheckpoint.load("job", "other-zip")
+        assert checkpoint.zipjob_uuid == "zip"
+        assert checkpoint.filenames == {"file_0.tif", "file_1.tif"}
+        checkpoint.verify(blob_client, files)
+        resumed_blocks = checkpoint.staged_blocks
+        with (
+            BlobBlockWriter(
+                blob_client,
+                block_size=1000,
+                staged_blocks=checkpoint.staged_blocks,
+                block_id_prefix=checkpoint.block_id_prefix,
+            ) as blob_stream,
+            ZipStreamWriter(blob_stream, "zip", checkpoint) as zip_writer,
+        ):
+            assert blob_stream.tell() == sum(size for _, size in resumed_blocks)
+            added = [filename for filename in files if filename not in zip_writer]
+            for filename in added:
+                zip_writer.add_file(filename, files[filename])
+        checkpoint.delete()
+
+        assert added == ["file_2.tif", "file_3.tif"]
+        assert checkpoint_blobs == {}
+        assert blob_client.committed_block_ids[: len(resumed_blocks)] == [block_id for block_id, _ in resumed_blocks]
+        with ZipFile(BytesIO(blob_client.content)) as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.namelist() == [f"zip/{filename}" for filename in files]
+            assert all(zip_file.read(f"zip/{filename}") == content for filename, content in files.items())
+
+    def test_zip_is_restarted_when_checkpoint_cant_be_continued(self):
+        blob_client = MockBlobClient()
+
+        def create_checkpoint():
+            return ZipJobCheckpoint(
+                "job", "zip", staged_blocks=[("a1b2c3d400000000", 100)], entries=[ZipInfo("zip/1.tif")]
+            )
+
+        # The staged blocks are gone, e.g. because the zip was committed
+        checkpoint = create_checkpoint()
+        checkpoint.verify(blob_client, ["1.tif"])
+        assert checkpoint.staged_blocks == checkpoint.entries == []
+
+        # A file in the zip may not be zipped anymore
+        blob_client.stage_block("a1b2c3d400000000", bytes(100))
+        checkpoint = create_checkpoint()
+        checkpoint.verify(blob_client, ["2.tif"])
+        assert checkpoint.staged_blocks == checkpoint.entries == []
+
+        checkpoint = create_checkpoint()
+        checkpoint.verify(blob_client, ["1.tif", "2.tif"])
+        assert checkpoint.filenames == {"1.tif"}
+
+    def test_checkpoint_is_not_saved_for_report(self, checkpoint_blobs):
+        checkpoint = ZipJobCheckpoint.load("job", "zip")
+        checkpoint.interval = 0
+        with pytest.raises(ConnectionError):
+            with (
+                BlobBlockWriter(MockBlobClient(), block_size=1000) as blob_stream,
+                ZipStreamWriter(blob_stream, "zip", checkpoint) as zip_writer,
+            ):
+                zip_writer.add_file("file_0.tif", os.urandom(1500))
+                zip_writer.add_file("report.txt", "file_0.tif: included\n", save_checkpoint=False)
+                raise ConnectionError()
+
+        assert ZipJobCheckpoint.load("job", "other-zip").filenames == {"file_0.tif"}
 
     def test_get_email_address(self):
         Request = namedtuple("Request", "get_token_subject, get_token_claims")
@@ -439,3 +623,29 @@ class TestUtils:
         request = Request(get_token_subject=None, get_token_claims={})
         with pytest.raises(ImmediateHttpResponse):
             get_email_address(request, {"sub": "other str"})
+
+
+class TestExpiringLRUCache:
+    def test_entries_expire_at_their_own_time(self):
+        cache = ExpiringLRUCache(maxsize=10)
+        with time_machine.travel(1_000_000, tick=False):
+            cache.set("a", 1, expires_at=1_000_010)
+            cache.set("b", 2, expires_at=1_000_020)
+
+        with time_machine.travel(1_000_009.9, tick=False):
+            assert cache.get("a") == 1
+        with time_machine.travel(1_000_010, tick=False):
+            assert cache.get("a") is None
+            assert cache.get("b") == 2
+            assert len(cache) == 1
+
+    def test_least_recently_used_entry_is_removed(self):
+        cache = ExpiringLRUCache(maxsize=2)
+        cache.set("a", 1, expires_at=float("inf"))
+        cache.set("b", 2, expires_at=float("inf"))
+        cache.get("a")
+        cache.set("c", 3, expires_at=float("inf"))
+
+        assert cache.get("a") == 1
+        assert cache.get("b", "missing") == "missing"
+        assert cache.get("c") == 3
@@ -0,0 +1,113 @@
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+
+from iiif import parsing
+from iiif.dimensions import get_cached_dimensions
+from iiif.metadata import get_metadata_cache_key
+from iiif.renditions import get_cached_rendition
+from iiif.warm_up import get_dossiers_from_access_log
+from tests.test_batch_info_json import BATCH_METADATA_CONTENT
+from tests.tools import MockResponse
+
+FILE_URLS = [
+    "2/edepot:ST_00015~ST00000126_0",
+    "2/edepot:ST_00015~ST00000126_1",
+    "2/edepot:ST_00015~ST00000127_0",
+    "2/edepot:ST_00015~ST00000128_0",
+]
+
+
+def warm_caches(*args):
+    stdout = StringIO()
+    call_command("warm_caches", *args, stdout=stdout)
+    return stdout.getvalue()
+
+
+def test_get_dossiers_from_access_log():
+    lines = [
+        '10.0.0.1 - - "GET /iiif/2/edepot:ST_00015~ST00000126_0/full/180,/0/default.jpg HTTP/1.1" 200',
+        '10.0.0.1 - - "GET /iiif/2/wabo:SDZ_TA-38657~SDZ_1_0/info.json HTTP/1.1" 200',
+        '10.0.0.2 - - "GET /iiif/manifest/edepot:ST_00015 HTTP/1.1" 200',
+        '10.0.0.3 - - "GET /iiif/sprite/?dossier=edepot:SA_85385&size=100 HTTP/1.1" 200',
+        '10.0.0.3 - - "GET /iiif/2/edepot:SA_85385~SA00001_0/info.json HTTP/1.1" 200',
+        '10.0.0.3 - - "GET /iiif/2/edepot:SA_85385~SA00001_1/info.json HTTP/1.1" 200',
+        '10.0.0.4 - - "GET /iiif/status/health HTTP/1.1" 200',
+    ]
+    assert get_dossiers_from_access_log(lines, 10) == ["edepot:SA_85385", "edepot:ST_00015", "wabo:SDZ_TA-38657"]
+    assert get_dossiers_from_access_log(lines, 1) == ["edepot:SA_85385"]
+
+
+@patch("requests.get")
+@patch("iiif.metadata.do_metadata_request")
+class TestWarmCaches:
+    @pytest.fixture(autouse=True)
+    def shared_cache(self, settings, tmp_path):
+        # A cache which other processes can use as well
+        settings.CACHES = {
+            "default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": str(tmp_path)}
+        }
+
+    def test_warm_dossier(self, mock_do_metadata_request, mock_requests_get, test_image_data_factory):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+
+        output = warm_caches("edepot:ST_00015", "--thumbnail-size", "50", "--thumbnail-size", "100")
+        assert "[1/1] edepot:ST_00015: 4 files, 0 errors" in output
+        assert "Warmed 1 dossiers with 4 files" in output
+
+        assert cache.get(get_metadata_cache_key({"stadsdeel": "ST", "dossier": "00015"})) is not None
+        for iiif_url in FILE_URLS:
+            url_info = parsing.get_url_info(iiif_url, True)
+            assert get_cached_dimensions(url_info)["width"] == 96
+            assert get_cached_rendition(url_info, 50)
+            assert get_cached_rendition(url_info, 100)
+
+    def test_warm_dimensions_only(self, mock_do_metadata_request, mock_requests_get, test_image_data_factory):
+        mock_do_metadata_request.return_value = MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+        mock_requests_get.return_value = MockResponse(
+            200, content=test_image_data_factory("test-image-96x85.jpg"), headers={"Content-Type": "image/jpeg"}
+        )
+
+        warm_caches("edepot:ST_00015", "--no-thumbnails")
+
+        url_info = parsing.get_url_info(FILE_URLS[0], True)
+        assert get_cached_dimensions(url_info)["width"] == 96
+        assert get_cached_rendition(url_info, 180) is None
+        assert mock_requests_get.call_count == len(FILE_URLS)
+
+    def test_warm_dossiers_from_access_log(
+        self, mock_do_metadata_request, mock_requests_get, test_image_data_factory, tmp_path
+    ):
+        def metadata_side_effect(metadata_url, *args, **kwargs):
+            if "ST_00015" in metadata_url:
+                return MockResponse(200, json_content=BATCH_METADATA_CONTENT)
+            return MockResponse(404)
+
+        mock_do_metadata_request.side_effect = metadata_side_effect
+        mock_requests_get.return_value = MockResponse(404)
+        access_log = tmp_path / "access.log"
+        access_log.write_text("GET /iiif/manifest/edepot:ST_00015\nGET /iiif/manifest/edepot:SA_12345\n")
+
+        output = warm_caches("--access-log", str(access_log), "--no-thumbnails")
+        assert "edepot:ST_00015: 4 files, 4 errors" in output
+        assert "edepot:SA_12345: failed, No metadata could be found for this dossier" in output
+        assert "Warmed 1 dossiers with 4 files" in output
+        assert "(1 dossiers and 4 files failed)" in output
+
+    def test_without_dossiers(self, mock_do_metadata_request, mock_requests_get):
+        with pytest.raises(CommandError):
+            warm_caches()
+
+    def test_process_local_cache_is_refused(self, mock_do_metadata_request, mock_requests_get, settings):
+        settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+        with pytest.raises(CommandError, match="isn't shared with the web server"):
+            warm_caches("edepot:ST_00015")
+
+        mock_do_metadata_request.assert_not_called()
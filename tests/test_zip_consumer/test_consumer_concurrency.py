@@ -0,0 +1,234 @@
+import json
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.queue import QueueMessage
+
+from zip_consumer.queue_zip_consumer import AzureZipQueueConsumer, MessageLease, MessageLeaseExpiredError
+
+
+def create_message(number):
+    return QueueMessage(
+        content=json.dumps({"version": "zip_job_v1", "data": f"job-{number}"}),
+        id=f"message-{number}",
+        pop_receipt=f"receipt-{number}",
+        dequeue_count=1,
+    )
+
+
+class FakeQueue:
+    # A queue which hands out every message once, like Azure does while the messages are invisible
+    def __init__(self, number_of_messages):
+        self.messages = [create_message(number) for number in range(number_of_messages)]
+        self.received = []
+        self.deleted = []
+        self.pop_receipts = {}
+        self.client = Mock()
+        self.client.receive_messages.side_effect = self.receive_messages
+        self.client.delete_message.side_effect = self.delete_message
+        self.client.update_message.side_effect = self.update_message
+        self.updates = []
+
+    def delete_message(self, message_id, pop_receipt):
+        assert pop_receipt == self.pop_receipts.get(message_id, pop_receipt)
+        self.deleted.append(message_id)
+
+    def update_message(self, message_id, pop_receipt, visibility_timeout):
+        assert pop_receipt == self.pop_receipts.get(message_id, pop_receipt)
+        self.updates.append((message_id, visibility_timeout))
+        self.pop_receipts[message_id] = f"receipt-{message_id}-{len(self.updates)}"
+        return QueueMessage(id=message_id, pop_receipt=self.pop_receipts[message_id])
+
+    def receive_messages(self, max_messages, messages_per_page, visibility_timeout):
+        assert messages_per_page == max_messages
+        messages, self.messages = self.messages[:max_messages], self.messages[max_messages:]
+        self.received.append(len(messages))
+        return iter(messages)
+
+
+class TestConsumerConcurrency:
+    def setup_method(self):
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def process_message(self, message, lease=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_jobs_are_processed_concurrently(self, mock_get_queue_client):
+        queue = FakeQueue(7)
+        mock_get_queue_client.return_value = queue.client
+
+        consumer = AzureZipQueueConsumer(end_at_empty_queue=True, concurrency=3)
+        consumer.process_message = self.process_message
+        consumer.run()
+
+        assert self.max_active == 3
+        # Never more messages are received than there are free job slots
+        assert queue.received[0] == 3
+        assert all(received <= 3 for received in queue.received)
+        assert sorted(queue.deleted) == [f"message-{number}" for number in range(7)]
+
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_stop_finishes_jobs_in_progress(self, mock_get_queue_client):
+        queue = FakeQueue(5)
+        mock_get_queue_client.return_value = queue.client
+        started = threading.Event()
+        finish = threading.Event()
+
+        def process_message(message, lease=None):
+            started.set()
+            finish.wait(5)
+
+        consumer = AzureZipQueueConsumer(concurrency=2)
+        consumer.process_message = process_message
+        thread = threading.Thread(target=consumer.run)
+        thread.start()
+        started.wait(5)
+
+        consumer.stop()
+        finish.set()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        # The received messages were processed, the others are left for other consumers
+        assert queue.received == [2]
+        assert sorted(queue.deleted) == ["message-0", "message-1"]
+        assert len(queue.messages) == 3
+
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_message_received_again_is_not_processed_twice(self, mock_get_queue_client):
+        queue = FakeQueue(1)
+        mock_get_queue_client.return_value = queue.client
+        consumer = AzureZipQueueConsumer()
+        consumer.process_message = Mock()
+        executor = Mock()
+
+        consumer._start_job(executor, queue.messages[0])
+        consumer._start_job(executor, queue.messages[0])
+
+        assert executor.submit.call_count == 1
+
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_message_with_expired_lease_is_not_deleted(self, mock_get_queue_client):
+        queue = FakeQueue(1)
+        mock_get_queue_client.return_value = queue.client
+
+        consumer = AzureZipQueueConsumer(end_at_empty_queue=True)
+        consumer.MESSAGE_VISIBILITY_TIMEOUT = 0.01
+        consumer.process_message = self.process_message
+        consumer.run()
+
+        # Another consumer could be processing the message by now
+        assert queue.deleted == []
+
+
+class TestPolling:
+    @pytest.fixture(autouse=True)
+    def poll_intervals(self, settings):
+        settings.ZIP_CONSUMER_MIN_POLL_INTERVAL = 1
+        settings.ZIP_CONSUMER_MAX_POLL_INTERVAL = 8
+
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_empty_queue_delay_grows_with_jitter(self, mock_get_queue_client):
+        consumer = AzureZipQueueConsumer()
+
+        with patch("zip_consumer.queue_zip_consumer.random.uniform", side_effect=lambda low, high: high):
+            assert [consumer.get_empty_queue_delay() for _ in range(5)] == [1, 2, 4, 8, 8]
+
+        consumer = AzureZipQueueConsumer()
+        delays = [consumer.get_empty_queue_delay() for _ in range(5)]
+        assert all(
+            low <= delay <= high for delay, (low, high) in zip(delays, [(0.5, 1), (1, 2), (2, 4), (4, 8), (4, 8)])
+        )
+
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_idle_consumer_backs_off_until_a_message_arrives(self, mock_get_queue_client):
+        queue = FakeQueue(0)
+        mock_get_queue_client.return_value = queue.client
+        consumer = AzureZipQueueConsumer()
+        consumer.process_message = Mock()
+        delays = []
+
+        def wait(timeout=None):
+            delays.append(timeout)
+            if len(delays) == 2:
+                queue.messages.append(create_message(0))
+            if len(delays) == 4:
+                consumer.stop()
+
+        consumer._wait = wait
+        with patch("zip_consumer.queue_zip_consumer.random.uniform", side_effect=lambda low, high: high):
+            consumer.run()
+
+        # The queue isn't polled between receives, and the delay starts over after a message was received
+        assert queue.received == [0, 0, 1, 0, 0]
+        assert delays == [1, 2, 1, 2]
+        assert queue.deleted == ["message-0"]
+        queue.client.get_queue_properties.assert_not_called()
+
+
+class TestMessageLease:
+    @patch("zip_consumer.queue_zip_consumer.get_queue_client")
+    def test_lease_is_renewed_while_the_job_runs(self, mock_get_queue_client):
+        queue = FakeQueue(1)
+        mock_get_queue_client.return_value = queue.client
+
+        def process_message(message, lease=None):
+            # Much longer than the visibility timeout
+            time.sleep(0.3)
+            lease.check()
+
+        consumer = AzureZipQueueConsumer(end_at_empty_queue=True)
+        consumer.MESSAGE_VISIBILITY_TIMEOUT = 0.1
+        consumer.MESSAGE_HEARTBEAT_INTERVAL = 0.02
+        consumer.process_message = process_message
+        consumer.run()
+
+        assert len(queue.updates) >= 5
+        assert queue.updates[0] == ("message-0", 0.1)
+        # The message is deleted with the pop receipt of the last renewal
+        assert queue.deleted == ["message-0"]
+
+    def test_lost_lease_is_not_renewed(self):
+        queue = FakeQueue(1)
+        queue.client.update_message.side_effect = ResourceNotFoundError("The specified message does not exist")
+        lease = MessageLease(queue.messages[0], visibility_timeout=60)
+
+        lease.renew(queue.client, 60)
+        lease.renew(queue.client, 60)
+
+        assert lease.expired
+        assert queue.client.update_message.call_count == 1
+
+    def test_lease_is_kept_after_a_failed_renewal(self):
+        queue = FakeQueue(1)
+        queue.client.update_message.side_effect = ConnectionError()
+        lease = MessageLease(queue.messages[0], visibility_timeout=60)
+
+        lease.renew(queue.client, 60)
+
+        assert not lease.expired
+        assert lease.pop_receipt == "receipt-0"
+
+    def test_overdue_lease_is_not_renewed(self):
+        queue = FakeQueue(1)
+        lease = MessageLease(queue.messages[0], visibility_timeout=60, max_duration=0.05)
+
+        lease.renew(queue.client, 60)
+        time.sleep(0.05)
+        lease.renew(queue.client, 60)
+
+        assert queue.client.update_message.call_count == 1
+        assert lease.expired
+        with pytest.raises(MessageLeaseExpiredError):
+            lease.check()
@@ -1,3 +1,4 @@
+from io import BytesIO
 from unittest.mock import Mock, patch
 
 import pytest
@@ -6,6 +7,7 @@ from django.conf import settings
 
 from iiif import image_server
 from tests.tools import MockResponse
+from zip_consumer.zip_tools import ZipStreamWriter
 
 METADATA_CONTENT = {
     "dossiernr": "02576",
@@ -37,7 +39,7 @@ def test_get_image_fails(mock_requests_get, http_status_code):
 
     mock_requests_get.return_value = mock_response
 
-    tmp_folder_path = "/tmp/bouwdossier-zips/"
+    zip_writer = ZipStreamWriter(BytesIO(), "job")
     info_txt_contents = ""
 
     iiif_url = "2/edepot:SJ_02576~SJ10027690_0"
@@ -64,7 +66,7 @@ def test_get_image_fails(mock_requests_get, http_status_code):
         image_info["url_info"],
         fail_reason,
         metadata,
-        tmp_folder_path,
+        zip_writer,
     )
 
     assert info_txt_contents[:30] == "SJ10027690_00001.jpg: excluded"
@@ -75,7 +77,7 @@ def test_get_image_200(mock_requests_get, test_image_data_factory):
     test_image_data = test_image_data_factory("test-image-96x85.jpg")
 
     mock_requests_get.return_value = MockResponse(200, content=test_image_data, headers={"Content-Type": "image/png"})
-    tmp_folder_path = "/tmp/bouwdossier-zips/"
+    zip_writer = ZipStreamWriter(BytesIO(), "job")
     info_txt_contents = ""
 
     iiif_url = "2/edepot:SJ_02576~SJ10027690_0"
@@ -102,7 +104,7 @@ def test_get_image_200(mock_requests_get, test_image_data_factory):
         image_info["url_info"],
         fail_reason,
         metadata,
-        tmp_folder_path,
+        zip_writer,
     )
 
     assert info_txt_contents[:30] == "SJ10027690_00001.jpg: included"
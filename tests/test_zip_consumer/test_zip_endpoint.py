@@ -1,6 +1,8 @@
 import json
-import os
+from io import BytesIO
 from unittest.mock import ANY, patch
+from uuid import uuid4
+from zipfile import ZipFile
 
 import pytest
 from azure.core.exceptions import ResourceNotFoundError
@@ -20,7 +22,6 @@ from tests.test_settings import (
 from tests.tools import MockResponse, create_authz_token
 from utils.storage import get_blob_from_storage_account
 from zip_consumer.queue_zip_consumer import AzureZipQueueConsumer
-from zip_consumer.zip_tools import TMP_BOUWDOSSIER_ZIP_FOLDER
 
 
 @pytest.mark.django_db
@@ -352,7 +353,7 @@ class TestZipEndpoint:
     @patch("requests.get")
     @patch("iiif.metadata.do_metadata_request")
     @patch("auth_mail.mailing.send_email")
-    @patch("zip_consumer.zip_tools.cleanup_local_files")
+    @patch("zip_consumer.zip_tools.uuid4")
     @pytest.mark.parametrize(
         "scope, second_image_access, expected_line_end, expected_files",
         [
@@ -378,7 +379,7 @@ class TestZipEndpoint:
     )
     def test_consumer(
         self,
-        mock_cleanup_local_files,
+        mock_uuid4,
         mock_send_email,
         mock_do_metadata_request,
         mock_requests_get,
@@ -390,9 +391,11 @@ class TestZipEndpoint:
         client,
         test_image_data_factory,
         test_queue_client,
+        download_blob_container,
     ):
         # Setting up mocks
-        mock_cleanup_local_files.return_value = None
+        zipjob_uuid = uuid4()
+        mock_uuid4.return_value = zipjob_uuid
         mock_send_email.return_value = None
         mock_do_metadata_request.return_value = MockResponse(
             200,
@@ -471,22 +474,17 @@ class TestZipEndpoint:
         # Test whether the records that were in the queue are correctly removed
         assert len(self.get_all_queue_messages(test_queue_client)) == 0
 
-        # Check whether the newly created zip file exists
-        tmp_contents = sorted(
-            os.listdir(TMP_BOUWDOSSIER_ZIP_FOLDER)
-        )  # Sorting it so the first is the folder and the second the zip
-        assert len(tmp_contents) == 2
-        assert os.path.isdir(os.path.join(TMP_BOUWDOSSIER_ZIP_FOLDER, tmp_contents[0]))
-        assert os.path.isfile(os.path.join(TMP_BOUWDOSSIER_ZIP_FOLDER, tmp_contents[1]))
-        assert tmp_contents[0] + ".zip" == tmp_contents[1]
+        # Check whether the zip was uploaded to the storage account
+        zip_bytes = download_blob_container.download_blob(f"{zipjob_uuid}.zip").readall()
+        with ZipFile(BytesIO(zip_bytes)) as zip_file:
+            # Check whether the zip contains the expected number of files
+            files = zip_file.namelist()
+            assert len(files) == expected_files
+            assert all(file.startswith(f"{zipjob_uuid}/") for file in files)
 
-        # Check whether the zip contains the expected number of files
-        files = os.listdir(f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{tmp_contents[0]}")
-        assert len(files) == expected_files
-
-        # Check whether the report.txt contains info about the missing restrictions
-        with open(f"{TMP_BOUWDOSSIER_ZIP_FOLDER}{tmp_contents[0]}/report.txt", "r") as f:
-            assert f.readlines()[-1].endswith(expected_line_end + "\n")
+            # Check whether the report.txt contains info about the missing restrictions
+            report_lines = zip_file.read(f"{zipjob_uuid}/report.txt").decode().splitlines(keepends=True)
+            assert report_lines[-1].endswith(expected_line_end + "\n")
 
         # Check whether an email was sent
         mock_send_email.method_called_with("zip@amsterdam.nl", ANY, ANY)
@@ -494,6 +492,3 @@ class TestZipEndpoint:
         # Check whether the zip job blob was removed
         with pytest.raises(ResourceNotFoundError):
             self.get_zip_job(job_name)
-
-        # Cleanup so that other tests are not influenced
-        os.system(f"rm -rf {TMP_BOUWDOSSIER_ZIP_FOLDER}*")
@@ -1,5 +1,7 @@
 import time
 
+from azure.core.exceptions import ServiceResponseError
+from azure.storage.blob import BlobBlock
 from django.conf import settings
 from jwcrypto.common import JWException
 from jwcrypto.jwk import JWKSet
@@ -46,7 +48,39 @@ class MockResponse:
         self.status_code = status_code
         self.json_content = json_content
         self.content = content
-        self.headers = headers
+        self.headers = headers if headers is not None else {}
 
     def json(self):
         return self.json_content
+
+    def close(self):
+        self.closed = True
+
+
+class MockBlobClient:
+    # Keeps the staged and committed blocks of a block blob in memory. Staging the blocks in failing_block_ids fails.
+    def __init__(self, blob_name="test.zip", failing_block_ids=()):
+        self.blob_name = blob_name
+        self.failing_block_ids = set(failing_block_ids)
+        self.staged_blocks = {}
+        self.committed_block_ids = None
+
+    def stage_block(self, block_id, data):
+        if block_id in self.failing_block_ids:
+            raise ServiceResponseError("Connection reset")
+        self.staged_blocks[block_id] = bytes(data)
+
+    def get_block_list(self, block_list_type="committed"):
+        uncommitted = []
+        for block_id, data in self.staged_blocks.items():
+            block = BlobBlock(block_id)
+            block.size = len(data)
+            uncommitted.append(block)
+        return [], uncommitted
+
+    def commit_block_list(self, block_list):
+        self.committed_block_ids = list(block_list)
+
+    @property
+    def content(self):
+        return b"".join(self.staged_blocks[block_id] for block_id in self.committed_block_ids)